@@ -1,27 +1,72 @@
 # This file is part of atooms
 # Copyright 2010-2018, Daniele Coslovich
 
+"""
+Post-processing code for particle simulations.
+
+Correlation functions are imported lazily, upon first access, so
+that importing the package, e.g. to run `pp.py --help`, does not pull
+in numpy and the trajectory modules.
+"""
+
+import sys
 import logging
+import importlib
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
-from .correlation import *
-from .partial import *
-from .filter import Filter
-from .susceptibility import Susceptibility
+# Modules of the public names of the package
+_modules = {
+    'correlation': ['acf', 'gcf', 'gcf_offset', 'gcf_offset_batch', 'acf_fft', 'msd_fft',
+                    'gcf_fft', 'use_fft', 'gcf_multiple_tau', 'Correlation'],
+    'partial': ['Partial'],
+    'pipeline': ['Pipeline'],
+    'filter': ['Filter'],
+    'helpers': ['filter_species'],
+    'susceptibility': ['Susceptibility'],
+    # Real space correlation functions
+    'alpha2': ['NonGaussianParameter'],
+    'chi4t': ['Chi4SelfOverlap', 'Chi4SelfOverlapOptimized'],
+    'gr': ['RadialDistributionFunction', 'RadialDistributionFunctionLegacy',
+           'RadialDistributionFunctionFast', 'RadialDistributionFunctionNumpy'],
+    'msd': ['MeanSquareDisplacement'],
+    'qt': ['CollectiveOverlap', 'SelfOverlap'],
+    'vacf': ['VelocityAutocorrelation'],
+    'ba': ['BondAngleDistribution'],
+    # Fourier space correlation functions
+    'fkt': ['SelfIntermediateScattering', 'SelfIntermediateScatteringLegacy',
+            'SelfIntermediateScatteringFast', 'IntermediateScattering'],
+    'ik': ['SpectralDensity'],
+    's4kt': ['S4ktOverlap'],
+    'sk': ['StructureFactor', 'StructureFactorLegacy', 'StructureFactorOptimized'],
+}
+
+_names = {}
+for _module, _attributes in _modules.items():
+    for _name in _attributes:
+        _names[_name] = _module
+
+__all__ = sorted(_names)
+
+
+def __getattr__(name):
+    if name in _names:
+        value = getattr(importlib.import_module('.' + _names[name], __name__), name)
+        globals()[name] = value
+        return value
+    # Submodules, e.g. correlation.core
+    if name.startswith('_'):
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    try:
+        return importlib.import_module('.' + name, __name__)
+    except ImportError:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-# Real space correlation functions
-from .alpha2 import *
-from .chi4t import *
-from .gr import *
-from .msd import *
-from .qt import *
-from .vacf import *
-from .ba import *
 
-# Real space correlation functions
-from .fkt import *
-from .ik import *
-from .s4kt import *
-from .sk import *
+def __dir__():
+    return sorted(set(globals()) | set(_names))
 
 
+# Module-level __getattr__ requires python >= 3.7
+if sys.version_info < (3, 7):
+    for _name in __all__:
+        globals()[_name] = __getattr__(_name)
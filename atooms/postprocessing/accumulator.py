@@ -0,0 +1,93 @@
+# This file is part of atooms
+# Copyright 2010-2018, Daniele Coslovich
+
+"""
+Streaming accumulators for statistical errors.
+
+Samples of a correlation function, e.g. its value at a given time
+origin, are summed within a small number of blocks, each covering a
+contiguous portion of the trajectory. The block means are then
+combined with Welford's algorithm to estimate the statistical error
+on the mean. Only the running sums are stored, so the memory overhead
+is negligible.
+"""
+
+import numpy
+
+__all__ = ['Welford', 'BlockAverage']
+
+
+class Welford(object):
+
+    """Streaming mean and variance using Welford's algorithm"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.count
+        self._m2 = self._m2 + delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        """Unbiased variance of the samples"""
+        if self.count < 2:
+            return self._m2 * float('nan')
+        return self._m2 / (self.count - 1)
+
+    @property
+    def error(self):
+        """Standard error on the mean"""
+        if self.count == 0:
+            return float('nan')
+        return (self.variance / self.count)**0.5
+
+
+class BlockAverage(object):
+
+    """
+    Block averages of samples labelled by a key, e.g. time
+    differences.
+
+    Each sample is added to one of `nblocks` blocks. The error on the
+    mean is the standard error of the block means. Values may be
+    scalars or numpy arrays.
+    """
+
+    def __init__(self, nblocks):
+        self.nblocks = nblocks
+        self._sum = {}
+        self._count = {}
+
+    def add(self, key, block, value, count=1):
+        """
+        Add `value`, the sum of `count` samples, to `block` for
+        `key`.
+        """
+        if key not in self._sum:
+            self._sum[key] = [0.0] * self.nblocks
+            self._count[key] = [0] * self.nblocks
+        self._sum[key][block] = self._sum[key][block] + value
+        self._count[key][block] += count
+
+    def block(self, frame, nframes):
+        """Return the block of `frame` in a trajectory of `nframes` frames"""
+        return min(self.nblocks - 1, frame * self.nblocks // max(1, nframes))
+
+    def error(self, key=None):
+        """
+        Return the error on the mean for `key`. It is nan if less than
+        two blocks have samples.
+        """
+        welford = Welford()
+        for value, count in zip(self._sum[key], self._count[key]):
+            if count > 0:
+                welford.add(numpy.asarray(value) / float(count))
+        return welford.error
+
+    def keys(self):
+        return self._sum.keys()
@@ -6,7 +6,7 @@
 import numpy
 
 from .helpers import linear_grid
-from .correlation import Correlation, gcf_offset
+from .correlation import Correlation, gcf_offset_batch
 from .helpers import setup_t_grid, ifabsmm
 
 __all__ = ['NonGaussianParameter']
@@ -29,15 +29,19 @@ class NonGaussianParameter(Correlation):
 
     def _compute(self):
         def alpha_2(x, y):
-            if x is y:
-                return 0.0
-            dx2 = (x - y)**2
-            dr2 = numpy.sum(dx2) / float(x.shape[0])
-            dr4 = numpy.sum(numpy.sum(dx2, axis=1)**2) / float(x.shape[0])
-            return 3 * dr4 / (5 * dr2**2) - 1
-
-        self.grid, self.value = gcf_offset(alpha_2, self._discrete_tgrid, self.skip,
-                                           self.trajectory.steps, self._pos_unf)
+            dx2 = numpy.sum((x - y)**2, axis=2)
+            dr2 = numpy.sum(dx2, axis=1) / float(x.shape[1])
+            dr4 = numpy.sum(dx2**2, axis=1) / float(x.shape[1])
+            # Vanishing displacements, e.g. at t=0
+            zero = dr2 == 0
+            dr2[zero] = 1.0
+            return numpy.where(zero, 0.0, 3 * dr4 / (5 * dr2**2) - 1)
+
+        blocks = self._block_average()
+        self.grid, self.value = gcf_offset_batch(alpha_2, self._discrete_tgrid, self.skip,
+                                                 self.trajectory.steps, self._pos_unf,
+                                                 blocks=blocks)
+        self._set_error(blocks)
         self.grid = [ti * self.trajectory.timestep for ti in self.grid]
 
     def analyze(self):
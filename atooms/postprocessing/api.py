@@ -1,10 +1,9 @@
 """Post processing API."""
 
+# Heavy modules, such as the correlation functions and atooms
+# trajectories, are imported only when needed, so that building the
+# command line interface of pp.py is fast
 import atooms.postprocessing as pp
-from atooms.postprocessing.partial import Partial
-from atooms.trajectory import Trajectory
-from atooms.trajectory.decorators import change_species, center
-from atooms.system.particle import distinct_species
 
 from .helpers import linear_grid, logx_grid
 
@@ -13,28 +12,32 @@ _func_db = {'linear_grid': linear_grid,
             'logx_grid': logx_grid,
             'logx': logx_grid}
 
+def distinct_species(particle):
+    from atooms.system.particle import distinct_species
+    return distinct_species(particle)
+
+
 def _get_trajectories(input_files, args):
-    from atooms.trajectory import Sliced
-    from atooms.core.utils import fractional_slice
+    from atooms.trajectory import Trajectory
+    from atooms.trajectory.decorators import change_species, center
+    from .slicing import frame_plan, TrajectorySlice
     for input_file in input_files:
         with Trajectory(input_file, fmt=args['fmt']) as th:
             if args['center']:
                 th.add_callback(center)
-            # Caching is useful for systems with multiple species but
-            # it will increase the memory footprint. Use --no-cache to
-            # disable it
-            if not args['no_cache']:
-                th.cache = True
             if args['species_layout'] is not None:
                 th.register_callback(change_species, args['species_layout'])
-            sl = fractional_slice(args['first'], args['last'], args['skip'], len(th))
-            if th.block_size > 1:
-                sl_start = (sl.start // th.block_size) * th.block_size if sl.start is not None else sl.start
-                sl_stop = (sl.stop // th.block_size) * th.block_size if sl.stop is not None else sl.stop
-                sl = slice(sl_start, sl_stop, sl.step)
-            if sl != slice(None, None, 1):
-                ts = Sliced(th, sl)
+            frames = frame_plan(th, args['first'], args['last'], args['skip'])
+            if frames != list(range(len(th))):
+                # The frames of the slice are read directly from the
+                # trajectory and systems are not cached
+                ts = TrajectorySlice(th, frames)
             else:
+                # Caching is useful for systems with multiple species
+                # but it will increase the memory footprint. Use
+                # --no-cache to disable it
+                if not args['no_cache']:
+                    th.cache = True
                 ts = th
             yield ts
 
@@ -85,8 +88,8 @@ def gr(input_file, dr=0.04, grandcanonical=False, ndim=-1, rmax=-1.0, *input_fil
 
         ids = distinct_species(th[0].particle)
         if len(ids) > 1 and not global_args['no_partial']:
-            cf = Partial(backend, ids, th,
-                         dr=dr, rmax=rmax, norigins=global_args['norigins'], ndim=ndim)
+            cf = pp.Partial(backend, ids, th,
+                            dr=dr, rmax=rmax, norigins=global_args['norigins'], ndim=ndim)
             cf.do(update=global_args['update'])
 
 def sk(input_file, nk=20, dk=0.1, kmin=-1.0, kmax=15.0, ksamples=30,
@@ -118,10 +121,10 @@ def sk(input_file, nk=20, dk=0.1, kmin=-1.0, kmax=15.0, ksamples=30,
 
         ids = distinct_species(th[0].particle)
         if len(ids) > 1 and not global_args['no_partial']:
-            cf = Partial(backend, ids, th, kgrid=kgrid,
-                         norigins=global_args['norigins'],
-                         kmin=kmin, kmax=kmax, nk=nk, dk=dk,
-                         ksamples=ksamples)
+            cf = pp.Partial(backend, ids, th, kgrid=kgrid,
+                            norigins=global_args['norigins'],
+                            kmin=kmin, kmax=kmax, nk=nk, dk=dk,
+                            ksamples=ksamples)
             cf.add_weight(trajectory=weight_trajectory,
                           field=weight,
                           fluctuations=weight_fluctuations)
@@ -162,9 +165,9 @@ def msd(input_file, tmax=-1.0, tmax_fraction=0.75, tsamples=30,
                                   sigma=sigma, rmax=rmsd_max,
                                   fix_cm=fix_cm).do(update=global_args['update'])
         if len(ids) > 1:
-            Partial(pp.MeanSquareDisplacement, ids, th, tgrid=t_grid,
-                    norigins=global_args['norigins'], sigma=sigma,
-                    rmax=rmsd_max).do(update=global_args['update'])
+            pp.Partial(pp.MeanSquareDisplacement, ids, th, tgrid=t_grid,
+                       norigins=global_args['norigins'], sigma=sigma,
+                       rmax=rmsd_max).do(update=global_args['update'])
 
 def vacf(input_file, tmax=-1.0, tmax_fraction=0.10,
          tsamples=30, func='linear', *input_files, **global_args):
@@ -181,8 +184,8 @@ def vacf(input_file, tmax=-1.0, tmax_fraction=0.10,
         pp.VelocityAutocorrelation(th, t_grid, norigins=global_args['norigins']).do(update=global_args['update'])
         ids = distinct_species(th[0].particle)
         if len(ids) > 1:
-            Partial(pp.VelocityAutocorrelation, ids, th,
-                    t_grid, norigins=global_args['norigins']).do(update=global_args['update'])
+            pp.Partial(pp.VelocityAutocorrelation, ids, th,
+                       t_grid, norigins=global_args['norigins']).do(update=global_args['update'])
 
 def fkt(input_file, tmax=-1.0, tmax_fraction=0.75,
         tsamples=60, kmin=7.0, kmax=7.0, ksamples=1, dk=0.1, nk=100,
@@ -204,9 +207,9 @@ def fkt(input_file, tmax=-1.0, tmax_fraction=0.75,
             k_grid = linear_grid(kmin, kmax, ksamples)
         ids = distinct_species(th[0].particle)
         if len(ids) > 1:
-            Partial(pp.IntermediateScattering, ids, th, k_grid, t_grid,
-                    norigins=global_args['norigins'],
-                    nk=nk, dk=dk, fix_cm=fix_cm).do(update=global_args['update'])
+            pp.Partial(pp.IntermediateScattering, ids, th, k_grid, t_grid,
+                       norigins=global_args['norigins'],
+                       nk=nk, dk=dk, fix_cm=fix_cm).do(update=global_args['update'])
 
 def fskt(input_file, tmax=-1.0, tmax_fraction=0.75, tsamples=60,
          kmin=7.0, kmax=8.0, ksamples=1, dk=0.1, nk=8, kgrid=None,
@@ -236,9 +239,9 @@ def fskt(input_file, tmax=-1.0, tmax_fraction=0.75, tsamples=60,
                     lookup_mb=lookup_mb).do(update=global_args['update'])
         ids = distinct_species(th[0].particle)
         if len(ids) > 1:
-            Partial(backend, ids, th, k_grid, t_grid, nk, dk=dk,
-                    norigins=global_args['norigins'], fix_cm=fix_cm,
-                    lookup_mb=lookup_mb).do(update=global_args['update'])
+            pp.Partial(backend, ids, th, k_grid, t_grid, nk, dk=dk,
+                       norigins=global_args['norigins'], fix_cm=fix_cm,
+                       lookup_mb=lookup_mb).do(update=global_args['update'])
 
 def chi4qs(input_file, tsamples=60, a=0.3, tmax=-1.0, func='logx',
            tmax_fraction=0.75, total=False, *input_files,
@@ -262,8 +265,8 @@ def chi4qs(input_file, tsamples=60, a=0.3, tmax=-1.0, func='logx',
             backend(th, t_grid, a=a, norigins=global_args['norigins']).do(update=global_args['update'])
         ids = distinct_species(th[0].particle)
         if not total and len(ids) > 1:
-            Partial(backend, ids, th, t_grid, a=a,
-                    norigins=global_args['norigins']).do(update=global_args['update'])
+            pp.Partial(backend, ids, th, t_grid, a=a,
+                       norigins=global_args['norigins']).do(update=global_args['update'])
 
 def alpha2(input_file, tmax=-1.0, tmax_fraction=0.75,
            tsamples=60, func='logx', *input_files, **global_args):
@@ -280,8 +283,8 @@ def alpha2(input_file, tmax=-1.0, tmax_fraction=0.75,
         pp.NonGaussianParameter(th, t_grid, norigins=global_args['norigins']).do(update=global_args['update'])
         ids = distinct_species(th[0].particle)
         if len(ids) > 1:
-            Partial(pp.NonGaussianParameter, ids, th, t_grid,
-                    norigins=global_args['norigins']).do(update=global_args['update'])
+            pp.Partial(pp.NonGaussianParameter, ids, th, t_grid,
+                       norigins=global_args['norigins']).do(update=global_args['update'])
 
 def qst(input_file, tmax=-1.0, tmax_fraction=0.75,
         tsamples=60, func='logx', *input_files, **global_args):
@@ -298,8 +301,8 @@ def qst(input_file, tmax=-1.0, tmax_fraction=0.75,
         pp.SelfOverlap(th, t_grid, norigins=global_args['norigins']).do(update=global_args['update'])
         ids = distinct_species(th[0].particle)
         if len(ids) > 1:
-            Partial(pp.SelfOverlap, ids, th, t_grid,
-                    norigins=global_args['norigins']).do(update=global_args['update'])
+            pp.Partial(pp.SelfOverlap, ids, th, t_grid,
+                       norigins=global_args['norigins']).do(update=global_args['update'])
 
 def qt(input_file, tmax=-1.0, tmax_fraction=0.75,
         tsamples=60, func='logx', *input_files, **global_args):
@@ -316,8 +319,8 @@ def qt(input_file, tmax=-1.0, tmax_fraction=0.75,
         pp.CollectiveOverlap(th, t_grid, norigins=global_args['norigins']).do(update=global_args['update'])
         ids = distinct_species(th[0].particle)
         if len(ids) > 1:
-            Partial(pp.CollectiveOverlap, ids, th, t_grid,
-                    norigins=global_args['norigins']).do(update=global_args['update'])
+            pp.Partial(pp.CollectiveOverlap, ids, th, t_grid,
+                       norigins=global_args['norigins']).do(update=global_args['update'])
 
 def ba(input_file, dtheta=4.0, grandcanonical=False, *input_files, **global_args):
     """Bond-angle distribution"""
@@ -332,5 +335,5 @@ def ba(input_file, dtheta=4.0, grandcanonical=False, *input_files, **global_args
 
         # ids = distinct_species(th[0].particle)
         # if len(ids) > 1 and not global_args['no_partial']:
-        #     cf = Partial(pp.BondAngleDistribution, ids, th, dtheta=dtheta, norigins=global_args['norigins'])
+        #     cf = pp.Partial(pp.BondAngleDistribution, ids, th, dtheta=dtheta, norigins=global_args['norigins'])
         #     cf.do(update=global_args['update'])
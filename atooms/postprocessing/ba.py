@@ -8,7 +8,7 @@ import logging
 
 import numpy
 
-from .helpers import linear_grid
+from .helpers import linear_grid, required_frames
 from .correlation import Correlation
 from .progress import progress
 
@@ -61,12 +61,15 @@ class BondAngleDistribution(Correlation):
         self.grid = linear_grid(0.0, 180.0, dtheta)  # reassign grid anyway
         self.rcut = rcut
 
+    def _required_frames(self):
+        return required_frames(len(self.trajectory), self.skip)
+
     def _compute(self):
-        from atooms.trajectory.decorators import change_species
         from atooms.postprocessing.realspace_wrap import compute
         from atooms.system.particle import distinct_species
+        from .neighbors import VerletList, pair_search, pairs_distance_squared
 
-        hist_all = []
+        hist = numpy.zeros(len(self.grid), dtype=numpy.int64)
         hist_one = numpy.ndarray(len(self.grid), dtype=numpy.int32)
         origins = range(0, len(self.trajectory), self.skip)
         dtheta = self.grid[1] - self.grid[0]
@@ -81,34 +84,36 @@ class BondAngleDistribution(Correlation):
             self.rcut = numpy.ndarray((len(ids), len(ids)))
             for species_pair in rcut:
                 self.rcut[ids.index(species_pair[0]), ids.index(species_pair[1])] = rcut[species_pair]
+        self.rcut = numpy.asarray(self.rcut)
 
-        for isp in range(len(ids)):
-            for jsp in range(len(ids)):
+        for isp in range(self.rcut.shape[0]):
+            for jsp in range(self.rcut.shape[1]):
                 self.analysis['cutoff distance {}-{}'.format(isp, jsp)] = self.rcut[isp, jsp]
 
+        # Neighbors are reused across frames when possible
+        if self._fixed_particles():
+            neighbors = VerletList(rcut=numpy.max(self.rcut))
+        else:
+            neighbors = pair_search(numpy.max(self.rcut), self._cell_side[0], self._pos_1[0])
         for i in progress(origins):
-            system = self.trajectory[i]
-            side = system.cell.side  # this should not be affected by filters
-            #system = change_species(system, 'F')  # species are in fortran style
-            #ids = numpy.array(system.dump('spe'), dtype=numpy.int32)
-            nn = numpy.array(0, dtype=numpy.int32)
-            neighbors = numpy.ndarray(50, dtype=numpy.int32)
-            for idx in range(len(self._pos_0[i])):
-                isp = self._ids_0[i][idx]
-                compute.neighbors('C', side, self._pos_0[i][idx],
-                                  self._pos_1[i].transpose(),
-                                  self._ids_1[i],
-                                  self.rcut[isp, :],
-                                  nn, neighbors)
-                #print idx, self._pos_1[i].shape, neighbors[0: nn], set(self._ids_1[i])
-                compute.bond_angle(self._pos_0[i][idx, :],
-                                   self._pos_1[i].transpose(),
-                                   neighbors[0: nn], side, dtheta,
+            side = self._cell_side[i]  # this should not be affected by filters
+            x, y = self._pos_0[i], self._pos_1[i]
+            offsets, indices = neighbors.compute(side, x, y)
+            # Keep neighbors within the cutoff of each pair of species
+            owner = numpy.repeat(numpy.arange(len(x)), numpy.diff(offsets))
+            rcut = self.rcut[self._ids_0[i][owner], self._ids_1[i][indices]]
+            within = pairs_distance_squared(x, y, owner, indices, side) < rcut**2
+            indices = indices[within].astype(numpy.int32)
+            offsets = numpy.zeros(len(x) + 1, dtype=numpy.int64)
+            numpy.cumsum(numpy.bincount(owner[within], minlength=len(x)), out=offsets[1:])
+            y = y.transpose()
+            for idx in range(len(x)):
+                compute.bond_angle(x[idx, :], y,
+                                   indices[offsets[idx]: offsets[idx+1]], side, dtheta,
                                    hist_one)
-                hist_all.append(hist_one.copy())
+                hist += hist_one
 
         # Normalization
-        hist = numpy.sum(hist_all, axis=0)
         norm = float(numpy.sum(hist[:-1]))
         self.grid = (numpy.array(self.grid[:-1]) + numpy.array(self.grid[1:])) / 2.0
         self.value = hist[:-1] / (norm * dtheta)
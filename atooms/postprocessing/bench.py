@@ -0,0 +1,268 @@
+# This file is part of atooms
+# Copyright 2010-2018, Daniele Coslovich
+
+"""
+Benchmarks of correlation functions on synthetic trajectories.
+
+Run the benchmarks with
+
+    python -m atooms.postprocessing.bench [options]
+
+For each correlation function, backend, number of particles and
+number of frames, we build an in-memory synthetic trajectory of
+random walkers, see `TrajectorySynthetic`. With `--xyz`, the
+trajectory is written in a temporary xyz file and read back from
+disk instead, so that file parsing is included in the timings. We
+then measure the time spent reading the phase space arrays from the
+trajectory (setup), the time spent computing the correlation
+function (compute), the peak memory allocated during both stages and
+the throughput, i.e. the number of particle frames processed per
+second. Results are stored in a JSON
+file, see `--output`, to track regressions and speedups.
+
+With `--startup`, we instead measure the wall time of fresh
+interpreters that import `atooms.postprocessing` and print the help
+of `pp.py`, and fail if the latter is slower than `--target` seconds.
+
+Cases with more than `--max-size` particle frames are skipped, to
+keep the largest trajectories within a reasonable memory budget.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy
+from atooms.trajectory import TrajectoryXYZ
+
+from . import core
+from .synthetic import TrajectorySynthetic
+from .gr import RadialDistributionFunctionLegacy, RadialDistributionFunctionFast, \
+    RadialDistributionFunctionNumpy
+from .sk import StructureFactorLegacy, StructureFactorFast
+from .fkt import IntermediateScattering, SelfIntermediateScatteringLegacy, \
+    SelfIntermediateScatteringFast
+from .msd import MeanSquareDisplacement
+from .chi4t import Chi4SelfOverlap, Chi4SelfOverlapOptimized
+from .qt import CollectiveOverlap
+from .ba import BondAngleDistribution
+from .ik import SpectralDensity
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__all__ = ['write_trajectory', 'run', 'startup_time', 'main']
+
+_log = logging.getLogger(__name__)
+
+_kgrid = [4.0, 7.3]
+
+# Factories of the correlation functions to benchmark, for each
+# symbol and backend. Parameters are chosen so that the cost of each
+# case is dominated by the kernels, not by the grids.
+cases = {
+    'gr': {
+        'legacy': lambda th: RadialDistributionFunctionLegacy(th, norigins=10),
+        'fast': lambda th: RadialDistributionFunctionFast(th, norigins=10),
+        'numpy': lambda th: RadialDistributionFunctionNumpy(th, norigins=10),
+    },
+    'sk': {
+        'legacy': lambda th: StructureFactorLegacy(th, _kgrid, norigins=10, nk=10),
+        'fast': lambda th: StructureFactorFast(th, _kgrid, norigins=10, nk=10),
+    },
+    'fkt': {
+        'default': lambda th: IntermediateScattering(th, _kgrid, nk=4, tsamples=10),
+    },
+    'fskt': {
+        'legacy': lambda th: SelfIntermediateScatteringLegacy(th, _kgrid, nk=4, tsamples=10),
+        'fast': lambda th: SelfIntermediateScatteringFast(th, _kgrid, nk=4, tsamples=10),
+    },
+    'msd': {
+        'direct': lambda th: MeanSquareDisplacement(th, tsamples=10, algorithm='direct'),
+        'fft': lambda th: MeanSquareDisplacement(th, tsamples=10, algorithm='fft'),
+    },
+    'chi4qs': {
+        'legacy': lambda th: Chi4SelfOverlap(th, norigins=10, tsamples=10),
+        'fast': lambda th: Chi4SelfOverlapOptimized(th, norigins=10, tsamples=10),
+    },
+    'qt': {
+        'default': lambda th: CollectiveOverlap(th, tsamples=10),
+    },
+    'ba': {
+        # An explicit cutoff avoids computing (and writing) partial g(r)
+        'default': lambda th: BondAngleDistribution(th, norigins=10, rcut=numpy.full((2, 2), 1.5)),
+    },
+    'ik': {
+        'default': lambda th: SpectralDensity(th, th, _kgrid, norigins=10, nk=10),
+    },
+}
+
+
+def write_trajectory(path, trajectory):
+    """Write the synthetic `trajectory` in the xyz file `path`"""
+    with TrajectoryXYZ(path, 'w', fields=['species', 'position', 'radius']) as th:
+        th.timestep = trajectory.timestep
+        for step, system in zip(trajectory.steps, trajectory):
+            th.write(system, step)
+
+
+def run(symbol, backend, trajectory, memory=True):
+    """
+    Benchmark the correlation function `symbol` with `backend` on
+    `trajectory`. Return a dictionary of results.
+    """
+    result = {'symbol': symbol, 'backend': backend,
+              'npart': len(trajectory[0].particle), 'nframes': len(trajectory)}
+    if memory and tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        cf = cases[symbol][backend](trajectory)
+        result['class'] = cf.__class__.__name__
+        start = time.time()
+        cf._setup_arrays()
+        result['setup_time'] = time.time() - start
+        # Arrays are ready, compute() will not read them again
+        cf._phasespace_ready = True
+        start = time.time()
+        cf.compute()
+        result['compute_time'] = time.time() - start
+        total_time = result['setup_time'] + result['compute_time']
+        result['throughput'] = result['npart'] * result['nframes'] / max(total_time, 1e-9)
+    except Exception as e:
+        _log.warning('%s %s failed: %s', symbol, backend, e)
+        result['error'] = '{}: {}'.format(e.__class__.__name__, e)
+    finally:
+        if memory and tracemalloc is not None:
+            result['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+        else:
+            result['peak_memory_mb'] = None
+    return result
+
+
+def startup_time(command, repeat=5):
+    """
+    Return the best wall time, in seconds, out of `repeat` executions
+    of `command` in a fresh python interpreter.
+
+    The `command` is a list of arguments passed to the interpreter,
+    e.g. `['-c', 'import atooms.postprocessing']`.
+    """
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable] + list(command), stdout=devnull)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best
+
+
+def _startup(args):
+    pp_script = os.path.join(os.path.dirname(__file__), '..', '..', 'bin', 'pp.py')
+    commands = {'python': ['-c', 'pass'],
+                'import': ['-c', 'import atooms.postprocessing'],
+                'help': [pp_script, '--help']}
+    results = []
+    for name in ['python', 'import', 'help']:
+        if name == 'help' and not os.path.exists(pp_script):
+            _log.warning('cannot find %s, skipping', pp_script)
+            continue
+        result = {'symbol': 'startup', 'backend': name,
+                  'time': startup_time(commands[name], args.repeat)}
+        print('{symbol:7s} {backend:8s} time={time:.3f}s'.format(**result))
+        results.append(result)
+
+    with open(args.output, 'w') as fh:
+        json.dump({'metadata': _metadata(), 'results': results}, fh, indent=1)
+    if results[-1]['backend'] == 'help' and results[-1]['time'] > args.target:
+        raise SystemExit('pp.py --help took {:.3f}s, target is {:.3f}s'.format(
+            results[-1]['time'], args.target))
+    return results
+
+
+def _metadata():
+    return {'version': core.__version__,
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-o', '--output', dest='output', default='bench.json',
+                        help='output JSON file')
+    parser.add_argument('-c', '--correlation', dest='symbols', nargs='+',
+                        default=sorted(cases), choices=sorted(cases),
+                        help='correlation functions to benchmark')
+    parser.add_argument('-b', '--backend', dest='backends', nargs='+', default=None,
+                        help='backends to benchmark (default: all)')
+    parser.add_argument('-N', '--npart', dest='npart', type=int, nargs='+',
+                        default=[100, 1000, 10000, 100000], help='numbers of particles')
+    parser.add_argument('-f', '--nframes', dest='nframes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000], help='numbers of frames')
+    parser.add_argument('--max-size', dest='max_size', type=float, default=1e7,
+                        help='skip cases with more particle frames than this')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='do not trace peak memory')
+    parser.add_argument('--xyz', dest='xyz', action='store_true',
+                        help='read synthetic trajectories from xyz files')
+    parser.add_argument('--tmpdir', dest='tmpdir', default=None,
+                        help='directory for xyz files')
+    parser.add_argument('--startup', dest='startup', action='store_true',
+                        help='benchmark import and pp.py startup times')
+    parser.add_argument('--target', dest='target', type=float, default=0.5,
+                        help='maximum startup time of pp.py --help in seconds')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help='number of executions of startup benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        return _startup(args)
+
+    results = []
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+    try:
+        for npart in args.npart:
+            for nframes in args.nframes:
+                if npart * nframes > args.max_size:
+                    _log.info('skipping N=%d, %d frames', npart, nframes)
+                    continue
+                th = TrajectorySynthetic(npart, nframes)
+                if args.xyz:
+                    path = os.path.join(tmpdir, 'N{}_frames{}.xyz'.format(npart, nframes))
+                    write_trajectory(path, th)
+                    th = TrajectoryXYZ(path)
+                with th:
+                    for symbol in args.symbols:
+                        for backend in sorted(cases[symbol]):
+                            if args.backends is not None and backend not in args.backends:
+                                continue
+                            result = run(symbol, backend, th, memory=args.memory)
+                            results.append(result)
+                            if 'error' in result:
+                                continue
+                            print('{symbol:7s} {backend:8s} N={npart:<7d} frames={nframes:<6d} '
+                                  'setup={setup_time:.3f}s compute={compute_time:.3f}s '
+                                  'throughput={throughput:.3g}/s'.format(**result))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    with open(args.output, 'w') as fh:
+        json.dump({'metadata': _metadata(), 'results': results}, fh, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
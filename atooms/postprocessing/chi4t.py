@@ -76,6 +76,19 @@ class Chi4SelfOverlap(Correlation):
             self.variance.value.append(A2_av)
         self.average.grid, self.variance.grid = self.grid, self.grid
 
+    def _results(self):
+        results = super(Chi4SelfOverlap, self)._results()
+        results['average'] = self.average.value
+        results['variance'] = self.variance.value
+        return results
+
+    def _set_results(self, results):
+        super(Chi4SelfOverlap, self)._set_results(results)
+        self.average.tag, self.variance.tag = self.tag, self.tag
+        self.average.value = results['average']
+        self.variance.value = results['variance']
+        self.average.grid, self.variance.grid = self.grid, self.grid
+
     def write(self):
         # We subclass this to also write down qsu and qsu2
         super(Chi4SelfOverlap, self).write()
@@ -14,7 +14,13 @@ except ImportError:
 
 # Global variables
 pp_output_path = '{trajectory.filename}.pp.{symbol}.{tag}'
+pp_output_format = 'txt'
 pp_trajectory_format = None
+pp_float_dtype = None
+pp_phasespace_cache = False
+pp_nworkers = 1
+pp_error_blocks = 0
+pp_cache_path = '{trajectory.filename}.pp.cache'
 
 # Help formatter
 os.environ['COLUMNS'] = "100"
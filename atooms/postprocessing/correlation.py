@@ -4,12 +4,16 @@
 """Base correlation function."""
 
 import os
+import math
+import copy
+import pickle
+import hashlib
 import logging
+from functools import partial
 from collections import defaultdict
 
 import numpy
 from atooms.trajectory import Trajectory
-from atooms.trajectory.decorators import Unfolded
 from atooms.trajectory.decorators import change_species
 from atooms.system.particle import distinct_species
 from atooms.core.utils import Timer
@@ -19,10 +23,15 @@ except ImportError:
     from .helpers import _dump
 
 from . import core
-from .helpers import adjust_skip
+from .helpers import adjust_skip, filter_species
+from .phasespace import Store, Cache, SpeciesCodes, Unfolder, trajectory_key, callback_key
+from .filter import ParticleArrays
+from .parallel import map_frames
+from .accumulator import BlockAverage
 from .progress import progress
 
-__all__ = ['acf', 'gcf', 'gcf_offset', 'Correlation']
+__all__ = ['acf', 'gcf', 'gcf_offset', 'gcf_offset_batch', 'acf_fft', 'msd_fft',
+           'gcf_fft', 'use_fft', 'gcf_multiple_tau', 'Correlation']
 
 _log = logging.getLogger(__name__)
 #pp_output_path = '{trajectory.filename}.pp.{symbol}.{tag}'
@@ -117,6 +126,263 @@ def gcf_offset(f, grid, skip, t, x, mask=None):
         return dt, [cf[ti] / sum([cnt[ti] for ti in dt])]
 
 
+def _stack(x):
+    """Return `x` as a single array if possible, otherwise as a list"""
+    if isinstance(x, numpy.ndarray):
+        return x
+    if len(set(numpy.shape(xi) for xi in x)) == 1:
+        return numpy.array(x)
+    return x
+
+
+def _add_blocks(blocks, keys, inverse, value, origins, nframes):
+    """
+    Add the `value` at each time origin to the `blocks` accumulator,
+    labelled by `keys[inverse]`.
+    """
+    nblocks = blocks.nblocks
+    index = inverse * nblocks + numpy.minimum(nblocks - 1, origins * nblocks // nframes)
+    size = len(keys) * nblocks
+    sums = numpy.bincount(index, weights=value, minlength=size).reshape(len(keys), nblocks)
+    counts = numpy.bincount(index, minlength=size).reshape(len(keys), nblocks)
+    for k, key in enumerate(keys.tolist()):
+        for block in numpy.nonzero(counts[k])[0]:
+            blocks.add(key, block, sums[k, block], counts[k, block])
+
+
+def gcf_offset_batch(f, grid, skip, t, x, chunk_mb=64.0, blocks=None):
+    """
+    Generalized correlation function, batched over time origins.
+
+    Same as `gcf_offset()`, but `f` is a vectorized kernel: it takes
+    two arrays of shape (norigins, ...) holding `x` at times t(i0+i)
+    and t(i0) for a batch of time origins i0, and returns an array of
+    shape (norigins, ) with the value of the correlation for each
+    origin.
+
+    All the time origins of a given lag i are processed at once using
+    strided views of `x`. To limit the memory footprint of the
+    kernel, origins are split in chunks of at most `chunk_mb` Mb.
+    If `x` is a list of arrays with different shapes, the kernel is
+    called on batches of a single origin.
+
+    If `blocks` is a `BlockAverage` instance, the values at each time
+    origin are also accumulated in it, using time differences as
+    keys, to estimate statistical errors.
+
+    Exemple: mean square displacement.
+
+        def msd(x, y):
+            return numpy.sum((x - y)**2, axis=(1, 2)) / x.shape[1]
+    """
+    cf = defaultdict(float)
+    cnt = defaultdict(int)
+    t = numpy.asarray(t)
+    x = _stack(x)
+    nframes = len(x)
+    for off, i in progress(grid, total=len(grid)):
+        origins = numpy.arange(off, nframes - i, skip)
+        if len(origins) == 0:
+            continue
+        if isinstance(x, numpy.ndarray):
+            size = max(1, int(chunk_mb * 1024**2 / max(1, x[0].nbytes)))
+            value = numpy.empty(len(origins))
+            for start in range(0, len(origins), size):
+                n = min(size, len(origins) - start)
+                first = origins[start]
+                value[start: start + n] = f(x[first + i: first + i + n * skip: skip],
+                                            x[first: first + n * skip: skip])
+        else:
+            value = numpy.array([f(x[i0 + i][numpy.newaxis], x[i0][numpy.newaxis])[0]
+                                 for i0 in origins])
+
+        # Accumulate by actual time difference
+        dt, inverse = numpy.unique(t[origins + i] - t[origins], return_inverse=True)
+        if blocks is not None:
+            _add_blocks(blocks, dt, inverse, value, origins, nframes)
+        value = numpy.bincount(inverse, weights=value)
+        count = numpy.bincount(inverse)
+        for dti, vi, ni in zip(dt.tolist(), value, count):
+            cf[dti] += vi
+            cnt[dti] += ni
+
+    # Return the ACF with the time differences sorted
+    dt = sorted(cf.keys())
+    return dt, [cf[ti] / cnt[ti] for ti in dt]
+
+
+def _fft_sum(x, chunk_mb):
+    """
+    Return sum_i0 x[i0+m] . x[i0] for all lags m, where `x` is a 2d
+    array whose columns are correlated independently and then summed.
+    """
+    nframes = x.shape[0]
+    # Zero padding avoids the periodic images of the signal
+    nfft = 2**int(math.ceil(math.log(2 * nframes, 2)))
+    size = max(1, int(chunk_mb * 1024**2 / (nfft * 16)))
+    acf = numpy.zeros(nframes)
+    for j in range(0, x.shape[1], size):
+        fx = numpy.fft.rfft(x[:, j: j + size], n=nfft, axis=0)
+        power = fx.real**2 + fx.imag**2
+        acf += numpy.fft.irfft(power, n=nfft, axis=0)[:nframes].sum(axis=1)
+    return acf
+
+
+def acf_fft(x, chunk_mb=64.0):
+    """
+    Autocorrelation function computed with the Wiener-Khinchin
+    theorem using all time origins.
+
+    Return an array whose entry m is the average over time origins
+    i0 of x[i0+m] . x[i0], where the dot product runs over the
+    trailing dimensions of `x` and is divided by `x.shape[1]` (number
+    of particles). The time frames must be equally spaced.
+    """
+    x = numpy.asarray(x, dtype=float)
+    nframes = x.shape[0]
+    acf = _fft_sum(x.reshape(nframes, -1), chunk_mb)
+    return acf / (nframes - numpy.arange(nframes)) / float(x.shape[1])
+
+
+def msd_fft(x, chunk_mb=64.0):
+    """
+    Mean square displacement computed with FFT using all time origins.
+
+    Return an array whose entry m is the average over time origins
+    i0 of |x[i0+m] - x[i0]|^2, divided by `x.shape[1]` (number of
+    particles). The time frames must be equally spaced.
+    """
+    x = numpy.asarray(x, dtype=float)
+    nframes, npart = x.shape[0], x.shape[1]
+    x = x.reshape(nframes, -1)
+    # The displacements do not depend on the average positions,
+    # subtracting them reduces round-off errors
+    x = x - x.mean(axis=0)
+    lags = numpy.arange(nframes)
+    # Square displacements decompose as x[i0+m]^2 + x[i0]^2 - 2 x[i0+m] . x[i0]
+    d = numpy.sum(x**2, axis=1)
+    s1 = 2 * d.sum() - numpy.concatenate([[0.0], numpy.cumsum(d)[:-1] + numpy.cumsum(d[::-1])[:-1]])
+    s2 = _fft_sum(x, chunk_mb)
+    return (s1 - 2 * s2) / (nframes - lags) / float(npart)
+
+
+def use_fft(algorithm, grid, skip, steps, block_size, errors=False):
+    """
+    Return True if time correlations on the (offset, lag) `grid`
+    should be computed with FFT.
+
+    `algorithm` can be 'direct', 'fft' or 'auto'. FFT requires
+    equally spaced frames (`block_size` equal to 1) and uses all
+    time origins. With 'auto', FFT is chosen if its cost is lower
+    than the one of the direct calculation over the `grid` with time
+    origins spaced by `skip`, which is the case for dense time grids.
+
+    FFT does not provide the values at each time origin, hence no
+    error estimates: if `errors` is True, 'auto' never chooses FFT.
+    """
+    if algorithm == 'direct':
+        return False
+    if algorithm not in ['fft', 'auto']:
+        raise ValueError('unknown algorithm {}'.format(algorithm))
+    nframes = len(steps)
+    linear = block_size == 1 and nframes > 1 and \
+        numpy.all(numpy.diff(steps) == steps[1] - steps[0])
+    if algorithm == 'fft':
+        if not linear:
+            raise ValueError('FFT requires equally spaced frames')
+        return True
+    if not linear or errors:
+        return False
+    # Rough number of operations per particle and dimension
+    cost_direct = sum([len(range(off, nframes - i, skip)) for off, i in grid])
+    cost_fft = 5 * nframes * math.log(2 * nframes, 2)
+    return cost_fft < cost_direct
+
+
+def gcf_fft(f, grid, t, x):
+    """
+    Evaluate the correlation function `f` (e.g. `msd_fft`) of the
+    equally spaced data `x` for all lags and return it on the (0, lag)
+    `grid`, with the time differences sorted as in `gcf_offset()`.
+    """
+    value = f(x)
+    cf = {}
+    for off, i in grid:
+        cf[t[off + i] - t[off]] = value[i]
+    dt = sorted(cf.keys())
+    return dt, [cf[ti] for ti in dt]
+
+
+def gcf_multiple_tau(f, t, x, block_size=1, p=16, m=2,
+                     compression='discard', tmax=None, blocks=None):
+    """
+    Generalized correlation function computed with a multiple-tau
+    correlator.
+
+    The data `x` are coarse-grained hierarchically by a factor `m` at
+    each level. At the first level, the correlation is computed for
+    lags between 0 and `p`-1, at the following levels for lags
+    between `p`/`m` and `p`-1, in units of the coarse-grained time
+    interval. All the time origins of each level are used. The time
+    differences are thus log-spaced and the cost scales as T log T.
+
+    Coarse-graining is done according to `compression`:
+
+    - 'discard': keep one frame every `m`, which is exact for any
+    kernel `f`, e.g. mean square displacement or self overlap
+    - 'average': average `m` consecutive frames, which improves the
+    statistics of linear correlators, e.g. autocorrelation functions
+
+    The frames must be equally spaced in time. If `block_size` is
+    larger than one, the trajectory is stored in logarithmic blocks:
+    the lags within a block are computed from all the block-start
+    frames and the correlator is applied to the block-start frames.
+
+    The kernel `f` is vectorized as in `gcf_offset_batch()`. Only
+    time differences up to `tmax` are computed, if `tmax` is not None.
+    The optional `blocks` accumulator is passed to `gcf_offset_batch()`.
+    """
+    if compression not in ['discard', 'average']:
+        raise ValueError('unknown compression {}'.format(compression))
+    if p % m != 0:
+        raise ValueError('p must be a multiple of m')
+    t = numpy.asarray(t)
+    x = _stack(x)
+    cf = {}
+    if block_size > 1:
+        grid = [(0, i) for i in range(1, block_size)]
+        cf.update(zip(*gcf_offset_batch(f, grid, block_size, t, x, blocks=blocks)))
+        t, x = t[::block_size], x[::block_size]
+    if len(t) > 2 and numpy.any(numpy.diff(t) != t[1] - t[0]):
+        raise ValueError('multiple-tau correlator requires equally spaced frames')
+    if compression == 'average' and not isinstance(x, numpy.ndarray):
+        raise ValueError('cannot average frames with different number of particles')
+
+    level = 0
+    while len(x) > 1:
+        first = 0 if level == 0 else p // m
+        grid = [(0, i) for i in range(first, min(p, len(x)))]
+        if len(grid) == 0:
+            break
+        for dt, value in zip(*gcf_offset_batch(f, grid, 1, t, x, blocks=blocks)):
+            # Keep the finest estimate of each time difference
+            if dt not in cf:
+                cf[dt] = value
+        if tmax is not None and t[grid[-1][1]] - t[0] >= tmax:
+            break
+        # Coarse grain the data for the next level
+        if compression == 'discard':
+            t, x = t[::m], x[::m]
+        else:
+            n = len(x) // m
+            t = t[:n * m: m]
+            x = x[:n * m].reshape((n, m) + x.shape[1:]).mean(axis=1)
+        level += 1
+
+    dt = sorted([ti for ti in cf if tmax is None or ti <= tmax])
+    return dt, [cf[ti] for ti in dt]
+
+
 def _subtract_mean(weight):
     mean = 0
     for current_field in weight:
@@ -127,6 +393,29 @@ def _subtract_mean(weight):
     return weight
 
 
+def _parameter_key(x):
+    """
+    Return a string identifying the parameter `x` passed to a
+    correlation function.
+
+    Unlike repr(), the string contains all the elements of numpy
+    arrays. Callables are identified as in `callback_key()` and
+    trajectories as in `trajectory_key()`.
+    """
+    if isinstance(x, numpy.ndarray):
+        return '{}{}'.format(x.dtype, repr(x.tolist()))
+    if isinstance(x, (list, tuple)):
+        return '[{}]'.format(', '.join(_parameter_key(xi) for xi in x))
+    if isinstance(x, dict):
+        return '{{{}}}'.format(', '.join('{!r}: {}'.format(key, _parameter_key(x[key]))
+                                        for key in sorted(x, key=str)))
+    if hasattr(x, 'steps') and hasattr(x, 'read'):
+        return str(trajectory_key(x))
+    if callable(x) and not isinstance(x, type):
+        return callback_key(x)
+    return repr(x)
+
+
 class Correlation(object):
     """
     Base class for correlation functions.
@@ -160,9 +449,9 @@ class Correlation(object):
     convention is used: if a correlation function A depends on
     variables x and y, then `symbol = 'A(x,y)'`.
 
-    The `phasespace` variable allow subclasses to access a list of 2d
-    numpy arrays with particles coordinates via the following private
-    variables:
+    The `phasespace` variable allow subclasses to access numpy arrays
+    of shape (nframes, N, ndim) with particles coordinates via the
+    following private variables:
 
     - if `nbodies` is 1: `self._pos` for positions, `self._vel` for
     velocities, `self._unf_pos` for PBC-unfolded positions
@@ -170,6 +459,38 @@ class Correlation(object):
     - if `nbodies` is 2, an additional suffix that take values 0 or 1
     is added to distinguish the two sets of particles,
     e.g. `self._pos_0` and `self._pos_1`
+
+    If the number of particles changes across frames, these variables
+    are lists of 2d numpy arrays instead. Floating point arrays are
+    stored using the data type `dtype`, which defaults to
+    `core.pp_float_dtype`. If the latter is None, the data type of the
+    trajectory is used. The sides of the cell at each frame are stored
+    in `self._cell_side`.
+
+    Subclasses may restrict the frames read from the trajectory by
+    overriding `_required_frames()`. Frames that are not read are
+    zeroed in the arrays above.
+
+    If `nworkers` is larger than 1 (default is `core.pp_nworkers`),
+    frames are read in parallel by `nworkers` processes.
+
+    If `error_blocks` is larger than 1 (default is
+    `core.pp_error_blocks`), correlation functions that support it
+    estimate the statistical error on `value` by block averaging over
+    `error_blocks` portions of the trajectory and store it in
+    `self.error`, which is then written as an additional column.
+
+    If `phasespace_cache` is True (default is `core.pp_phasespace_cache`),
+    the arrays are stored in a persistent cache on disk, in a
+    directory defined by `core.pp_cache_path`, and loaded back as
+    memory-mapped arrays when the same trajectory is analyzed again
+    with the same filters.
+
+    When calling `do(update=True)`, results are stored in the same
+    directory, in a cache keyed by a fingerprint of the trajectory,
+    the class, the arguments passed upon construction, the filters,
+    the weights and the package version. Correlation functions are
+    only computed if their fingerprint is not found in the cache.
     """
 
     nbodies = 1
@@ -195,6 +516,18 @@ class Correlation(object):
     indicates which variables should be read from the trajectory file.
     They will be available as self._pos, self._pos_unf, self._vel.
     """
+    _species_resolved = False
+    """
+    Subclasses that implement `_compute_species()` set this to `True`.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        # Store the arguments passed upon construction to fingerprint
+        # the results, see `_fingerprint()`
+        self = super(Correlation, cls).__new__(cls)
+        self._args = args
+        self._kwargs = kwargs
+        return self
 
     def __init__(self, trj, grid, output_path=None, norigins=None, fix_cm=False):
         # Accept a trajectory-like instance or a path to a trajectory
@@ -203,7 +536,6 @@ class Correlation(object):
         else:
             self.trajectory = trj
         self._fix_cm = fix_cm
-        self._unfolded = None
         self.grid = grid
         self.value = []
         self.analysis = {}
@@ -211,6 +543,12 @@ class Correlation(object):
         self.tag = ''
         self.tag_description = 'the whole system'
         self.output_path = output_path if output_path is not None else core.pp_output_path
+        self.output_format = core.pp_output_format
+        self.dtype = core.pp_float_dtype
+        self.phasespace_cache = core.pp_phasespace_cache
+        self.nworkers = core.pp_nworkers
+        self.error_blocks = core.pp_error_blocks
+        self.error = None
         self.skip = adjust_skip(self.trajectory, norigins)
 
         # Callbacks
@@ -230,6 +568,23 @@ class Correlation(object):
         self._ids_0, self._ids_1 = [], []
         self._pos_unf_0, self._pos_unf_1 = [], []
 
+        # Cell sides
+        self._cell_side = []
+
+        # Frames actually read from the trajectory (None means all)
+        self._frames = None
+
+        # If this is a list of species, `compute()` computes the
+        # partial correlation functions of all the species pairs with
+        # `_compute_species()` and stores them in `_partial_results`
+        self._partial_species = None
+        self._partial_results = None
+
+        # This is set to True when the arrays above have been filled
+        # from outside, e.g. by a `Pipeline`, and need not be dumped
+        # again
+        self._phasespace_ready = False
+
         # Weights
         self._weight = None
         self._weight_0, self._weight_1 = None, None
@@ -297,18 +652,94 @@ class Correlation(object):
         self._cbk_kwargs.append(kwargs)
 
     def need_update(self):
-        """Check if the trajectory file is newer than the output file"""
-        need = True
-        if os.path.exists(self._output_file) and self._output_file != '/dev/stdout':
-            if os.path.getmtime(self.trajectory.filename) < \
-               os.path.getmtime(self._output_file):
-                need = False
-        return need
+        """
+        Check if the results must be computed, i.e. if they are not
+        found in the cache of results.
+        """
+        path = self._results_file()
+        return path is None or not os.path.exists(path)
+
+    def _fingerprint(self):
+        """
+        Return a hash identifying the results of the correlation
+        function or None if the trajectory is not associated to a
+        file.
+        """
+        key = trajectory_key(self.trajectory)
+        if key is None:
+            return None
+        # The trajectory is the first argument
+        args = getattr(self, '_args', ())[1:]
+        kwargs = dict(getattr(self, '_kwargs', {}))
+        kwargs.pop('trj', None)
+        kwargs.pop('trajectory', None)
+        key += '{}.{}'.format(self.__class__.__module__, self.__class__.__name__)
+        key += _parameter_key([args, kwargs, self._fix_cm, self.skip,
+                               self.dtype, self.error_blocks, core.__version__])
+        for cbk, args, kwargs in zip(self._cbk, self._cbk_args, self._cbk_kwargs):
+            key += callback_key(cbk, args, kwargs)
+        if self._weight is not None:
+            key += _parameter_key([self._weight_field, self._weight_fluctuations,
+                                   self._weight_trajectory])
+        return hashlib.md5(key.encode()).hexdigest()
+
+    def _results_file(self):
+        """Return the path of the cached results or None"""
+        key = self._fingerprint()
+        if key is None:
+            return None
+        path = core.pp_cache_path.format(trajectory=self.trajectory)
+        return os.path.join(path, 'results', key + '.pkl')
+
+    def _results(self):
+        """Return a dictionary of the results to cache"""
+        return {'grid': self.grid, 'value': self.value, 'error': self.error}
+
+    def _set_results(self, results):
+        """Set the results from the dictionary `results`"""
+        self.grid = results['grid']
+        self.value = results['value']
+        self.error = results['error']
+
+    def _read_cache(self):
+        """Read the results from the cache"""
+        path = self._results_file()
+        _log.info('reading results from cache %s', path)
+        with open(path, 'rb') as fh:
+            self._set_results(pickle.load(fh))
+
+    def _write_cache(self):
+        """Store the results in the cache, if possible"""
+        path = self._results_file()
+        if path is None:
+            return
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # Write to a temporary file first, so that concurrent
+            # readers never see partial results
+            with open(path + '.tmp', 'wb') as fh:
+                pickle.dump(self._results(), fh, protocol=2)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            _log.warning('could not cache results in %s (%s)', path, e)
+
+    def _required_frames(self):
+        """
+        Return the sorted list of frames needed by `_compute()` or None
+        if all the frames are needed.
+
+        Unfolded positions are always computed from all the frames.
+        """
+        return None
 
-    def _setup_arrays(self):
+    def _setup_arrays(self, frames=None):
         """
         Dump positions and/or velocities at different time frames as a
         list of numpy array.
+
+        If `frames` is None, only the frames returned by
+        `_required_frames()` are read.
         """
         # TODO: what happens if we call compute twice?? Shouldnt we reset the arrays?
         # Ensure phasespace is a list.
@@ -317,14 +748,90 @@ class Correlation(object):
            not isinstance(self.phasespace, tuple):
             self.phasespace = [self.phasespace]
 
-        # Setup arrays        
+        # Setup arrays, possibly from the cache
+        if not self._phasespace_ready:
+            self._frames = frames if frames is not None else self._required_frames()
+            if self._frames is not None and len(self._frames) == len(self.trajectory):
+                self._frames = None
+            cache = self._cache()
+            if cache is None or not self._load_cache(cache):
+                if self.nbodies == 1:
+                    self._setup_arrays_onebody()
+                elif self.nbodies == 2:
+                    self._setup_arrays_twobody()
+                if cache is not None:
+                    cache.save({name: getattr(self, name) for name in self._phasespace_arrays()})
+
+        # Setup weights
         if self.nbodies == 1:
-            self._setup_arrays_onebody()
             self._setup_weight_onebody()
         elif self.nbodies == 2:
-            self._setup_arrays_twobody()
             self._setup_weight_twobody()
 
+    def _phasespace_arrays(self):
+        """
+        Return the names of the private arrays dumped for the
+        current phasespace and filters.
+        """
+        if self.nbodies == 2 and len(self._cbk) > 1:
+            suffixes = ['_0', '_1']
+        else:
+            suffixes = ['']
+        names = ['_cell_side']
+        for variable in self.phasespace:
+            names += ['_' + variable.replace('-', '_') + suffix for suffix in suffixes]
+        return names
+
+    def _cache(self):
+        """
+        Return the cache of phase space arrays for the current
+        trajectory and filters or None if caching is disabled or not
+        possible.
+        """
+        if not self.phasespace_cache:
+            return None
+        key = trajectory_key(self.trajectory)
+        if key is None:
+            return None
+        if self.nbodies == 2 and len(self._cbk) > 1:
+            nfilters = 2
+        else:
+            nfilters = 1
+        key += str(self._fix_cm) + str(self.dtype) + str(self._frames)
+        for cbk, args, kwargs in list(zip(self._cbk, self._cbk_args, self._cbk_kwargs))[:nfilters]:
+            key += callback_key(cbk, args, kwargs)
+        path = core.pp_cache_path.format(trajectory=self.trajectory)
+        return Cache(os.path.join(path, 'phasespace', hashlib.md5(key.encode()).hexdigest()))
+
+    def _load_cache(self, cache):
+        """Load the phase space arrays from `cache`. Return True on success."""
+        arrays = cache.load(self._phasespace_arrays())
+        if arrays is None:
+            return False
+        for name in arrays:
+            setattr(self, name, arrays[name])
+        if self.nbodies == 2 and len(self._cbk) <= 1:
+            self._alias_arrays_twobody()
+        return True
+
+    def _alias_arrays_twobody(self):
+        """Use the one-body arrays for both sets of particles"""
+        self._pos_0 = self._pos
+        self._pos_1 = self._pos
+        self._vel_0 = self._vel
+        self._vel_1 = self._vel
+        self._ids_0 = self._ids
+        self._ids_1 = self._ids
+
+    def _iter_frames(self, all_frames=False):
+        """
+        Iterate over the frames to read as (frame, system) pairs. If
+        `all_frames` is True, all the frames are read.
+        """
+        if self._frames is None or all_frames:
+            return progress(enumerate(self.trajectory), total=len(self.trajectory))
+        return progress(((i, self.trajectory[i]) for i in self._frames), total=len(self._frames))
+
     def _setup_arrays_onebody(self):
         """
         Setup list of numpy arrays for one-body correlations.
@@ -332,31 +839,58 @@ class Correlation(object):
         We also take care of dumping the weight if needed, see
         `add_weight()`.
         """
-        if 'pos' in self.phasespace or 'vel' in self.phasespace or 'ids' in self.phasespace:
-            ids = distinct_species(self.trajectory[0].particle)
-            for s in progress(self.trajectory):
-                # Apply filter if there is one
-                if len(self._cbk) > 0:
-                    s = self._cbk[0](s, *self._cbk_args[0], **self._cbk_kwargs[0])
-                if 'pos' in self.phasespace:
-                    self._pos.append(s.dump('pos'))
-                if 'vel' in self.phasespace:
-                    self._vel.append(s.dump('vel'))
-                if 'ids' in self.phasespace:
-                    _ids = s.dump('species')
-                    _ids = numpy.array([ids.index(_) for _ in _ids], dtype=numpy.int32)
-                    self._ids.append(_ids)
-                    
-        # Dump unfolded positions if requested
-        if 'pos-unf' in self.phasespace:
-            if self._unfolded is None:
-                self._unfolded = Unfolded(self.trajectory, fixed_cm=self._fix_cm)
-            for s in progress(self._unfolded):
-                # Apply filter if there is one
-                if len(self._cbk) > 0:
-                    s = self._cbk[0](s, *self._cbk_args[0], **self._cbk_kwargs[0])
-                self._pos_unf.append(s.dump('pos'))
-                
+        if self.nworkers > 1:
+            self._setup_arrays_parallel(nfilters=1, fix_cm=self._fix_cm)
+        else:
+            self._setup_arrays_serial(nfilters=1, fix_cm=self._fix_cm)
+
+    def _setup_arrays_serial(self, nfilters, fix_cm):
+        """
+        Setup the arrays by reading the frames serially.
+
+        Unfolded positions are obtained on the fly from the folded
+        positions of all the particles, see `Unfolder`. Filters are
+        then applied to the unfolded positions, as `Unfolded` would
+        do.
+        """
+        unfolded = 'pos-unf' in self.phasespace
+        variables = [v for v in ['pos', 'vel', 'ids'] if v in self.phasespace]
+        if len(variables) == 0 and not unfolded:
+            self._cell_side = []
+            return
+
+        nframes = len(self.trajectory)
+        nsets = nfilters if len(self._cbk) > 0 else 1
+        stores = {}
+        for variable in variables + (['pos-unf'] if unfolded else []):
+            for i in range(nsets):
+                stores[(variable, i)] = Store(nframes, self.dtype)
+        _side = Store(nframes)
+
+        species = SpeciesCodes(distinct_species(self.trajectory[0].particle))
+        unfolder = self._unfolder(fix_cm) if unfolded else None
+        # Unfolded positions are always computed from all the frames
+        for frame, s in self._iter_frames(all_frames=unfolded):
+            _side.append(s.cell.side, frame)
+            data = self._dump_system(s, nfilters, variables, species, unfolder)
+            for key in data:
+                stores[key].append(data[key], frame)
+        self._set_arrays(stores, nfilters)
+        self._cell_side = _side.finalize()
+
+    def _set_arrays(self, stores, nfilters):
+        """Set the arrays from the dictionary of `stores` with keys (variable, i)"""
+        suffixes = [''] if nfilters == 1 else ['_0', '_1']
+        for (variable, i), store in stores.items():
+            setattr(self, '_' + variable.replace('-', '_') + suffixes[i], store.finalize())
+
+    def _unfolder(self, fix_cm):
+        """Return an `Unfolder` for the positions of all the particles"""
+        mass = None
+        if fix_cm:
+            mass = self.trajectory[0].dump('particle.mass')
+        return Unfolder(fix_cm, mass)
+
     def _setup_weight_onebody(self):
         """
         Setup list of numpy arrays for the weight, see `add_weight()`
@@ -365,6 +899,7 @@ class Correlation(object):
             return
 
         # Dump arrays of weights
+        _weight = Store(len(self.trajectory), self.dtype)
         for s in progress(self.trajectory):
             # Apply filter if there is one
             # TODO: fix when weight trajectory does not contain actual particle info
@@ -373,7 +908,8 @@ class Correlation(object):
             if len(self._cbk) > 0:
                 s = self._cbk[0](s, *self._cbk_args[0], **self._cbk_kwargs[0])                
             current_weight = s.dump('particle.%s' % self._weight_field)
-            self._weight.append(current_weight)
+            _weight.append(current_weight)
+        self._weight = _weight.finalize()
 
         # Subtract global mean
         if self._weight_fluctuations:
@@ -398,13 +934,16 @@ class Correlation(object):
             return
 
         # Dump arrays of weights
+        _weight_0 = Store(len(self.trajectory), self.dtype)
+        _weight_1 = Store(len(self.trajectory), self.dtype)
         for s in progress(self.trajectory):
             # Apply filters
             if len(self._cbk) == 2:
                 s0 = self._cbk[0](s, *self._cbk_args[0], **self._cbk_kwargs[0])
                 s1 = self._cbk[1](s, *self._cbk_args[1], **self._cbk_kwargs[1])
-            self._weight_0.append(s0.dump('particle.%s' % self._weight_field))
-            self._weight_1.append(s1.dump('particle.%s' % self._weight_field))
+            _weight_0.append(s0.dump('particle.%s' % self._weight_field))
+            _weight_1.append(s1.dump('particle.%s' % self._weight_field))
+        self._weight_0, self._weight_1 = _weight_0.finalize(), _weight_1.finalize()
 
         # Subtract global mean
         if self._weight_fluctuations:
@@ -415,40 +954,194 @@ class Correlation(object):
         """Setup list of numpy arrays for two-body correlations."""
         if len(self._cbk) <= 1:
             self._setup_arrays_onebody()
-            self._pos_0 = self._pos
-            self._pos_1 = self._pos
-            self._vel_0 = self._vel
-            self._vel_1 = self._vel
-            self._ids_0 = self._ids
-            self._ids_1 = self._ids
+            self._alias_arrays_twobody()
             return
 
-        if 'pos' in self.phasespace or 'vel' in self.phasespace or 'ids' in self.phasespace:
-            ids = distinct_species(self.trajectory[0].particle)
-            for s in progress(self.trajectory):
-                s0 = self._cbk[0](s, *self._cbk_args[0], **self._cbk_kwargs[0])
-                s1 = self._cbk[1](s, *self._cbk_args[1], **self._cbk_kwargs[1])
-                if 'pos' in self.phasespace:
-                    self._pos_0.append(s0.dump('pos'))
-                    self._pos_1.append(s1.dump('pos'))
-                if 'vel' in self.phasespace:
-                    self._vel_0.append(s0.dump('vel'))
-                    self._vel_1.append(s1.dump('vel'))
-                if 'ids' in self.phasespace:
-                    _ids_0 = s0.dump('species')
-                    _ids_1 = s1.dump('species')
-                    _ids_0 = numpy.array([ids.index(_) for _ in _ids_0], dtype=numpy.int32)
-                    _ids_1 = numpy.array([ids.index(_) for _ in _ids_1], dtype=numpy.int32)
-                    self._ids_0.append(_ids_0)
-                    self._ids_1.append(_ids_1)
-                    
-        # Dump unfolded positions if requested
+        if self.nworkers > 1:
+            self._setup_arrays_parallel(nfilters=2, fix_cm=self._fix_cm)
+        else:
+            self._setup_arrays_serial(nfilters=2, fix_cm=self._fix_cm)
+
+    def _fixed_particles(self):
+        """
+        Return True if the phase space arrays hold the same particles,
+        in the same order, at all frames.
+
+        This holds if the number of particles is fixed and particles
+        are only filtered by species. Neighbor lists may then be
+        reused across frames, see `neighbors.VerletList`.
+        """
+        if self.trajectory.grandcanonical:
+            return False
+        return all(cbk is filter_species for cbk in self._cbk)
+
+    def _block_average(self):
+        """Return an accumulator for error estimates or None if errors are not requested"""
+        if self.error_blocks > 1:
+            return BlockAverage(self.error_blocks)
+        return None
+
+    def _set_error(self, blocks, scale=1.0):
+        """Store in `self.error` the errors accumulated in `blocks` on the grid"""
+        if blocks is not None and len(blocks.keys()) > 0:
+            self.error = [blocks.error(x) * scale for x in self.grid]
+
+    def _filtered(self, s, nfilters):
+        """Return the systems obtained by applying the first `nfilters` filters to `s`"""
+        if len(self._cbk) == 0:
+            return [s]
+        return [self._cbk[i](s, *self._cbk_args[i], **self._cbk_kwargs[i])
+                for i in range(nfilters)]
+
+    def _masks(self, arrays, nfilters):
+        """
+        Return the masks of the particles selected by the first
+        `nfilters` filters, given the `ParticleArrays` of the system,
+        or None if some filter does not provide a vectorized `mask`,
+        see `filter.ParticleArrays`. A mask is None if all particles
+        are selected.
+        """
+        if len(self._cbk) == 0:
+            return [None]
+        filters = list(zip(self._cbk, self._cbk_args, self._cbk_kwargs))[:nfilters]
+        for cbk, _, _ in filters:
+            if not hasattr(cbk, 'mask'):
+                return None
+        masks = []
+        for cbk, args, kwargs in filters:
+            mask = cbk.mask(arrays, *args, **kwargs)
+            if mask is not None:
+                mask = numpy.broadcast_to(numpy.asarray(mask, dtype=bool), (len(arrays), ))
+            masks.append(mask)
+        return masks
+
+    def _dump_system(self, s, nfilters, variables, species=None, unfolder=None):
+        """
+        Return a dictionary of the phase space `variables` of `s` after
+        applying the first `nfilters` filters. Keys are (variable, i),
+        where i is the index of the filter.
+
+        If possible, the arrays of all the particles are dumped once
+        and filtered with boolean masks, see `_masks()`. Species are
+        dumped as integer codes with `species`, a `SpeciesCodes`
+        instance. If `unfolder` is given, the positions of `s` are
+        appended to it and the unfolded positions are dumped as well
+        as `pos-unf`.
+        """
+        def dump(system, variable):
+            if variable == 'ids':
+                return species(system.dump('species'))
+            return system.dump(variable)
+
+        data = {}
+        arrays = ParticleArrays(s)
+        masks = self._masks(arrays, nfilters)
+        if masks is None:
+            for i, si in enumerate(self._filtered(s, nfilters)):
+                for variable in variables:
+                    data[(variable, i)] = dump(si, variable)
+        else:
+            for variable in variables:
+                x = species(arrays['species']) if variable == 'ids' else arrays[variable]
+                for i, mask in enumerate(masks):
+                    data[(variable, i)] = x if mask is None else x[mask]
+
+        if unfolder is not None:
+            pos_unf = unfolder.append(arrays['position'], s.cell.side)
+            for i, x in enumerate(self._dump_unfolded(s, arrays, pos_unf, nfilters)):
+                data[('pos-unf', i)] = x
+        return data
+
+    def _dump_unfolded(self, s, arrays, pos_unf, nfilters):
+        """
+        Return the unfolded positions `pos_unf` of the particles of `s`
+        selected by each filter. `arrays` are the `ParticleArrays` of
+        `s`.
+        """
+        masks = self._masks(arrays.with_position(pos_unf), nfilters)
+        if masks is not None:
+            return [pos_unf if mask is None else pos_unf[mask] for mask in masks]
+        # Copy the system, as Unfolded does, not to alter cached systems
+        s = copy.deepcopy(s)
+        for i, p in enumerate(s.particle):
+            p.position = pos_unf[i].copy()
+        return [si.dump('pos') for si in self._filtered(s, nfilters)]
+
+    def _dump_frame(self, trajectory, frame, nfilters, species):
+        """
+        Dump the phase space variables of `frame`, for each filter.
+
+        If unfolded positions are requested, we also dump the folded
+        positions of all the particles.
+        """
+        s = trajectory.read(frame)
+        data = {'side': numpy.array(s.cell.side)}
         if 'pos-unf' in self.phasespace:
-            for s in progress(Unfolded(self.trajectory)):
-                s0 = self._cbk[0](s, *self._cbk_args[0], **self._cbk_kwargs[0])
-                s1 = self._cbk[1](s, *self._cbk_args[1], **self._cbk_kwargs[1])
-                self._pos_unf_0.append(s0.dump('pos'))
-                self._pos_unf_1.append(s1.dump('pos'))
+            data['pos-all'] = s.dump('pos')
+        variables = [v for v in ['pos', 'vel', 'ids'] if v in self.phasespace]
+        data.update(self._dump_system(s, nfilters, variables, species))
+        return data
+
+    def _dump_frame_unfolded(self, trajectory, frame, nfilters, pos_unf):
+        """Dump the unfolded positions of `frame`, for each filter"""
+        s = trajectory.read(frame)
+        return self._dump_unfolded(s, ParticleArrays(s), pos_unf[frame], nfilters)
+
+    def _setup_arrays_parallel(self, nfilters, fix_cm):
+        """
+        Setup the arrays by reading frames in parallel with
+        `nworkers` processes.
+
+        Unfolded positions are obtained in two steps: the workers
+        dump the folded positions of all the particles, which are
+        then unfolded here, see `Unfolder`. If there are filters, the
+        workers then apply them on the unfolded positions, as
+        `Unfolded` would do.
+        """
+        nframes = len(self.trajectory)
+        unfolded = 'pos-unf' in self.phasespace
+        if self._frames is None or unfolded:
+            frames = range(nframes)
+        else:
+            frames = self._frames
+        nsets = nfilters if len(self._cbk) > 0 else 1
+        variables = [v for v in ['pos', 'vel', 'ids'] if v in self.phasespace]
+        stores = {}
+        for variable in variables:
+            for i in range(nsets):
+                stores[(variable, i)] = Store(nframes, self.dtype)
+        _side = Store(nframes)
+        _pos_all = Store(nframes)
+
+        species = SpeciesCodes(distinct_species(self.trajectory[0].particle))
+        func = partial(self._dump_frame, nfilters=nfilters, species=species)
+        for frame, data in zip(frames, map_frames(func, self.trajectory, frames, self.nworkers)):
+            _side.append(data['side'], frame)
+            if unfolded:
+                _pos_all.append(data['pos-all'], frame)
+            for key in stores:
+                stores[key].append(data[key], frame)
+
+        self._set_arrays(stores, nfilters)
+        self._cell_side = _side.finalize()
+        if not unfolded:
+            return
+
+        pos_all = _pos_all.finalize()
+        if isinstance(pos_all, list):
+            raise ValueError('cannot unfold positions when the number of particles changes')
+        pos_unf = self._unfolder(fix_cm).append(pos_all, self._cell_side)
+        del pos_all
+        if len(self._cbk) == 0:
+            self._pos_unf = pos_unf if self.dtype is None else pos_unf.astype(self.dtype)
+            return
+
+        stores = {('pos-unf', i): Store(nframes, self.dtype) for i in range(nsets)}
+        func = partial(self._dump_frame_unfolded, nfilters=nfilters, pos_unf=pos_unf)
+        for data in map_frames(func, self.trajectory, range(nframes), self.nworkers):
+            for i in range(nsets):
+                stores[('pos-unf', i)].append(data[i])
+        self._set_arrays(stores, nfilters)
 
     def compute(self):
         """
@@ -469,7 +1162,13 @@ class Correlation(object):
                   len(range(0, len(self.trajectory), self.skip)),
                   len(self.trajectory))
         t[1].start()
-        self._compute()
+        self.error = None
+        if self._partial_species is None:
+            self._compute()
+            if self.error_blocks > 1 and self.error is None:
+                _log.warning('%s does not estimate errors with this algorithm', self.long_name)
+        else:
+            self._partial_results = self._compute_species(self._partial_species)
         t[1].stop()
 
         _log.info('output file %s', self._output_file)
@@ -486,6 +1185,30 @@ class Correlation(object):
         """Subclasses must implement this"""
         pass
 
+    def _compute_species(self, species):
+        """
+        Subclasses may implement this to compute the partial
+        correlation functions of all the pairs of `species` in a single
+        pass over the unfiltered arrays `_pos` and `_ids`.
+
+        Return a dictionary of results, see `_results()`, for each
+        species pair (isp, jsp).
+        """
+        raise NotImplementedError()
+
+    def _species_index(self, species):
+        """
+        Return an array mapping the species ids in `_ids` to the
+        position of the corresponding species in the list `species`,
+        or to -1 if the species is not in the list.
+        """
+        distinct = distinct_species(self.trajectory[0].particle)
+        index = -numpy.ones(len(distinct), dtype=int)
+        for i, isp in enumerate(species):
+            if isp in distinct:
+                index[distinct.index(isp)] = i
+        return index
+
     def analyze(self):
         """
         Subclasses may implement this and store the results in the
@@ -515,16 +1238,56 @@ class Correlation(object):
         return filename
 
     def read(self):
-        """Read correlation function from existing file"""
+        """
+        Read correlation function from existing file.
+
+        The file format is detected from the content of the file.
+        """
+        with open(self._output_file, 'rb') as inp:
+            magic = inp.read(4)
+        if magic.startswith(b'PK'):
+            self._read_npz()
+        elif magic == b'\x89HDF':
+            self._read_hdf5()
+        else:
+            self._read_txt()
+
+    def _read_txt(self):
         with open(self._output_file, 'r') as inp:
-            x = numpy.loadtxt(inp, unpack=True)
-            if len(x) == 3:
-                _log.warn("cannot read 3-columns files yet in %s", self._output_file)
-            elif len(x) == 2:
-                self.grid, self.value = x
-            else:
-                self.grid, self.value = x[0: 2]
-                _log.warn("Ignoring some columns in %s", self._output_file)
+            x = numpy.loadtxt(inp, unpack=True, ndmin=2)
+        if len(self.grid_name) == 2 and len(x) >= 3:
+            # The first grid variable is repeated for each entry of
+            # the second one, see write()
+            n = int(numpy.sum(x[0] == x[0][0]))
+            self.grid = [x[0][::n], x[1][:n]]
+            self.value = x[2].reshape(-1, n)
+            if len(x) == 4:
+                self.error = x[3].reshape(-1, n)
+        elif len(x) == 3:
+            self.grid, self.value, self.error = x
+        elif len(x) == 2:
+            self.grid, self.value = x
+        else:
+            self.grid, self.value = x[0: 2]
+            _log.warn("Ignoring some columns in %s", self._output_file)
+
+    def _read_arrays(self, data):
+        if 'grid' in data:
+            self.grid = numpy.array(data['grid'])
+        else:
+            self.grid = [numpy.array(data['grid_0']), numpy.array(data['grid_1'])]
+        self.value = numpy.array(data['value'])
+        if 'error' in data:
+            self.error = numpy.array(data['error'])
+
+    def _read_npz(self):
+        with numpy.load(self._output_file) as data:
+            self._read_arrays(data)
+
+    def _read_hdf5(self):
+        import h5py
+        with h5py.File(self._output_file, 'r') as data:
+            self._read_arrays(data)
 
     @property
     def grid_name(self):
@@ -554,6 +1317,13 @@ class Correlation(object):
 
         The default is defined by core.pp_output_path, which currently
         looks like '{trajectory.filename}.pp.{symbol}.{tag}'
+
+        The file format is set by the `output_format` instance variable
+        (default is core.pp_output_format):
+
+        - txt: columns of plain text with metadata as comments
+        - npz: compressed numpy archive with metadata as strings
+        - hdf5: HDF5 file with metadata as attributes (requires h5py)
         """
         def is_iterable(maybe_iterable):
             try:
@@ -564,12 +1334,16 @@ class Correlation(object):
                 return True
 
         # Pack grid and value into arrays to dump
+        arrays = {'value': numpy.array(self.value)}
         if is_iterable(self.grid[0]) and len(self.grid) == 2:
-            x = numpy.array(self.grid[0]).repeat(len(self.value[0]))
-            y = numpy.array(self.grid[1] * len(self.grid[0]))
-            z = numpy.array(self.value).flatten()
+            arrays['grid_0'] = numpy.array(self.grid[0])
+            arrays['grid_1'] = numpy.array(self.grid[1])
+            x = arrays['grid_0'].repeat(len(arrays['grid_1']))
+            y = numpy.tile(arrays['grid_1'], len(arrays['grid_0']))
+            z = arrays['value'].flatten()
             dump = numpy.transpose(numpy.array([x, y, z]))
         else:
+            arrays['grid'] = numpy.array(self.grid)
             dump = numpy.transpose(numpy.array([self.grid, self.value]))
 
         # Comment line
@@ -577,6 +1351,10 @@ class Correlation(object):
         variables = self.short_name.split('(')[1][:-1]
         variables = variables.split(',')
         columns = variables + [self.short_name]  #[self.symbol]
+        if self.error is not None:
+            arrays['error'] = numpy.array(self.error)
+            dump = numpy.column_stack([dump, arrays['error'].flatten()])
+            columns += ['error']
         if len(self.tag_description) > 0:
             conj = 'of'
         else:
@@ -601,23 +1379,49 @@ class Correlation(object):
         import os
         from atooms.core.utils import mkdir
         mkdir(os.path.dirname(self._output_file))
-        with open(self._output_file, 'w') as fh:
-            fh.write(comments)
-            if len(analysis) > 0:
-                fh.write(analysis)
-            numpy.savetxt(fh, dump, fmt="%g")
-            fh.flush()
+        if self.output_format == 'txt' or self._output_file == '/dev/stdout':
+            with open(self._output_file, 'w') as fh:
+                fh.write(comments)
+                if len(analysis) > 0:
+                    fh.write(analysis)
+                numpy.savetxt(fh, dump, fmt="%g")
+                fh.flush()
+            return
+
+        # Binary formats: store metadata as key, value pairs
+        metadata = []
+        for line in (comments + analysis).splitlines():
+            key, _, value = line.lstrip('# ').partition(': ')
+            metadata.append((key, value))
+        if self.output_format == 'npz':
+            for key, value in metadata:
+                arrays['metadata: ' + key] = numpy.array(value)
+            with open(self._output_file, 'wb') as fh:
+                numpy.savez_compressed(fh, **arrays)
+        elif self.output_format == 'hdf5':
+            import h5py
+            with h5py.File(self._output_file, 'w') as fh:
+                for key in arrays:
+                    fh.create_dataset(key, data=arrays[key])
+                for key, value in metadata:
+                    fh.attrs[key] = value
+        else:
+            raise ValueError('unknown output format {}'.format(self.output_format))
 
     def do(self, update=False):
         """
         Do the full template pattern: compute, analyze and write the
         correlation function.
+
+        If `update` is True, the results are read from the cache of
+        results, if found, and stored in it otherwise.
         """
         if update and not self.need_update():
-            self.read()
-            return
-
-        self.compute()
+            self._read_cache()
+        else:
+            self.compute()
+            if update:
+                self._write_cache()
 
         try:
             self.analyze()
@@ -11,26 +11,163 @@ For 2-body correlations we expect up to two logical conditions. If
 there is only one, we filter only the first group of particle, the
 second one includes all the particles of the system. Otherwise we
 filter two subsets of particles accordingly.
+
+Conditions are compiled once into vectorized numpy expressions, which
+are evaluated on the arrays of particle properties of each frame, see
+`ParticleArrays`. Logical operators `and`, `or` and `not` act element
+wise, e.g. `species == 'A' and x > 0`.
+
+Filters that define a `mask` attribute, such as `filter_condition`
+and `filter_species`, are applied by correlation functions directly on
+the dumped arrays. The `mask` function is called with the
+`ParticleArrays` of the unfiltered system and the arguments of the
+filter and returns a boolean array or None to select all particles.
 """
 
+import ast
+import copy
 import logging
 
+import numpy
+
 from .helpers import filter_species
 
-__all__ = ['Filter']
+__all__ = ['Filter', 'ParticleArrays', 'compile_condition', 'filter_condition']
 _log = logging.getLogger(__name__)
 
 
-def Filter(correlation, condition):
+class ParticleArrays(object):
+
+    """
+    Mapping of particle properties of `system` to numpy arrays.
+
+    Arrays are dumped lazily and stored. Besides the attributes of
+    the particles, e.g. `species`, `position` or `radius`, the
+    components of the positions are available as `x`, `y` and `z`.
+    Positions and velocities can also be accessed as `pos` and `vel`.
+    """
+
+    _aliases = {'pos': 'position', 'vel': 'velocity'}
+    _components = {'x': 0, 'y': 1, 'z': 2}
+
+    def __init__(self, system):
+        self.system = system
+        self._data = {}
+
+    def __len__(self):
+        return len(self.system.particle)
+
+    def with_position(self, position):
+        """
+        Return the arrays of the same particles at `position`, e.g.
+        their unfolded positions. Other stored arrays are shared.
+        """
+        other = ParticleArrays(self.system)
+        for name in self._data:
+            if name != 'position' and name not in self._components:
+                other._data[name] = self._data[name]
+        other._data['position'] = position
+        return other
+
+    def __getitem__(self, name):
+        name = self._aliases.get(name, name)
+        if name not in self._data:
+            if name in self._components:
+                self._data[name] = self['position'][:, self._components[name]]
+            elif len(self.system.particle) > 0 and \
+                 not hasattr(self.system.particle[0], name):
+                raise KeyError(name)
+            else:
+                self._data[name] = self.system.dump('particle.' + name)
+        return self._data[name]
+
+
+def _numpy_call(name, *args):
+    """Return the ast node of a call to `numpy.name` with `args`"""
+    func = ast.Attribute(value=ast.Name(id='numpy', ctx=ast.Load()), attr=name, ctx=ast.Load())
+    return ast.Call(func=func, args=list(args), keywords=[])
+
+
+class _Vectorize(ast.NodeTransformer):
+
+    """Replace logical operators with element-wise ones"""
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        name = 'logical_and' if isinstance(node.op, ast.And) else 'logical_or'
+        result = node.values[0]
+        for value in node.values[1:]:
+            result = _numpy_call(name, result, value)
+        return ast.copy_location(result, node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(_numpy_call('logical_not', node.operand), node)
+        return node
 
-    def _filter_generic(system, condition):
-        import copy
-        s = copy.copy(system)
-        s.particle = []
-        for particle in system.particle:
-            if eval(condition, particle.__dict__):
-                s.particle.append(particle)
-        return s
+    def visit_Compare(self, node):
+        # Chained comparisons, e.g. 0 < x < 1, are split
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        left, result = node.left, None
+        for op, right in zip(node.ops, node.comparators):
+            compare = ast.Compare(left=left, ops=[op], comparators=[right])
+            result = compare if result is None else _numpy_call('logical_and', result, compare)
+            left = right
+        return ast.copy_location(result, node)
+
+
+_compiled = {}
+
+
+def compile_condition(condition):
+    """
+    Return the code object of the vectorized version of `condition`.
+
+    Compiled conditions are stored, so this is done once per
+    condition.
+    """
+    if condition not in _compiled:
+        tree = ast.parse(condition.strip(), mode='eval')
+        tree = ast.fix_missing_locations(_Vectorize().visit(tree))
+        _compiled[condition] = compile(tree, '<condition>', 'eval')
+    return _compiled[condition]
+
+
+def mask_condition(arrays, condition):
+    """Return the boolean mask of the particles in `arrays` satisfying `condition`"""
+    try:
+        mask = eval(compile_condition(condition), {'numpy': numpy}, arrays)
+    except NameError as e:
+        raise ValueError('unknown particle property in condition {} ({})'.format(condition, e))
+    mask = numpy.asarray(mask, dtype=bool)
+    return numpy.broadcast_to(mask, (len(arrays), ))
+
+
+def filter_condition(system, condition):
+    """Callback to filter particles satisfying `condition`"""
+    mask = mask_condition(ParticleArrays(system), condition)
+    s = copy.copy(system)
+    s.particle = [system.particle[i] for i in numpy.nonzero(mask)[0]]
+    return s
+
+filter_condition.mask = mask_condition
+
+
+def _mask_all(arrays):
+    return None
+
+
+def filter_all(system):
+    """Callback that selects all particles"""
+    return system
+
+filter_all.mask = _mask_all
+
+
+def Filter(correlation, condition):
 
     tag = condition.replace(' ', '')
     tag = tag.replace('and', '_')
@@ -44,7 +181,7 @@ def Filter(correlation, condition):
     correlation.tag_description = condition
 
     if correlation.nbodies == 1:
-        correlation.add_filter(_filter_generic, condition)
+        correlation.add_filter(filter_condition, condition)
 
     elif correlation.nbodies == 2:
         # We expect up to two logical conditions
@@ -54,13 +191,13 @@ def Filter(correlation, condition):
         # particles, the second one includes all the particles of the
         # system, hence the identity function
         if len(conditions) == 1:
-            correlation.add_filter(_filter_generic, conditions[0])
-            correlation.add_filter(lambda x: x)
+            correlation.add_filter(filter_condition, conditions[0])
+            correlation.add_filter(filter_all)
         elif len(conditions) == 2:
             # If there are two, we filter two subsets of particles
             # accordingly
-            correlation.add_filter(_filter_generic, conditions[0])
-            correlation.add_filter(_filter_generic, conditions[1])
+            correlation.add_filter(filter_condition, conditions[0])
+            correlation.add_filter(filter_condition, conditions[1])
         else:
             raise ValueError('too many conditions for a 2 body-correlation function')
 
@@ -11,9 +11,9 @@ from atooms.trajectory.utils import check_block_size
 
 from . import core
 from atooms.trajectory import Trajectory
-from .helpers import logx_grid, setup_t_grid
+from .helpers import logx_grid, setup_t_grid, required_frames
 from .correlation import Correlation
-from .fourierspace import FourierSpaceCorrelation, expo_sphere
+from .fourierspace import FourierSpaceCorrelation, expo_sphere, rho_species
 from .progress import progress
 
 __all__ = ['SelfIntermediateScattering',
@@ -78,6 +78,18 @@ class IntermediateScatteringBase(FourierSpaceCorrelation):
         # make sure no additional time origins except the first frame is used
         self._discrete_tgrid = setup_t_grid(self.trajectory, self.grid[1], offset=norigins != '1' and norigins != 1)
 
+    def _required_frames(self):
+        return required_frames(len(self.trajectory), self.skip, self._discrete_tgrid)
+
+    def _set_error_kt(self, blocks, times):
+        """
+        Store in `self.error` the errors accumulated in `blocks` for
+        each wave vector index and time difference in `times`.
+        """
+        if blocks is not None and len(blocks.keys()) > 0:
+            self.error = [[blocks.error((kk, ti)) for ti in times]
+                          for kk in range(len(self.grid[0]))]
+
 
 class SelfIntermediateScatteringLegacy(IntermediateScatteringBase):
     """
@@ -113,7 +125,7 @@ class SelfIntermediateScatteringLegacy(IntermediateScatteringBase):
 
     def _compute(self):
         # Throw everything into a big numpy array (nframes, npos, ndim)
-        pos = numpy.array(self._pos)
+        pos = numpy.asarray(self._pos)
         ndims = len(self.k0)
         # To optimize without wasting too much memory (we have
         # troubles here) we group particles in blocks and tabulate the
@@ -130,6 +142,7 @@ class SelfIntermediateScatteringLegacy(IntermediateScatteringBase):
         kmax = max(self.kvector.keys()) + self.dk
         acf = [defaultdict(float) for _ in self.kgrid]
         cnt = [defaultdict(float) for _ in self.kgrid]
+        blocks = self._block_average()
         skip = self.skip
         origins = range(0, pos.shape[1], block)
         for j in progress(origins):
@@ -143,29 +156,35 @@ class SelfIntermediateScatteringLegacy(IntermediateScatteringBase):
                             dt = self.trajectory.steps[i0+i] - self.trajectory.steps[i0]
                             # Dimensional switch
                             if ndims == 3:
-                                acf[kk][dt] += numpy.sum(x[i0+i, :, 0, ik[0]]*x[i0, :, 0, ik[0]].conjugate() *
-                                                         x[i0+i, :, 1, ik[1]]*x[i0, :, 1, ik[1]].conjugate() *
-                                                         x[i0+i, :, 2, ik[2]]*x[i0, :, 2, ik[2]].conjugate()).real
+                                value = numpy.sum(x[i0+i, :, 0, ik[0]]*x[i0, :, 0, ik[0]].conjugate() *
+                                                  x[i0+i, :, 1, ik[1]]*x[i0, :, 1, ik[1]].conjugate() *
+                                                  x[i0+i, :, 2, ik[2]]*x[i0, :, 2, ik[2]].conjugate()).real
                             elif ndims == 2:
-                                acf[kk][dt] += numpy.sum(x[i0+i, :, 0, ik[0]]*x[i0, :, 0, ik[0]].conjugate() *
-                                                         x[i0+i, :, 1, ik[1]]*x[i0, :, 1, ik[1]].conjugate()).real
+                                value = numpy.sum(x[i0+i, :, 0, ik[0]]*x[i0, :, 0, ik[0]].conjugate() *
+                                                  x[i0+i, :, 1, ik[1]]*x[i0, :, 1, ik[1]].conjugate()).real
 
                             else:
                                 # Arbitrary dimension (a bit slower)
                                 tmp = x[i0+i, :, 0, ik[0]]*x[i0, :, 0, ik[0]].conjugate()
                                 for idim in range(1, len(ik)):
                                     tmp *= x[i0+i, :, idim, ik[idim]]*x[i0, :, idim, ik[idim]].conjugate()
-                                acf[kk][dt] += numpy.sum(tmp).real                            
+                                value = numpy.sum(tmp).real
+                            acf[kk][dt] += value
                             cnt[kk][dt] += x.shape[1]
+                            if blocks is not None:
+                                blocks.add((kk, dt), blocks.block(i0, x.shape[0]), value, x.shape[1])
 
         tgrid = sorted(acf[0].keys())
         self.grid[0] = self.kgrid
         self.grid[1] = [ti*self.trajectory.timestep for ti in tgrid]
         self.value = [[acf[kk][ti] / cnt[kk][ti] for ti in tgrid] for kk in range(len(self.grid[0]))]
+        self._set_error_kt(blocks, tgrid)
 
         # Normalize
         if self.normalize:
             for k in range(len(self.grid[0])):
+                if self.error is not None:
+                    self.error[k] = [e / self.value[k][0] for e in self.error[k]]
                 for i in range(len(self.value[k])):
                     self.value[k][i] /= self.value[k][0]
 
@@ -194,7 +213,7 @@ class SelfIntermediateScatteringFast(SelfIntermediateScatteringLegacy):
             raise
 
         # Throw everything into a big numpy array (nframes, npos, ndim)
-        pos = numpy.array(self._pos)
+        pos = numpy.asarray(self._pos)
 
         # Select the f90 kernel
         ndims = len(self.k0)
@@ -225,6 +244,7 @@ class SelfIntermediateScatteringFast(SelfIntermediateScatteringLegacy):
             raise ValueError('could not find any wave-vectors, try increasing dk')
         acf = [defaultdict(float) for _ in self.kgrid]
         cnt = [defaultdict(float) for _ in self.kgrid]
+        blocks = self._block_average()
         skip = self.skip
         origins = range(0, pos.shape[1], block)
         for j in progress(origins):
@@ -241,14 +261,20 @@ class SelfIntermediateScatteringFast(SelfIntermediateScatteringLegacy):
                             res = fskt_kernel(xf, i0+1, i0+1+i, numpy.array(ik, dtype=numpy.int32)+1)
                             acf[kk][dt] += res.real
                             cnt[kk][dt] += x.shape[1]
+                            if blocks is not None:
+                                blocks.add((kk, dt), blocks.block(i0, x.shape[0]),
+                                           res.real, x.shape[1])
                             
         tgrid = sorted(acf[0].keys())
         self.grid[0] = self.kgrid
         self.grid[1] = [ti*self.trajectory.timestep for ti in tgrid]
         self.value = [[acf[kk][ti] / cnt[kk][ti] for ti in tgrid] for kk in range(len(self.grid[0]))]
+        self._set_error_kt(blocks, tgrid)
         # Normalize
         if self.normalize:
             for k in range(len(self.grid[0])):
+                if self.error is not None:
+                    self.error[k] = [e / self.value[k][0] for e in self.error[k]]
                 for i in range(len(self.value[k])):
                     self.value[k][i] /= self.value[k][0]
 
@@ -269,6 +295,7 @@ class IntermediateScattering(IntermediateScatteringBase):
     short_name = 'F(k,t)'
     long_name = 'intermediate scattering function'
     phasespace = 'pos'
+    _species_resolved = True
 
     def __init__(self, trajectory, kgrid=None, tgrid=None, nk=100, dk=0.1, tsamples=60,
                  kmin=1.0, kmax=10.0, ksamples=10, norigins=-1, fix_cm=False, normalize=True):
@@ -288,7 +315,8 @@ class IntermediateScattering(IntermediateScatteringBase):
         kmax = max(self.kvector.keys()) + self.dk
         rho_0 = [defaultdict(complex) for it in range(nsteps)]
         rho_1 = [defaultdict(complex) for it in range(nsteps)]
-        for it in range(nsteps):
+        frames = range(nsteps) if self._frames is None else self._frames
+        for it in frames:
             expo_0 = expo_sphere(self.k0, kmax, self._pos_0[it])
             # Optimize a bit here: if there is only one filter (alpha-alpha or total calculation)
             # expo_2 will be just a reference to expo_1
@@ -339,6 +367,7 @@ class IntermediateScattering(IntermediateScatteringBase):
         # Compute correlation function
         acf = [defaultdict(float) for _ in kgrid]
         cnt = [defaultdict(float) for _ in kgrid]
+        blocks = self._block_average()
         skip = self.skip
         for kk, knorm in enumerate(progress(kgrid)):
             for j in selection[kk]:
@@ -348,8 +377,11 @@ class IntermediateScattering(IntermediateScatteringBase):
                         # Get the actual time difference
                         # TODO: It looks like the order of i0 and ik lopps should be swapped
                         dt = self.trajectory.steps[i0+i] - self.trajectory.steps[i0]
-                        acf[kk][dt] += (rho_0[i0+i][ik] * rho_1[i0][ik].conjugate()).real #/ self._pos[i0].shape[0]
+                        value = (rho_0[i0+i][ik] * rho_1[i0][ik].conjugate()).real
+                        acf[kk][dt] += value #/ self._pos[i0].shape[0]
                         cnt[kk][dt] += 1
+                        if blocks is not None:
+                            blocks.add((kk, dt), blocks.block(i0, len(rho_0)), value)
 
         # Normalization
         times = sorted(acf[0].keys())
@@ -365,13 +397,67 @@ class IntermediateScattering(IntermediateScatteringBase):
         # First normalize by cnt (time counts), then by value at t=0
         # We do not need to normalize by the average number of particles
         self.value_nonorm = [[acf[kk][ti] / (cnt[kk][ti]) for ti in times] for kk in range(len(self.grid[0]))]
+        self._set_error_kt(blocks, times)
 
         # Normalize
         if self.normalize:
             self.value = [[v / self.value_nonorm[kk][0] for v in self.value_nonorm[kk]] for kk in range(len(self.grid[0]))]
+            if self.error is not None:
+                self.error = [[e / self.value_nonorm[kk][0] for e in self.error[kk]] for kk in range(len(self.grid[0]))]
         else:
             self.value = self.value_nonorm
 
+    def _compute_species(self, species):
+        nsteps = len(self._pos)
+        nsp = len(species)
+        index = self._species_index(species)
+        kgrid, selection = self.kgrid, self.selection
+        if len(self.kvector.keys()) == 0:
+            raise ValueError('could not find any wave-vectors, try increasing dk')
+        kmax = max(self.kvector.keys()) + self.dk
+
+        # Tabulate the densities of all species, see _tabulate_rho()
+        ikvec = [[self.kvector[knorm][i] for i in selection[kk]]
+                 for kk, knorm in enumerate(kgrid)]
+        rho = [None for it in range(nsteps)]
+        frames = range(nsteps) if self._frames is None else self._frames
+        for it in frames:
+            expo = expo_sphere(self.k0, kmax, self._pos[it])
+            ids = index[self._ids[it]]
+            rho[it] = [rho_species(expo, ids, nsp, ikvec[kk]) for kk in range(len(kgrid))]
+
+        # Compute correlation functions of all species pairs
+        acf = [defaultdict(float) for _ in kgrid]
+        cnt = [defaultdict(float) for _ in kgrid]
+        blocks = self._block_average()
+        skip = self.skip
+        for kk in progress(range(len(kgrid))):
+            for off, i in self._discrete_tgrid:
+                for i0 in range(off, nsteps-i, skip):
+                    dt = self.trajectory.steps[i0+i] - self.trajectory.steps[i0]
+                    value = numpy.dot(rho[i0+i][kk], rho[i0][kk].conjugate().transpose()).real
+                    acf[kk][dt] += value
+                    cnt[kk][dt] += len(ikvec[kk])
+                    if blocks is not None:
+                        blocks.add((kk, dt), blocks.block(i0, nsteps), value, len(ikvec[kk]))
+
+        # Normalization, see _compute()
+        times = sorted(acf[0].keys())
+        grid = [kgrid, [ti*self.trajectory.timestep for ti in times]]
+        results = {}
+        for a, isp in enumerate(species):
+            for b, jsp in enumerate(species):
+                value = [[acf[kk][ti][a, b] / cnt[kk][ti] for ti in times] for kk in range(len(kgrid))]
+                error = None
+                if blocks is not None:
+                    error = [[blocks.error((kk, ti))[a, b] for ti in times] for kk in range(len(kgrid))]
+                if self.normalize:
+                    if error is not None:
+                        error = [[e / value[kk][0] for e in error[kk]] for kk in range(len(kgrid))]
+                    value = [[v / value[kk][0] for v in value[kk]] for kk in range(len(kgrid))]
+                results[(isp, jsp)] = {'grid': grid, 'value': value, 'error': error}
+        return results
+
     def analyze(self):
         self.analysis['relaxation times tau'] = _extract_tau(self.grid[0], self.grid[1], self.value)
 
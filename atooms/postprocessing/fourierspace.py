@@ -13,7 +13,7 @@ import numpy
 from .helpers import linear_grid
 from .correlation import Correlation
 
-__all__ = ['expo_sphere', 'expo_sphere_safe', 'FourierSpaceCorrelation']
+__all__ = ['expo_sphere', 'expo_sphere_safe', 'rho_species', 'FourierSpaceCorrelation']
 
 _log = logging.getLogger(__name__)
 
@@ -52,6 +52,24 @@ def expo_sphere(k0, kmax, pos):
     return expo
 
 
+def rho_species(expo, species, nsp, ikvec):
+    """
+    Return the Fourier components of the density of each species.
+
+    `expo` are the exponentials of the positions of a single sample
+    as returned by `expo_sphere()`, `species` is an array of species
+    indices between 0 and nsp-1 (particles with negative indices are
+    ignored) and `ikvec` is an integer array of shape (nvec, ndim)
+    of wave-vector indices. The returned array has shape (nsp, nvec).
+    """
+    ikvec = numpy.asarray(ikvec)
+    tmp = expo[:, 0, ikvec[:, 0]]
+    for idim in range(1, ikvec.shape[1]):
+        tmp = tmp * expo[:, idim, ikvec[:, idim]]
+    onehot = numpy.asarray(species)[numpy.newaxis, :] == numpy.arange(nsp)[:, numpy.newaxis]
+    return numpy.dot(onehot.astype(float), tmp)
+
+
 def expo_sphere_safe(k0, kmax, pos):
     """
     Returns the exponentials of the input positions for each k.
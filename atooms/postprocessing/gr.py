@@ -8,13 +8,15 @@ import logging
 
 import numpy
 
-from .helpers import linear_grid
+from .helpers import linear_grid, required_frames
+from .linkedcells import cells_per_side, cell_index, stencil, neighbor_cells
 from .correlation import Correlation
 from .progress import progress
 
 __all__ = ['RadialDistributionFunction',
            'RadialDistributionFunctionLegacy',
-           'RadialDistributionFunctionFast']
+           'RadialDistributionFunctionFast',
+           'RadialDistributionFunctionNumpy']
 
 _log = logging.getLogger(__name__)
 
@@ -24,7 +26,7 @@ def gr_kernel(x, y, L, *args):
     # r is an array of array distances
     r = x-y
     r = r - numpy.rint(r/L) * L
-    return numpy.sqrt(numpy.sum(r**2, axis=1))
+    return numpy.sqrt(numpy.sum(r**2, axis=-1))
 
 
 def gr_kernel_square(x, y, L, *args):
@@ -32,7 +34,27 @@ def gr_kernel_square(x, y, L, *args):
     # r is an array of array distances
     r = x-y
     r = r - numpy.rint(r/L) * L
-    return numpy.sum(r**2, axis=1)
+    return numpy.sum(r**2, axis=-1)
+
+def gr_kernel_components(x, y, L, *args):
+    """
+    Return distances as `gr_kernel()`, looping over the components
+    of the positions. Operations are done in place, which is much
+    faster on large blocks of pairs.
+    """
+    r2 = None
+    for k in range(x.shape[-1]):
+        dr = x[..., k] - y[..., k]
+        image = dr / L[k]
+        numpy.rint(image, out=image)
+        image *= L[k]
+        dr -= image
+        dr *= dr
+        if r2 is None:
+            r2 = dr
+        else:
+            r2 += dr
+    return numpy.sqrt(r2, out=r2)
 
 def pairs_newton_hist(f, x, y, L, bins):
     """
@@ -53,6 +75,199 @@ def pairs_newton_hist(f, x, y, L, bins):
     return hist
 
 
+def pairs_species_hist(f, x, species, nsp, L, bins):
+    """
+    Apply function f to all pairs i<j in x and histogram the results
+    separately for each pair of species.
+
+    `species` is an array of species indices between 0 and nsp-1,
+    particles with negative indices are ignored. Return an array of
+    shape (nsp, nsp, len(bins)-1), whose entry (a, b) counts pairs
+    such that particle i is of species a and particle j of species
+    b.
+    """
+    nbins = len(bins) - 1
+    hist = numpy.zeros(nsp * nsp * nbins, dtype=numpy.int64)
+    npart = len(x)
+    # Pairs are processed in chunks of rows of about 10^6 pairs each
+    size = max(1, int(1e6 / max(1, npart)))
+    for start in range(0, npart - 1, size):
+        rows = numpy.arange(start, min(start + size, npart - 1))
+        cols = numpy.arange(start + 1, npart)
+        i, j = numpy.nonzero(cols[numpy.newaxis, :] > rows[:, numpy.newaxis])
+        i, j = rows[i], cols[j]
+        fxy = f(x[j], x[i], L)
+        where = numpy.searchsorted(bins, fxy, side='right') - 1
+        # As in numpy.histogram, the last bin includes its right edge
+        where[fxy == bins[-1]] = nbins - 1
+        mask = (where >= 0) & (where < nbins) & (species[i] >= 0) & (species[j] >= 0)
+        code = (species[i][mask] * nsp + species[j][mask]) * nbins + where[mask]
+        hist += numpy.bincount(code, minlength=len(hist))
+    return hist.reshape(nsp, nsp, nbins)
+
+
+def bin_index(r, bins):
+    """
+    Return the indices of the histogram `bins` in which the values `r`
+    fall, or -1 for values outside the bins.
+
+    As in numpy.histogram, the last bin includes its right edge. The
+    bins are found arithmetically if they are uniform, else by
+    bisection.
+    """
+    nbins = len(bins) - 1
+    delta = (bins[-1] - bins[0]) / nbins
+    if numpy.allclose(numpy.diff(bins), delta):
+        where = numpy.floor((r - bins[0]) / delta).astype(numpy.int64)
+        # Fix round off at the bin edges
+        where[(where > 0) & (r < bins[numpy.clip(where, 0, nbins)])] -= 1
+        where[(where < nbins - 1) & (r >= bins[numpy.clip(where + 1, 0, nbins)])] += 1
+    else:
+        where = numpy.searchsorted(bins, r, side='right') - 1
+    where[r == bins[-1]] = nbins - 1
+    where[(where < 0) | (where >= nbins)] = -1
+    return where
+
+
+def _cell_table(cell, ncells):
+    """
+    Return a (ncells, max_occupancy) table of the indices of the
+    particles in each cell, padded with -1.
+
+    Particles are sorted by cell using a counting sort: the cell
+    occupancies give the offsets of the cells in the sorted order.
+    """
+    counts = numpy.bincount(cell, minlength=ncells)
+    offsets = numpy.cumsum(counts) - counts
+    order = numpy.argsort(cell, kind='stable')
+    rank = numpy.arange(len(cell)) - offsets[cell[order]]
+    table = numpy.full((ncells, max(1, counts.max())), -1, dtype=numpy.int64)
+    table[cell[order], rank] = order
+    return table
+
+
+def cell_pairs(x, y, side, rcut, size=1000000):
+    """
+    Yield blocks of candidate pairs of particles (i, j) within a
+    distance `rcut`, using cell lists in a periodic cell of sides
+    `side`.
+
+    The pairs are between particles `x[i]` and `y[j]`. If `y` is None,
+    distinct pairs of particles in `x` are yielded once. Each block
+    contains about `size` candidate pairs, including those beyond
+    `rcut`. Particles in each pair of neighboring cells are paired
+    through (ncells, max_occupancy) tables of particle indices, see
+    `_cell_table()`.
+    """
+    ncell = cells_per_side(side, rcut)
+    ncells = ncell.prod()
+    # The half stencil needs at least 3 cells per side, see stencil()
+    half = y is None and numpy.all(ncell >= 3)
+    offsets = stencil(ncell, half=half)
+    neighbors = neighbor_cells(ncell, offsets)
+    table_x = _cell_table(cell_index(x, side, ncell), ncells)
+    table_y = table_x if y is None else _cell_table(cell_index(y, side, ncell), ncells)
+    chunk = max(1, size // (table_x.shape[1] * table_y.shape[1]))
+    for k, offset in enumerate(offsets):
+        same = not numpy.any(offset)
+        for start in range(0, ncells, chunk):
+            i = table_x[start: start + chunk, :, numpy.newaxis]
+            j = table_y[neighbors[start: start + chunk, k], numpy.newaxis, :]
+            mask = (i >= 0) & (j >= 0)
+            if y is None and (same or not half):
+                mask &= i < j
+            i, j = numpy.broadcast_arrays(i, j)
+            yield i[mask], j[mask]
+
+
+def pairs_cells_hist(f, x, y, L, bins, species=None, nsp=1, neighbors=None):
+    """
+    Apply function f to the pairs in x[i] and y[j] and histogram the
+    results using the |bins| bin edges.
+
+    If `y` is None, distinct pairs of particles in `x` are counted
+    once. If `neighbors` is given, pairs are taken from the neighbors
+    of each particle, as CSR arrays `(offsets, indices)`, see
+    `linkedcells.LinkedCells`. Otherwise, pairs are searched with cell
+    lists if there are at least 3 cells of side `bins[-1]` along each
+    side, else all pairs are evaluated in blocks. If `species` is not
+    None, pairs are histogrammed separately for each ordered pair of
+    species indices (i, j), as in `pairs_species_hist()`, but the
+    order of particles within a pair is arbitrary. Species are only
+    supported if `y` is None.
+    """
+    nbins = len(bins) - 1
+    hist = numpy.zeros(nsp * nsp * nbins, dtype=numpy.int64)
+    other = x if y is None else y
+    if neighbors is not None:
+        for i, j in _list_pairs(*neighbors):
+            fxy = f(x[i], other[j], L)
+            code = _pairs_code(fxy, bins, species, nsp, i, j)
+            hist += numpy.bincount(code, minlength=len(hist))
+    elif numpy.all(cells_per_side(L, bins[-1]) >= 3):
+        for i, j in cell_pairs(x, y, L, bins[-1]):
+            fxy = f(x[i], other[j], L)
+            code = _pairs_code(fxy, bins, species, nsp, i, j)
+            hist += numpy.bincount(code, minlength=len(hist))
+    else:
+        for i, j, fxy in _all_pairs(f, x, y, L):
+            code = _pairs_code(fxy, bins, species, nsp, i, j)
+            hist += numpy.bincount(code, minlength=len(hist))
+    return hist.reshape(nsp, nsp, nbins)
+
+
+def _list_pairs(offsets, indices, size=1000000):
+    """Yield blocks of about `size` pairs (i, j) from CSR neighbors"""
+    owner = numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+    for start in range(0, len(indices), size):
+        yield owner[start: start + size], indices[start: start + size]
+
+
+def _pairs_code(fxy, bins, species, nsp, i, j):
+    """
+    Return the indices in the flattened (nsp, nsp, nbins) histogram
+    of the values `fxy` of pairs of particles `i` and `j`, dropping
+    values outside the bins.
+    """
+    nbins = len(bins) - 1
+    # Most candidate pairs are typically out of range
+    inside = fxy <= bins[-1]
+    where = bin_index(fxy[inside], bins)
+    if species is None:
+        return where[where >= 0]
+    i, j = i[inside], j[inside]
+    mask = (where >= 0) & (species[i] >= 0) & (species[j] >= 0)
+    return (species[i][mask] * nsp + species[j][mask]) * nbins + where[mask]
+
+
+def _all_pairs(f, x, y, L, size=1000000):
+    """
+    Yield blocks (i, j, fxy) of the values of f for all pairs of
+    particles in x[i] and y[j]. If `y` is None, only distinct pairs
+    i < j in `x` are included.
+
+    The function f is evaluated on blocks of rows of x broadcast
+    against y, which avoids gathering the positions of each pair.
+    """
+    distinct = y is None
+    if distinct:
+        y = x
+    rows = max(1, size // max(1, len(y)))
+    for start in range(0, len(x), rows):
+        stop = min(start + rows, len(x))
+        # With distinct pairs, columns before start+1 are never needed
+        first = start + 1 if distinct else 0
+        fxy = f(x[start: stop, numpy.newaxis, :], y[numpy.newaxis, first:, :], L)
+        i, j = numpy.indices(fxy.shape)
+        i += start
+        j += first
+        if distinct:
+            mask = j > i
+            yield i[mask], j[mask], fxy[mask]
+        else:
+            yield i.ravel(), j.ravel(), fxy.ravel()
+
+
 def pairs_hist(f, x, y, L, bins):
     """
     Apply function f to all pairs in x[i] and y[j] and update the
@@ -87,6 +302,7 @@ class RadialDistributionFunctionLegacy(Correlation):
     short_name = 'g(r)'
     long_name = 'radial distribution function'
     phasespace = 'pos'
+    _species_resolved = True
 
     def __init__(self, trajectory, rgrid=None, norigins=None, dr=0.04, ndim=-1, rmax=-1.0):
         Correlation.__init__(self, trajectory, rgrid, norigins=norigins)
@@ -115,47 +331,138 @@ class RadialDistributionFunctionLegacy(Correlation):
             L = min(self._side)
             self.grid = linear_grid(0.0, L / 2.0, dr)
             
+
+    def _required_frames(self):
+        return required_frames(len(self.trajectory), self.skip)
+
     def _compute(self):
         ncfg = len(self.trajectory)
+        origins = range(0, ncfg, self.skip)
         # Assume grandcanonical trajectory for generality.
         # Note that testing if the trajectory is grandcanonical or
-        # semigrandcanonical is useless when applying filters.  
-        # N_0, N_1 = len(self._pos_0[0]), len(self._pos_1[0])
-        N_0 = numpy.average([len(x) for x in self._pos_0])
-        N_1 = numpy.average([len(x) for x in self._pos_1])
-
-        gr_all = []
+        # semigrandcanonical is useless when applying filters.
+        # Histograms, numbers of particles and volumes are accumulated
+        # over the frames, so that memory does not grow with the
+        # number of origins.
+        N_0, N_1, volume = 0, 0, 0.0
+        nframes = 0
+        blocks = self._block_average()
         _, r = numpy.histogram([], bins=self.grid)
-        origins = range(0, ncfg, self.skip)
+        hist = numpy.zeros(len(r) - 1, dtype=numpy.int64)
         for i in progress(origins):
-            self._side = self.trajectory.read(i).cell.side
+            side = self._cell_side[i]
+            N_0 += len(self._pos_0[i])
+            N_1 += len(self._pos_1[i])
+            volume += side[:self._ndim].prod()
             if len(self._pos_0[i]) == 0 or len(self._pos_1[i]) == 0:
                 continue
             if self._pos_0 is self._pos_1:
-                gr = pairs_newton_hist(gr_kernel, self._pos_0[i], self._pos_1[i],
-                                       self._side, r)
+                gr = self._pairs_hist(self._pos_0[i], None, side, r)
             else:
-                gr = pairs_hist(gr_kernel, self._pos_0[i], self._pos_1[i],
-                                self._side, r)
-            gr_all.append(gr)
+                gr = self._pairs_hist(self._pos_0[i], self._pos_1[i], side, r)
+            hist += gr
+            nframes += 1
+            if blocks is not None:
+                blocks.add(None, blocks.block(i, ncfg), gr)
 
         # Normalization
-        if self._ndim == 2:
-            vol = math.pi * (r[1:]**2 - r[:-1]**2)
-        elif self._ndim == 3:
-            vol = 4 * math.pi / 3.0 * (r[1:]**3 - r[:-1]**3)
-        else:
-            from math import gamma
-            n2 = int(float(self._ndim) / 2)
-            vol = math.pi**n2 * (r[1:]**self._ndim-r[:-1]**self._ndim) / gamma(n2+1)
-        rho = N_1 / self._volume
+        N_0 = N_0 / float(len(origins))
+        N_1 = N_1 / float(len(origins))
+        vol = self._shell_volume(r)
+        rho = N_1 / (volume / len(origins))
         if self._pos_0 is self._pos_1:
             norm = rho * vol * N_0 * 0.5  # use Newton III
         else:
             norm = rho * vol * N_0
-        gr = numpy.average(gr_all, axis=0)
+        gr = hist / float(nframes)
         self.grid = (r[:-1] + r[1:]) / 2.0
         self.value = gr / norm
+        if blocks is not None:
+            self.error = blocks.error() / norm
+
+    def _pairs_hist(self, x, y, side, bins):
+        """
+        Return the histogram of distances between particles at
+        positions `x` and `y`. If `y` is None, distinct pairs of
+        particles in `x` are counted once.
+        """
+        if y is None:
+            return pairs_newton_hist(gr_kernel, x, x, side, bins)
+        else:
+            return pairs_hist(gr_kernel, x, y, side, bins)
+
+    def _species_hist(self, pos, ids, nsp, side, bins):
+        """
+        Return the (nsp, nsp, len(bins)-1) histograms of distances
+        between distinct pairs of particles, see `pairs_species_hist()`
+        """
+        return pairs_species_hist(gr_kernel, pos, ids, nsp, side, bins)
+
+    def _shell_volume(self, r):
+        """Return the volume of the shells between the distances `r`"""
+        if self._ndim == 2:
+            return math.pi * (r[1:]**2 - r[:-1]**2)
+        elif self._ndim == 3:
+            return 4 * math.pi / 3.0 * (r[1:]**3 - r[:-1]**3)
+        else:
+            from math import gamma
+            n2 = int(float(self._ndim) / 2)
+            return math.pi**n2 * (r[1:]**self._ndim-r[:-1]**self._ndim) / gamma(n2+1)
+
+    def _compute_species(self, species):
+        def histogram(pos, ids, side):
+            hist = self._species_hist(pos, ids, len(species), side, bins)
+            # Pairs of distinct species are found in both orders
+            gr = hist + hist.transpose(1, 0, 2)
+            gr[diagonal, diagonal] = hist[diagonal, diagonal]
+            return gr
+
+        bins = numpy.array(self.grid)
+        diagonal = numpy.arange(len(species))
+        return self._compute_species_bins(species, bins, histogram)
+
+    def _compute_species_bins(self, species, bins, histogram):
+        """
+        Compute g(r) for all pairs of `species` in a single pass over
+        the frames, using the histogram `bins`.
+
+        The function `histogram(pos, ids, side)` must return the
+        histograms of distances for each pair of species indices,
+        counting pairs of particles of the same species only once.
+        """
+        ncfg = len(self.trajectory)
+        origins = range(0, ncfg, self.skip)
+        nsp = len(species)
+        index = self._species_index(species)
+        npart = numpy.zeros(nsp)
+        volume = 0.0
+        hist = numpy.zeros((nsp, nsp, len(bins) - 1), dtype=numpy.int64)
+        blocks = self._block_average()
+        for i in progress(origins):
+            ids = index[self._ids[i]]
+            npart += numpy.bincount(ids[ids >= 0], minlength=nsp)
+            volume += self._cell_side[i][:self._ndim].prod()
+            gr = histogram(self._pos[i], ids, self._cell_side[i])
+            hist += gr
+            if blocks is not None:
+                blocks.add(None, blocks.block(i, ncfg), gr)
+
+        # Normalization, see _compute()
+        npart /= len(origins)
+        volume /= len(origins)
+        vol = self._shell_volume(bins)
+        gr = hist / float(len(origins))
+        error = blocks.error() if blocks is not None else None
+        results = {}
+        for a, isp in enumerate(species):
+            for b, jsp in enumerate(species):
+                norm = npart[b] / volume * vol * npart[a]
+                if a == b:
+                    norm *= 0.5
+                results[(isp, jsp)] = {'grid': (bins[:-1] + bins[1:]) / 2.0,
+                                       'value': gr[a, b] / norm,
+                                       'error': None if error is None else error[a, b] / norm}
+        return results
 
 
 class RadialDistributionFunctionFast(RadialDistributionFunctionLegacy):
@@ -174,18 +481,14 @@ class RadialDistributionFunctionFast(RadialDistributionFunctionLegacy):
       the time average
     """
 
-    def _compute(self):
-        from atooms.postprocessing.realspace_wrap import compute
-
-        ncfg = len(self.trajectory)
-        # Assume grandcanonical trajectory for generality.
-        # Note that testing if the trajectory is grandcanonical or
-        # semigrandcanonical is useless when applying filters.  
-        N_0, N_1 = [], []
-        gr_all = []
-        dr = self.grid[1]
-
-        from atooms.postprocessing.linkedcells import LinkedCells
+    def _linked_cells(self, pos, reuse=True):
+        """
+        Return a pair search backend for particles at positions `pos`
+        or None, see `neighbors.pair_search()`. If `reuse` is True and
+        the particles are the same at all frames, return a Verlet list
+        instead, which is reused across frames.
+        """
+        from atooms.postprocessing.neighbors import VerletList, pair_search
 
         # Use linked cells only if it is advantageous
         # - more than 3 cells along each side
@@ -193,71 +496,91 @@ class RadialDistributionFunctionFast(RadialDistributionFunctionLegacy):
         # These tests are done of the first framce
         # TODO: if memory footprint is surpassed skip particles
         if self.rmax > 0.0:
-            npart = len(self._pos_1[0])
             ndims = len(self._side)
-            rho = npart / self._side.prod()
+            rho = len(pos) / self._side.prod()
             nmax = self.rmax**ndims * rho
             if int(min(self._side / self.rmax)) > 3 and nmax < 1e8:
-                _log.info('using linked cells')
-                linkedcells = LinkedCells(rcut=self.rmax)
+                if reuse and self._fixed_particles():
+                    _log.info('using verlet lists')
+                    return VerletList(rcut=self.rmax)
+                search = pair_search(self.rmax, self._side, pos)
+                _log.info('using %s', search.__class__.__name__)
+                return search
             else:
                 _log.info('not using linked cells')
-                linkedcells = None
+        return None
+
+    def _histogram(self, x, y, side, gr, bins, linkedcells):
+        """
+        Store in `gr` the histogram of distances between particles at
+        positions `x` and `y`. If `y` is None, distinct pairs of
+        particles in `x` are counted once.
+        """
+        from atooms.postprocessing.realspace_wrap import compute
+
+        if y is None:
+            if linkedcells is None:
+                compute.gr_self(x.transpose(), side, bins[-1], gr, bins)
+            else:
+                neighbors, number_of_neighbors = linkedcells.compute(side, x, as_array=True)
+                compute.gr_neighbors_self('C', x.transpose(), neighbors, number_of_neighbors, side, bins[-1], gr, bins)
         else:
+            if linkedcells is None:
+                compute.gr_distinct(x.transpose(), y.transpose(), side, bins[-1], gr, bins)
+            else:
+                neighbors, number_of_neighbors = linkedcells.compute(side, x, y, as_array=True)
+                compute.gr_neighbors_distinct('C', x.transpose(), y.transpose(), neighbors, number_of_neighbors, side, bins[-1], gr, bins)
+
+    def _compute(self):
+        ncfg = len(self.trajectory)
+        # Assume grandcanonical trajectory for generality.
+        # Note that testing if the trajectory is grandcanonical or
+        # semigrandcanonical is useless when applying filters.  
+        N_0, N_1, volume = 0, 0, 0.0
+        nframes = 0
+        blocks = self._block_average()
+        dr = self.grid[1]
+
+        linkedcells = self._linked_cells(self._pos_1[0])
+        if self.rmax <= 0.0:
             # Maximum distance is L/2
             self.rmax = min(self._side) / 2
-            linkedcells = None
-        
+
         # Redefine grid to extend up to L
         self.grid = linear_grid(0.0, min(self._side), dr)
         gr, bins = numpy.histogram([], bins=self.grid)
+        hist = numpy.zeros_like(gr)
         origins = range(0, ncfg, self.skip)
         for i in progress(origins):
-            self._side = self.trajectory.read(i).cell.side
+            side = self._cell_side[i]
             if len(self._pos_0[i]) == 0 or len(self._pos_1[i]) == 0:
                 continue
             # Store number of particles for normalization
-            N_0.append(self._pos_0[i].shape[0])
-            N_1.append(self._pos_1[i].shape[0])
+            N_0 += self._pos_0[i].shape[0]
+            N_1 += self._pos_1[i].shape[0]
+            volume += side[:self._ndim].prod()
+            nframes += 1
 
-            # Compute g(r)            
+            # Compute g(r). The kernels overwrite gr at each frame.
             if self._pos_0 is self._pos_1:
-                x = self._pos_0[i].transpose()
-                if linkedcells is None:
-                    compute.gr_self(x, self._side, bins[-1], gr, bins)
-                else:
-                    neighbors, number_of_neighbors = linkedcells.compute(self._side, self._pos_0[i], as_array=True)
-                    compute.gr_neighbors_self('C', x, neighbors, number_of_neighbors, self._side, bins[-1], gr, bins)
+                self._histogram(self._pos_0[i], None, side, gr, bins, linkedcells)
             else:
-                x = self._pos_0[i].transpose()
-                y = self._pos_1[i].transpose()
-                if linkedcells is None:
-                    compute.gr_distinct(x, y, self._side, bins[-1], gr, bins)
-                else:
-                    neighbors, number_of_neighbors = linkedcells.compute(self._side, self._pos_0[i], self._pos_1[i], as_array=True)
-                    compute.gr_neighbors_distinct('C', x, y, neighbors, number_of_neighbors, self._side, bins[-1], gr, bins)
-                    
-            # Damned copies in python
-            gr_all.append(gr.copy())
+                self._histogram(self._pos_0[i], self._pos_1[i], side, gr, bins, linkedcells)
+            hist += gr
+            if blocks is not None:
+                blocks.add(None, blocks.block(i, ncfg), gr)
 
         # Normalization
         r = bins
-        N_0 = numpy.average(N_0)
-        N_1 = numpy.average(N_1)
-        if self._ndim == 2:
-            vol = math.pi * (r[1:]**2 - r[:-1]**2)
-        elif self._ndim == 3:
-            vol = 4 * math.pi / 3.0 * (r[1:]**3 - r[:-1]**3)
-        else:
-            from math import gamma
-            n2 = int(float(self._ndim) / 2)
-            vol = math.pi**n2 * (r[1:]**self._ndim-r[:-1]**self._ndim) / gamma(n2+1)
-        rho = N_1 / self._volume
+        N_0 = N_0 / float(nframes)
+        N_1 = N_1 / float(nframes)
+        vol = self._shell_volume(r)
+        rho = N_1 / (volume / nframes)
         if self._pos_0 is self._pos_1:
             norm = rho * vol * N_0 * 0.5  # use Newton III
         else:
             norm = rho * vol * N_0
-        gr = numpy.average(gr_all, axis=0)
+        gr = hist / float(nframes)
         self.grid = (r[:-1] + r[1:]) / 2.0
         self.value = gr / norm
 
@@ -265,6 +588,120 @@ class RadialDistributionFunctionFast(RadialDistributionFunctionLegacy):
         where = self.grid < self.rmax
         self.grid = self.grid[where]
         self.value = self.value[where]
-        
-# Defaults to fast 
-RadialDistributionFunction = RadialDistributionFunctionFast
+        if blocks is not None:
+            self.error = (blocks.error() / norm)[where]
+
+    def _compute_species(self, species):
+        # Same grid and linked cells as in _compute(). Subsets of
+        # particles of each species share the linked cells, so neighbors
+        # cannot be reused across frames.
+        linkedcells = self._linked_cells(self._pos[0], reuse=False)
+        rmax = self.rmax if self.rmax > 0.0 else min(self._side) / 2
+        gr, bins = numpy.histogram([], bins=linear_grid(0.0, min(self._side), self.grid[1]))
+
+        def histogram(pos, ids, side):
+            # The f90 kernels are applied to each pair of species
+            nsp = len(species)
+            hist = numpy.zeros((nsp, nsp, len(gr)), dtype=gr.dtype)
+            x = [numpy.ascontiguousarray(pos[ids == a]) for a in range(nsp)]
+            for a in range(nsp):
+                for b in range(a, nsp):
+                    if len(x[a]) == 0 or len(x[b]) == 0:
+                        continue
+                    self._histogram(x[a], None if a == b else x[b], side, gr, bins, linkedcells)
+                    hist[a, b] = gr
+                    hist[b, a] = gr
+            return hist
+
+        results = self._compute_species_bins(species, bins, histogram)
+        for result in results.values():
+            where = result['grid'] < rmax
+            for key in result:
+                if result[key] is not None:
+                    result[key] = result[key][where]
+        return results
+
+
+class RadialDistributionFunctionNumpy(RadialDistributionFunctionLegacy):
+    """
+    Radial distribution function using vectorized numpy kernels.
+
+    The correlation function g(r) is computed over a grid of distances
+    `rgrid`. If the latter is `None`, the grid is linear from 0 to L/2
+    with a spacing of `dr`, up to `rmax` if the latter is positive.
+    Here, L is the side of the simulation cell along the x axis at the
+    first step.
+
+    Pairs of particles are found with cell lists, when there are at
+    least 3 cells of side `rmax` along each side of the cell, else all
+    pairs are evaluated in blocks of arrays. If `rmax` is positive and
+    the particles are the same at all frames, a Verlet list is reused
+    across frames instead. For heterogeneous systems, pairs are found
+    with a periodic KD-tree, if scipy is available. This backend needs
+    no compiled extension.
+
+    Additional parameters:
+    ----------------------
+
+    - norigins: controls the number of trajectory frames to compute
+      the time average
+    """
+
+    def __init__(self, trajectory, rgrid=None, norigins=None, dr=0.04, ndim=-1, rmax=-1.0):
+        RadialDistributionFunctionLegacy.__init__(self, trajectory, rgrid=rgrid,
+                                                  norigins=norigins, dr=dr,
+                                                  ndim=ndim, rmax=rmax)
+        if rgrid is None and rmax > 0.0:
+            # Tolerate round-off on the last edge of the grid
+            self.grid = [r for r in self.grid if r <= rmax + 1e-9 * dr]
+        self._search = None
+
+    def _pair_search(self, pos):
+        """
+        Return a Verlet list or a KD-tree for the distances up to
+        `rmax`, or None if pairs are best found by `cell_pairs()`
+        """
+        from .linkedcells import LinkedCells
+        from .neighbors import VerletList, pair_search
+
+        if self.rmax <= 0.0:
+            return None
+        if self._fixed_particles():
+            _log.info('using verlet lists')
+            return VerletList(rcut=self.grid[-1])
+        search = pair_search(self.grid[-1], self._side, pos)
+        if isinstance(search, LinkedCells):
+            return None
+        _log.info('using %s', search.__class__.__name__)
+        return search
+
+    def _neighbors(self, x, y, side):
+        if self._search is None:
+            return None
+        return self._search.compute(side, x, y)
+
+    def _compute(self):
+        self._search = self._pair_search(self._pos_0[0])
+        RadialDistributionFunctionLegacy._compute(self)
+
+    def _compute_species(self, species):
+        self._search = self._pair_search(self._pos[0])
+        return RadialDistributionFunctionLegacy._compute_species(self, species)
+
+    def _pairs_hist(self, x, y, side, bins):
+        return pairs_cells_hist(gr_kernel_components, x, y, side, bins,
+                                neighbors=self._neighbors(x, y, side))[0, 0]
+
+    def _species_hist(self, pos, ids, nsp, side, bins):
+        return pairs_cells_hist(gr_kernel_components, pos, None, side, bins,
+                                species=ids, nsp=nsp,
+                                neighbors=self._neighbors(pos, None, side))
+
+
+# Defaults to fast, unless the f90 kernels are missing
+try:
+    from . import realspace_wrap
+    RadialDistributionFunction = RadialDistributionFunctionFast
+except ImportError:
+    _log.debug('f90 kernels missing, g(r) defaults to numpy backend')
+    RadialDistributionFunction = RadialDistributionFunctionNumpy
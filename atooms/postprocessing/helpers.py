@@ -112,6 +112,15 @@ def filter_species(system, species):
     return s
 
 
+def _mask_species(arrays, species):
+    if species is None:
+        return None
+    return arrays['species'] == species
+
+# Vectorized version used on dumped arrays, see `filter.ParticleArrays`
+filter_species.mask = _mask_species
+
+
 def copy_field(system, field, trajectory):
     """
     Copy particle property `field` from `trajectory` at the current
@@ -219,6 +228,26 @@ def setup_t_grid(trajectory, t_grid, offset=True):
     return offsets
 
 
+def required_frames(nframes, skip, grid=None):
+    """
+    Return the sorted list of frames used by a correlation function
+    computed over time origins separated by `skip` frames.
+
+    If `grid` is None, only the time origins are returned. Otherwise,
+    `grid` is a list of (offset, lag) pairs, as returned by
+    `setup_t_grid()`, and the frames `i0` and `i0+lag` are included
+    for all the time origins `i0` starting at offset.
+    """
+    if grid is None:
+        return list(range(0, nframes, skip))
+    frames = set()
+    for off, i in grid:
+        origins = range(off, nframes - i, skip)
+        frames.update(origins)
+        frames.update([i0 + i for i0 in origins])
+    return sorted(frames)
+
+
 def partition(inp, nbl):
     nel = len(inp) // nbl
     a = []
@@ -8,6 +8,7 @@ from atooms.trajectory import Trajectory
 from atooms.trajectory.utils import is_cell_variable
 
 from .fourierspace import FourierSpaceCorrelation, expo_sphere
+from .helpers import required_frames
 
 __all__ = ['SpectralDensity']
 
@@ -34,8 +35,15 @@ class SpectralDensity(FourierSpaceCorrelation):
                                          dk, kmin, kmax, ksamples)
         self._is_cell_variable = None
         # TODO: check step consistency 06.09.2017
-        with Trajectory(trajectory_radius) as th:
-            self._radius = [s.dump('particle.radius') for s in th]
+        # Accept a trajectory-like instance or a path to a trajectory
+        if isinstance(trajectory_radius, str):
+            with Trajectory(trajectory_radius) as th:
+                self._radius = [s.dump('particle.radius') for s in th]
+        else:
+            self._radius = [s.dump('particle.radius') for s in trajectory_radius]
+
+    def _required_frames(self):
+        return required_frames(len(self.trajectory), self.skip)
 
     def _compute(self):
         nsteps = len(self._pos)
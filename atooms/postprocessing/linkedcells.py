@@ -1,237 +1,200 @@
 # This file is part of atooms
 # Copyright 2010-2014, Daniele Coslovich
 
-"""Linked cells to compute neighbors efficiently."""
+"""
+Linked cells to compute neighbors efficiently.
 
-from collections import defaultdict
+The periodic cell is divided in cells of side at least `rcut` along
+each axis, in any number of dimensions. Cells are identified by flat
+indices, particles are sorted by cell and the neighboring cells of
+each cell are obtained from a precomputed stencil of offsets.
+Neighbors are returned in compressed sparse row (CSR) format: the
+neighbors of particle `i` are `indices[offsets[i]: offsets[i+1]]`.
+
+Example:
+-------
+
+    lc = LinkedCells(rcut=1.5)
+    offsets, indices = lc.compute(system.cell.side, system.dump('pos'))
+"""
+
+import itertools
 import numpy
 
-def _pbc(t, N):
-    for i in range(len(t)):
-        if t[i] >= N[i]:
-            t[i] -= N[i]
-        elif t[i] < 0:
-            t[i] += N[i]
-    return t
+__all__ = ['LinkedCells', 'cells_per_side', 'cell_index', 'stencil', 'neighbor_cells',
+           'csr_to_padded']
+
+
+def cells_per_side(side, rcut, max_cells=None):
+    """
+    Return the number of cells of side at least `rcut` along each side.
+
+    If `max_cells` is given, cells are made larger to keep the total
+    number of cells below it, e.g. when `rcut` is much smaller than
+    the typical distance between particles.
+    """
+    side = numpy.asarray(side)
+    ncell = numpy.maximum(1, (side / rcut).astype(numpy.int64))
+    if max_cells is not None and ncell.prod() > max_cells:
+        scale = (ncell.prod() / float(max(1, max_cells)))**(1.0 / len(ncell))
+        ncell = numpy.maximum(1, (ncell / scale).astype(numpy.int64))
+    return ncell
+
+
+def cell_index(pos, side, ncell):
+    """
+    Return the flat indices of the cells of the particles at positions
+    `pos` in a periodic cell of sides `side` centered at the origin,
+    with `ncell` cells along each side.
+    """
+    cell = numpy.floor((pos / side + 0.5) * ncell).astype(numpy.int64) % ncell
+    return numpy.ravel_multi_index(tuple(cell.transpose()), ncell)
+
+
+def stencil(ncell, half=False):
+    """
+    Return the offsets of the neighboring cells of a cell, including
+    the cell itself, with `ncell` cells along each side.
+
+    Offsets that fold onto the same cell, when there are less than 3
+    cells along some side, are included once. If `half` is True, only
+    one of each pair of opposite offsets is kept, so that each pair
+    of neighboring cells appears once. This requires at least 3 cells
+    along each side.
+    """
+    deltas = []
+    for n in ncell:
+        deltas.append([0, 1, -1][:min(n, 3)])
+    offsets = [d for d in itertools.product(*deltas)]
+    if half:
+        if numpy.any(numpy.asarray(ncell) < 3):
+            raise ValueError('half stencil requires at least 3 cells along each side')
+        zero = (0, ) * len(ncell)
+        offsets = [d for d in offsets if d >= zero]
+    return numpy.array(sorted(offsets))
+
+
+def neighbor_cells(ncell, offsets):
+    """
+    Return a (ncells, len(offsets)) array of the flat indices of the
+    neighboring cells of each cell, for the given stencil `offsets`.
+    """
+    ncell = numpy.asarray(ncell)
+    coords = numpy.indices(ncell).reshape(len(ncell), 1, -1)
+    shifted = (coords + offsets.transpose()[:, :, numpy.newaxis]) % ncell[:, numpy.newaxis, numpy.newaxis]
+    return numpy.ravel_multi_index(tuple(shifted), ncell).transpose()
+
+
+def csr_to_padded(offsets, indices, fill=0):
+    """
+    Return the neighbors in CSR format as a padded (npart,
+    max_neighbors) matrix and the number of neighbors of each
+    particle, as required by the f90 kernels.
+    """
+    number_of_neighbors = numpy.diff(offsets)
+    npart = len(number_of_neighbors)
+    width = max(1, number_of_neighbors.max()) if npart > 0 else 1
+    neighbors = numpy.full((npart, width), fill, dtype=numpy.int64)
+    owner = numpy.repeat(numpy.arange(npart), number_of_neighbors)
+    column = numpy.arange(len(indices)) - offsets[owner]
+    neighbors[owner, column] = indices
+    return neighbors, number_of_neighbors
 
-# TODO: define iterator over cells
 
 class LinkedCells(object):
 
+    """
+    Linked cells with cells of side at least `rcut`.
+
+    Neighbors are all the particles in the neighboring cells of a
+    particle's cell: their distances are not checked against `rcut`.
+    """
+
     def __init__(self, rcut):
         self.rcut = rcut
-        self.neighbors = []
-        self._is_adjusted = False
-        self.__all_cells = None
-        self.__ghost_cells = None
-        
-    @property
-    def _all_cells(self):
-        if self.__all_cells is None:
-            self.__all_cells = []
-            for ix in range(self.n_cell[0]):
-                for iy in range(self.n_cell[1]):
-                    for iz in range(self.n_cell[2]):
-                        self.__all_cells.append((ix, iy, iz))
-
-        return self.__all_cells
-
-    @property
-    def _ghost_cells(self):
-        if self.__ghost_cells is None:
-            self.__ghost_cells = []
-            for ix in range(-1, self.n_cell[0]+1):
-                for iy in range(-1, self.n_cell[1]+1):
-                    for iz in range(-1, self.n_cell[2]+1):
-                        if ix == -1 or ix == self.n_cell[0] or \
-                           iy == -1 or iy == self.n_cell[1] or \
-                           iz == -1 or iz == self.n_cell[2]:
-                            self.__ghost_cells.append((ix, iy, iz))
-
-        return self.__ghost_cells
-
-    def _map(self, newton):
-        self._neigh_cell = {}
-        if newton:
-            for ix in range(self.n_cell[0]):
-                for iy in range(self.n_cell[1]):
-                    for iz in range(self.n_cell[2]):
-                        self._neigh_cell[(ix, iy, iz)] = \
-                            [(ix+1, iy, iz  ), (ix+1, iy+1, iz  ), (ix  , iy+1, iz  ), (ix-1, iy+1, iz  ),
-                             (ix+1, iy, iz-1), (ix+1, iy+1, iz-1), (ix  , iy+1, iz-1), (ix-1, iy+1, iz-1),
-                             (ix+1, iy, iz+1), (ix+1, iy+1, iz+1), (ix  , iy+1, iz+1), (ix-1, iy+1, iz+1),
-                             (ix  , iy, iz+1)]
-        else:
-            for ix in range(self.n_cell[0]):
-                for iy in range(self.n_cell[1]):
-                    for iz in range(self.n_cell[2]):
-                        self._neigh_cell[(ix, iy, iz)] = []
-                        for deltax in [-1, 0, 1]:
-                            for deltay in [-1, 0, 1]:
-                                for deltaz in [-1, 0, 1]:
-                                    if deltax == deltay == deltaz == 0:
-                                        continue
-                                    self._neigh_cell[(ix, iy, iz)].append((ix+deltax, iy+deltay, iz+deltaz))
-                        
-        # Apply PBC to neighboring "ghost" cells 
-        for i in self._neigh_cell:
-            for j in range(len(self._neigh_cell[i])):
-                #if self._neigh_cell[i][j] in self._ghost_cells:
-                # if numpy.any(numpy.array(self._neigh_cell[i][j]) < 0) or \
-                #    numpy.any(numpy.array(self._neigh_cell[i][j]) >= self.n_cell):
-                folded = _pbc(list(self._neigh_cell[i][j]), self.n_cell)
-                self._neigh_cell[i][j] = tuple(folded)
-
-    def adjust(self, npart, box, newton):
-        # TODO: why npart?
-        self.box = box
-        self.hbox = box / 2
-        self.n_cell = (box / self.rcut).astype(int)
-        self.box_cell = self.box / self.n_cell
-        self._map(newton=newton)
-
-    def _index(self, pos):
-        x = ((pos + self.hbox) / self.box_cell)
-        return x.astype(numpy.int)
+        self.box = None
+        self.n_cell = None
+        self.offsets = None
+        self.indices = None
+        self._newton = None
+        self._half = False
+        self._neigh_cell = None
+
+    def adjust(self, box, newton, npart=None):
+        """
+        Setup the cells and the neighboring cells of each cell for a
+        periodic cell of sides `box`. If `newton` is True, each pair
+        of particles will be included once. If `npart` is given, there
+        are at most about as many cells as particles.
+        """
+        self.box = numpy.array(box, dtype=float)
+        self.n_cell = cells_per_side(self.box, self.rcut, npart)
+        self._newton = newton
+        # With less than 3 cells along some side, a half stencil
+        # would count some pairs of cells twice, so we use the full
+        # stencil and keep pairs i<j
+        self._half = newton and numpy.all(self.n_cell >= 3)
+        self._stencil = stencil(self.n_cell, half=self._half)
+        self._neigh_cell = neighbor_cells(self.n_cell, self._stencil)
+
+    def _sort(self, pos):
+        """
+        Return the cells of the particles at positions `pos`, the
+        particles sorted by cell and the offsets of each cell in the
+        sorted order.
+        """
+        ncells = self.n_cell.prod()
+        cell = cell_index(pos, self.box, self.n_cell)
+        counts = numpy.bincount(cell, minlength=ncells)
+        order = numpy.argsort(cell, kind='stable')
+        first = numpy.zeros(ncells + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=first[1:])
+        return cell, order, first
 
     def compute(self, box, pos, other=None, as_array=False):
-        if not self._is_adjusted:
-            self.adjust(pos.shape[0], box, newton=other is None)
-            self._is_adjusted = True
-        # We only need positions here but how can we be sure that
-        # this is the same set of particles we use when retrieving
-        # the neighbours? We should keep a reference.
-        # from atooms.postprocessing.realspace_wrap import compute
-        # index = numpy.ndarray(pos.shape, dtype=numpy.int)
-        # compute.bin_in_cell(pos, self.hbox, self.box_cell, index)
-
-        self.neighbors = []
-        self.number_of_neighbors = []
-        index = self._index(pos)
-        if other is None:
-            index_other = index
-        else:
-            index_other = self._index(other)
-
-        particle_in_cell = defaultdict(list)
-        for ipart, icell in enumerate(index_other):
-            particle_in_cell[tuple(icell)].append(ipart)
-
-        for ipart in range(pos.shape[0]):
-            icell = tuple(index[ipart])
-            # Initialize an empty list
-            neighbors = []
-            # Start with particles in the cell of particle ipart
-            if other is None:
-                neighbors += [_ for _ in particle_in_cell[icell] if _ > ipart ]
+        """
+        Return the neighbors of the particles at positions `pos` in a
+        periodic cell of sides `box`, as CSR arrays `(offsets,
+        indices)`.
+
+        If `other` is None, neighbors are particles in `pos` and each
+        pair is included once, as a neighbor of either particle.
+        Otherwise, neighbors are particles in `other`.
+        If `as_array` is True, return instead a padded matrix of
+        neighbors and the number of neighbors of each particle, see
+        `csr_to_padded()`.
+        """
+        newton = other is None
+        if self.box is None or newton != self._newton or \
+           numpy.any(self.box != numpy.asarray(box)):
+            self.adjust(box, newton, len(pos))
+
+        cell, order, first = self._sort(pos)
+        if other is not None:
+            _, order, first = self._sort(other)
+
+        # Neighboring cells of each particle and their particles
+        npart = len(pos)
+        cells = self._neigh_cell[cell]
+        start = first[cells].ravel()
+        length = (first[cells + 1].ravel() - start)
+        total = length.sum()
+        shift = numpy.repeat(start - (numpy.cumsum(length) - length), length)
+        indices = order[shift + numpy.arange(total)]
+        owner = numpy.repeat(numpy.repeat(numpy.arange(npart), cells.shape[1]), length)
+
+        if newton:
+            if self._half:
+                # Only pairs within the same cell can appear twice
+                same = numpy.repeat(numpy.tile(~numpy.any(self._stencil, axis=1), npart), length)
+                keep = ~same | (indices > owner)
             else:
-                neighbors += particle_in_cell[icell]
-                # try:
-                #     neighbors.remove(ipart)
-                # except:
-                #     pass
-            # Loop over neighbors cells and add neighbors
-            for jcell in self._neigh_cell[icell]:
-                neighbors += particle_in_cell[jcell]
-            self.neighbors.append(neighbors)
-            self.number_of_neighbors.append(len(neighbors))
-            
+                keep = indices > owner
+            indices, owner = indices[keep], owner[keep]
+
+        offsets = numpy.zeros(npart + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(owner, minlength=npart), out=offsets[1:])
+        self.offsets, self.indices = offsets, indices
         if as_array:
-            npart = len(self.neighbors)
-            number_of_neighbors = numpy.array(self.number_of_neighbors)
-            neighbors_array = numpy.ndarray((npart, max(number_of_neighbors)), dtype=numpy.int)
-            for ipart in range(len(self.neighbors)):
-                neighbors_array[ipart, 0:len(self.neighbors[ipart])] = self.neighbors[ipart]
-            self.neighbors = neighbors_array
-            self.number_of_neighbors = number_of_neighbors
-            return self.neighbors, number_of_neighbors
-        else:            
-            return self.neighbors
-    
-# import sys
-# from atooms.system import Particle
-# import atooms.trajectory as trj
-# t = trj.Trajectory(sys.argv[1])
-# system = t[0]
-# # system.particle = []
-# # dr = system.cell.side[0] / 20
-# # for ix in range(0,20):
-# #     for iy in range(0,20):
-# #         system.particle.append(Particle(position=[ix*dr+dr/2 - system.cell.side[0]/2, iy*dr+dr/2 - system.cell.side[0]/2, 0]))
-
-# trj.decorators.change_species(system, 'F')
-# print('----')
-# pos = system.dump('pos', order='C')
-# ids = system.dump('spe')
-# print('----')
-# lc = _LinkedCells(rcut=2.0)
-# nn, num = lc.compute(system.cell.side, pos, as_array=True)
-# print(nn[0][0:num[0]])
-# print('#', lc.box_cell / (system.cell.side/2))
-# print('----')
-
-# for j in nn[0][0:num[0]]:
-#     dr = system.particle[0].distance(system.particle[j], system.cell)
-#     print(numpy.sum(dr**2)**0.5, lc.box_cell[0] * 2)
-
-# # from atooms.postprocessing.realspace_wrap import compute
-# # rcut = numpy.array([[1.5, 1.5], [1.5, 1.5]])
-# # rcut[:] = lc.box_cell[0] * 2
-# # max_neighbors = 300
-# # number_of_neighbors = numpy.ndarray(pos.shape[0], dtype=numpy.int32)
-# # neighbors = numpy.ndarray((pos.shape[0], max_neighbors), dtype=numpy.int32, order='F')
-# # #print(pos.shape)
-# # pos = numpy.array(pos, order='F')
-# # compute.neighbors_list('C',system.cell.side,pos.transpose(),ids,rcut,number_of_neighbors,neighbors)
-# # #neighbors_0 = numpy.ndarray(max_neighbors, dtype=numpy.int32, order='F')
-# # #nn = numpy.array(0, dtype=numpy.int32)
-# # # compute.neighbors('C',system.cell.side,pos,pos[0],ids,rcut,nn,neighbors_0)
-# # # print(neighbors[0][0:number_of_neighbors[0]])
-
-
-# # print(str(system.particle[0].position / (system.cell.side/2))[1:-1])
-# # print()
-# # print()
-# # for nnn in [sorted(neighbors[0]), sorted(lc.neighbors[0])]:
-# #     for j in nnn:
-# #         print(str(system.particle[j].position / (system.cell.side/2))[1:-1])
-# #     print()
-# #     print()
-
-
-
-# # js = []
-# # for j in range(pos.shape[0]):
-# #     dr = system.particle[0].distance(system.particle[j], system.cell)
-# #     if j> 0 and numpy.sum(dr**2)**0.5 < lc.box_cell[0] * 2:
-# #         js.append(j)
-
-# # # print(len(sorted(lc.neighbors[0])))
-# # # print(len(sorted(neighbors[0][0:number_of_neighbors[0]])))
-# # # print(len(sorted(js)))
-# # # print('----')    
-
-# # # for nnn in [sorted(lc.neighbors[0]),
-# # #             sorted(neighbors[0][0:number_of_neighbors[0]])]:
-# # #     for j in nnn:
-# # #         print(str(system.particle[j].position)[1:-1])
-# # #     print()
-# # #     print()
-
-# # # for nnn in [sorted(js),
-# # #             sorted(neighbors[0][0:number_of_neighbors[0]])]:
-# # #     for j in nnn:
-# # #         dr = system.particle[0].distance(system.particle[j], system.cell)
-# # #         print(j, numpy.sum(dr**2)**0.5)
-# # #     print
-
-
-# # # # for x in neighbors:
-# # # #     print(x)
-# # # for i in range(pos.shape[0]):
-# # #     x = list(sorted(lc.neighbors[i]))
-# # #     y = neighbors[i][0:number_of_neighbors[i]]
-# # #     print(x)
-# # #     print(y)
-# # #     assert numpy.all(x == y)
-# # #     print()
+            return csr_to_padded(offsets, indices)
+        return offsets, indices
@@ -7,7 +7,8 @@ import logging
 import numpy
 
 from .helpers import linear_grid
-from .correlation import Correlation, gcf_offset
+from .correlation import Correlation, gcf_offset_batch, gcf_fft, msd_fft, use_fft, _stack
+from .correlation import gcf_multiple_tau
 from .helpers import setup_t_grid
 
 __all__ = ['MeanSquareDisplacement']
@@ -33,6 +34,13 @@ class MeanSquareDisplacement(Correlation):
     - sigma: value of the interparticle distance (usually 1.0). It is
     used to limit the fit range to extract the diffusion coefficient
     and to determine the diffusion time
+    - algorithm: 'direct', 'fft', 'multiple-tau' or 'auto'. With
+    'fft', the MSD is computed with FFT using all time origins, which
+    requires equally spaced frames. With 'multiple-tau', the MSD is
+    computed on a log-spaced time grid, up to the largest time in
+    the grid, with a multiple-tau correlator, see
+    `gcf_multiple_tau()`. With 'auto', FFT is used when it is
+    cheaper and errors are not requested, see `use_fft()`.
     """
 
     symbol = 'msd'
@@ -41,8 +49,9 @@ class MeanSquareDisplacement(Correlation):
     phasespace = 'pos-unf'
 
     def __init__(self, trajectory, tgrid=None, rmax=-1.0, norigins=None,
-                 tsamples=30, sigma=1.0, fix_cm=False):
+                 tsamples=30, sigma=1.0, fix_cm=False, algorithm='auto'):
         self.rmax = rmax
+        self.algorithm = algorithm
         self.sigma = sigma
         self.tsamples = tsamples
         self._norigins = norigins
@@ -67,9 +76,28 @@ class MeanSquareDisplacement(Correlation):
 
         #self.grid = [_*self.trajectory.timestep for _ in self.trajectory.steps[:30]]
         self._discrete_tgrid = setup_t_grid(self.trajectory, self.grid, offset=self._norigins != '1')
+
+        def msd_batch(x, y):
+            return numpy.sum((x-y)**2, axis=(1, 2)) / float(x.shape[1])
+
         # Note that the grid is redefined
-        self.grid, self.value = gcf_offset(msd, self._discrete_tgrid, self.skip,
-                                           self.trajectory.steps, self._pos_unf)
+        pos_unf = _stack(self._pos_unf)
+        blocks = self._block_average()
+        if self.algorithm == 'multiple-tau':
+            self.grid, self.value = gcf_multiple_tau(msd_batch, self.trajectory.steps, pos_unf,
+                                                     self.trajectory.block_size,
+                                                     tmax=max(self.grid) / self.trajectory.timestep,
+                                                     blocks=blocks)
+        elif isinstance(pos_unf, numpy.ndarray) and \
+           use_fft(self.algorithm, self._discrete_tgrid, self.skip,
+                   self.trajectory.steps, self.trajectory.block_size,
+                   errors=self.error_blocks > 1):
+            self.grid, self.value = gcf_fft(msd_fft, self._discrete_tgrid,
+                                            self.trajectory.steps, pos_unf)
+        else:
+            self.grid, self.value = gcf_offset_batch(msd_batch, self._discrete_tgrid, self.skip,
+                                                     self.trajectory.steps, pos_unf, blocks=blocks)
+        self._set_error(blocks)
         # Update grid to real time
         self.grid = [ti * self.trajectory.timestep for ti in self.grid]
 
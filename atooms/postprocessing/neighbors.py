@@ -0,0 +1,244 @@
+# This file is part of atooms
+# Copyright 2010-2018, Daniele Coslovich
+
+"""
+Searches of pairs of particles within a cutoff distance.
+
+Pair search backends find, for each particle, the neighbors within a
+distance `rcut` in a periodic cell. They share the interface of
+`linkedcells.LinkedCells`:
+
+    offsets, indices = backend.compute(box, pos, other=None)
+
+returns the neighbors in CSR format, including all the pairs within
+`rcut` and possibly more: distances must still be checked. The
+available backends are
+
+- `LinkedCells`: cell lists, efficient for homogeneous systems
+- `PeriodicKDTree`: a periodic KD-tree, which keeps the search
+  near-linear in heterogeneous systems, e.g. gels or interfaces. It
+  requires scipy.
+- `VerletList`: pairs within `rcut + skin`, reused across frames as
+  long as particles have moved by less than `skin/2`, built with
+  one of the backends above
+
+`pair_search()` picks a backend from the density profile, the cutoff
+and the shape of the cell.
+
+Example:
+-------
+
+    vl = VerletList(rcut=2.5, skin=0.3)
+    for system in trajectory:
+        offsets, indices = vl.compute(system.cell.side, system.dump('pos'))
+"""
+
+import logging
+
+import numpy
+
+from .linkedcells import LinkedCells, csr_to_padded, cells_per_side, cell_index
+
+__all__ = ['PeriodicKDTree', 'VerletList', 'pair_search']
+
+_log = logging.getLogger(__name__)
+
+
+def _csr(owner, indices, npart):
+    """Return CSR arrays of the pairs (owner, indices) sorted by owner"""
+    order = numpy.argsort(owner, kind='stable')
+    offsets = numpy.zeros(npart + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(owner, minlength=npart), out=offsets[1:])
+    return offsets, indices[order]
+
+
+def _has_scipy():
+    try:
+        from scipy.spatial import cKDTree
+        return True
+    except ImportError:
+        return False
+
+
+def pair_search(rcut, box, pos, backend='auto'):
+    """
+    Return a pair search backend for particles at positions `pos` in
+    a periodic cell of sides `box`, with cutoff `rcut`.
+
+    If `backend` is 'auto', the periodic KD-tree is used when scipy is
+    available and cell lists would perform poorly. This happens if
+    there are less than 3 cells along some side, which is the case
+    for large cutoffs or elongated cells, or if the density is very
+    heterogeneous, so that a few cells hold most of the particles.
+    Otherwise, linked cells are used.
+    """
+    if backend == 'cells':
+        return LinkedCells(rcut)
+    if backend == 'kdtree':
+        return PeriodicKDTree(rcut)
+    if backend != 'auto':
+        raise ValueError('unknown pair search backend {}'.format(backend))
+
+    if not _has_scipy():
+        return LinkedCells(rcut)
+    ncell = cells_per_side(box, rcut, len(pos))
+    if numpy.any(ncell < 3):
+        _log.debug('less than 3 cells per side, using kd-tree')
+        return PeriodicKDTree(rcut)
+    # The cost of cell lists is proportional to the sum of the square
+    # occupancies of the cells. For uniform, random positions, it is
+    # N * (mean + 1), with mean = N / ncells.
+    counts = numpy.bincount(cell_index(pos, box, ncell), minlength=ncell.prod())
+    mean = len(pos) / float(ncell.prod())
+    if numpy.sum(counts**2) > 2 * len(pos) * (mean + 1):
+        _log.debug('heterogeneous density, using kd-tree')
+        return PeriodicKDTree(rcut)
+    return LinkedCells(rcut)
+
+
+class PeriodicKDTree(object):
+
+    """
+    Periodic KD-tree, built with scipy's cKDTree.
+
+    Unlike linked cells, neighbors are exactly the particles within
+    `rcut`.
+    """
+
+    def __init__(self, rcut):
+        self.rcut = rcut
+        self.offsets = None
+        self.indices = None
+
+    def _tree(self, box, pos):
+        from scipy.spatial import cKDTree
+        # The tree expects positions in [0, box)
+        x = (pos + box / 2) % box
+        x[x >= box] = 0.0
+        return cKDTree(x, boxsize=box)
+
+    def compute(self, box, pos, other=None, as_array=False):
+        """
+        Return the neighbors of the particles at positions `pos` in a
+        periodic cell of sides `box`, as CSR arrays `(offsets,
+        indices)`, see `LinkedCells.compute()`.
+        """
+        box = numpy.asarray(box, dtype=float)
+        tree = self._tree(box, pos)
+        if other is None:
+            pairs = tree.query_pairs(self.rcut, output_type='ndarray')
+            owner, indices = pairs[:, 0], pairs[:, 1]
+        else:
+            pairs = tree.sparse_distance_matrix(self._tree(box, other), self.rcut,
+                                                output_type='ndarray')
+            owner, indices = pairs['i'], pairs['j']
+        self.offsets, self.indices = _csr(owner, indices, len(pos))
+        if as_array:
+            return csr_to_padded(self.offsets, self.indices)
+        return self.offsets, self.indices
+
+
+def _displacement(pos, ref, box):
+    """Return the largest displacement between `pos` and `ref`"""
+    if len(pos) == 0:
+        return 0.0
+    dr = pos - ref
+    dr -= numpy.rint(dr / box) * box
+    return numpy.max(numpy.sum(dr**2, axis=1))**0.5
+
+
+def pairs_distance_squared(x, y, i, j, box):
+    """
+    Return the squared distances between the particles at positions
+    x[i] and y[j] in a periodic cell of sides `box`.
+    """
+    r2 = numpy.zeros(len(i))
+    for k in range(x.shape[1]):
+        dr = x[i, k] - y[j, k]
+        dr -= numpy.rint(dr / box[k]) * box[k]
+        r2 += dr * dr
+    return r2
+
+
+class VerletList(object):
+
+    """
+    Verlet neighbor list with cutoff `rcut` and `skin` distance.
+
+    The list is built with the pair search `backend`, see
+    `pair_search()`, and rebuilt only when the particles have moved
+    enough since the last build to bring new pairs within `rcut`, or
+    when the cell or the number of particles change. The particles
+    must be the same, in the same order, across calls to `compute()`,
+    else the list must be `reset()`.
+    """
+
+    def __init__(self, rcut, skin=0.3, backend='auto'):
+        self.rcut = rcut
+        self.skin = skin
+        self.backend = backend
+        self.offsets = None
+        self.indices = None
+        self.builds = 0
+        """Number of times the list has been built"""
+        self._padded = None
+        self._search = None
+        self.reset()
+
+    def reset(self):
+        """Force a new build of the list at the next `compute()`"""
+        self._box = None
+        self._pos = None
+        self._other = None
+
+    def _need_update(self, box, pos, other):
+        if self._pos is None or (other is None) != (self._other is None):
+            return True
+        if numpy.any(self._box != box) or pos.shape != self._pos.shape:
+            return True
+        if other is None:
+            # Both particles of a pair may have moved
+            return 2 * _displacement(pos, self._pos, box) > self.skin
+        if other.shape != self._other.shape:
+            return True
+        return _displacement(pos, self._pos, box) + \
+            _displacement(other, self._other, box) > self.skin
+
+    def _build(self, box, pos, other):
+        if self._search is None:
+            self._search = pair_search(self.rcut + self.skin, box, pos, self.backend)
+        offsets, indices = self._search.compute(box, pos, other)
+        owner = numpy.repeat(numpy.arange(len(pos)), numpy.diff(offsets))
+        y = pos if other is None else other
+        keep = numpy.zeros(len(indices), dtype=bool)
+        # Distances are checked in blocks to limit memory
+        size = 1000000
+        for start in range(0, len(indices), size):
+            i, j = owner[start: start + size], indices[start: start + size]
+            keep[start: start + size] = pairs_distance_squared(pos, y, i, j, box) < (self.rcut + self.skin)**2
+        self.indices = indices[keep]
+        self.offsets = numpy.zeros(len(pos) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(owner[keep], minlength=len(pos)), out=self.offsets[1:])
+        self._padded = None
+        self._box = box.copy()
+        self._pos = pos.copy()
+        self._other = None if other is None else other.copy()
+        self.builds += 1
+
+    def compute(self, box, pos, other=None, as_array=False):
+        """
+        Return the neighbors of the particles at positions `pos` in a
+        periodic cell of sides `box`, as CSR arrays `(offsets,
+        indices)`, see `LinkedCells.compute()`.
+
+        Neighbors include all the pairs within `rcut` and possibly some
+        pairs within `rcut + skin`: distances must still be checked.
+        """
+        box = numpy.asarray(box, dtype=float)
+        if self._need_update(box, pos, other):
+            self._build(box, pos, other)
+        if as_array:
+            if self._padded is None:
+                self._padded = csr_to_padded(self.offsets, self.indices)
+            return self._padded
+        return self.offsets, self.indices
@@ -0,0 +1,163 @@
+# This file is part of atooms
+# Copyright 2010-2018, Daniele Coslovich
+
+"""
+Parallel reading of trajectory frames and parallel execution of
+independent tasks.
+
+Frames are split in contiguous shards, which are processed by a pool
+of forked worker processes. Each worker opens its own handle to the
+trajectory file, since forked processes would otherwise share the
+file offset. The function applied to the frames is inherited by the
+workers via fork and need not be picklable, only its results must be.
+
+Independent tasks, such as the partial correlation functions of a
+mixture, are scheduled in the same way, see `map_tasks()`.
+
+If fork is not available, or if we are already within a worker
+process, frames and tasks are processed serially.
+"""
+
+import os
+import logging
+import multiprocessing
+
+from atooms.trajectory.utils import gopen
+
+from .progress import progress
+
+__all__ = ['map_frames', 'map_tasks']
+
+_log = logging.getLogger(__name__)
+
+# State inherited by the worker processes
+_func = None
+_trajectory = None
+_tasks = None
+_trajectories = ()
+
+
+def _reopen(trajectory):
+    """Open a private handle to the file of `trajectory`"""
+    # Views on other trajectories, e.g. slices, read from the latter
+    component = getattr(trajectory, 'component', None)
+    if component is not None:
+        _reopen(component)
+        return
+    handle = getattr(trajectory, 'trajectory', None)
+    filename = getattr(trajectory, 'filename', None)
+    if handle is None or not hasattr(handle, 'seek') or \
+       filename is None or not os.path.isfile(filename):
+        return
+    if getattr(trajectory, 'mode', 'r') != 'r':
+        return
+    trajectory.trajectory = gopen(filename, 'r')
+
+
+def _init():
+    for trajectory in (_trajectory, ) + tuple(_trajectories):
+        if trajectory is not None:
+            _reopen(trajectory)
+
+
+def _work(frames):
+    return [_func(_trajectory, frame) for frame in frames]
+
+
+def _work_task(index):
+    return index, _func(_tasks[index])
+
+
+def _pool(nworkers):
+    """Return a pool of `nworkers` forked processes or None"""
+    if multiprocessing.current_process().daemon:
+        # Daemonic processes cannot have children
+        return None
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        # Python 2: fork is the only start method on posix
+        if os.name != 'posix':
+            return None
+        context = multiprocessing
+    except ValueError:
+        return None
+    return context.Pool(nworkers, initializer=_init)
+
+
+def _shards(frames, n):
+    """Split the list of `frames` in `n` contiguous shards"""
+    size = max(1, -(-len(frames) // n))
+    return [frames[i: i + size] for i in range(0, len(frames), size)]
+
+
+def map_frames(func, trajectory, frames, nworkers=1):
+    """
+    Iterate over `func(trajectory, frame)` for all the `frames` of
+    `trajectory`, using `nworkers` processes.
+
+    Results are yielded in the order of `frames`.
+    """
+    global _func, _trajectory
+    frames = list(frames)
+    pool = None
+    if nworkers > 1 and len(frames) > 1:
+        _func, _trajectory = func, trajectory
+        pool = _pool(nworkers)
+        if pool is None:
+            _log.info('cannot fork worker processes, reading frames serially')
+
+    if pool is None:
+        for frame in progress(frames):
+            yield func(trajectory, frame)
+        return
+
+    try:
+        # Use more shards than workers to balance the load
+        shards = _shards(frames, nworkers * 4)
+        for results in progress(pool.imap(_work, shards), total=len(shards)):
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _func, _trajectory = None, None
+
+
+def map_tasks(func, tasks, nworkers=1, costs=None, trajectories=()):
+    """
+    Return the list of `func(task)` for all the `tasks`, using
+    `nworkers` processes.
+
+    If `costs` is given, tasks are submitted by decreasing cost, so
+    that idle workers always pick up the most expensive task left
+    (longest processing time first). Workers reopen the files of
+    `trajectories` used by the tasks.
+    """
+    global _func, _tasks, _trajectories
+    tasks = list(tasks)
+    pool = None
+    if nworkers > 1 and len(tasks) > 1:
+        _func, _tasks, _trajectories = func, tasks, trajectories
+        pool = _pool(min(nworkers, len(tasks)))
+        if pool is None:
+            _log.info('cannot fork worker processes, running tasks serially')
+
+    if pool is None:
+        return [func(task) for task in tasks]
+
+    order = list(range(len(tasks)))
+    if costs is not None:
+        order = sorted(order, key=lambda i: costs[i], reverse=True)
+    results = [None] * len(tasks)
+    try:
+        for index, result in progress(pool.imap_unordered(_work_task, order),
+                                      total=len(order)):
+            results[index] = result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _func, _tasks, _trajectories = None, None, ()
+    return results
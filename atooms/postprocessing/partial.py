@@ -5,11 +5,22 @@
 Fake decorator to compute partial correlation functions.
 
 It uses filters internally.
+
+Correlation functions that implement species-resolved kernels, such
+as g(r), S(k) and F(k,t), compute the partials of all species pairs
+in a single pass over the unfiltered trajectory, unless weights are
+used.
+
+Otherwise, partial correlation functions are independent and can be
+computed in parallel by passing `nworkers` larger than 1 upon
+construction. Species (pairs) are scheduled by decreasing number of
+particles (pairs), which estimates their cost.
 """
 
 import logging
 
 from .helpers import filter_species
+from .parallel import map_tasks
 
 _log = logging.getLogger(__name__)
 
@@ -17,12 +28,18 @@ _log = logging.getLogger(__name__)
 class Partial(object):
 
     def __init__(self, corr_cls, species, *args, **kwargs):
-        """The first positional argument must be the trajectory instance."""
+        """
+        The first positional argument must be the trajectory instance.
+
+        The `nworkers` keyword argument sets the number of processes
+        computing the partial correlation functions (default is 1).
+        """
         # Instantiate correlation objects
         # with args passed upon construction
         self.partial = {}
         self.nbodies = corr_cls.nbodies
         self.species = species
+        self.nworkers = kwargs.pop('nworkers', 1)
 
         if self.nbodies == 1:
             for i in range(len(self.species)):
@@ -45,6 +62,14 @@ class Partial(object):
                     self.partial[(isp, jsp)].tag = '%s-%s' % (isp, jsp)
                     self.partial[(isp, jsp)].tag_description = 'species pair %s-%s' % (isp, jsp)
 
+        # Unfiltered correlation that computes all the partials at
+        # once. It is created only when needed, see _compute_species()
+        self._species_resolved = self.nbodies == 2 and corr_cls._species_resolved
+        self._all = None
+        self._corr_cls = corr_cls
+        self._args = args
+        self._kwargs = kwargs
+
     def add_weight(self, trajectory=None, field=None, fluctuations=False):
         for key in self.partial:
             self.partial[key].add_weight(trajectory, field, fluctuations)
@@ -57,8 +82,94 @@ class Partial(object):
                 break
         return need
 
+    def _independent(self):
+        """Return the keys of the partial correlations to compute"""
+        keys = []
+        for key in sorted(self.partial, key=str):
+            if self.nbodies == 2 and \
+               self.species.index(key[0]) > self.species.index(key[1]):
+                continue
+            keys.append(key)
+        return keys
+
+    def _costs(self, keys):
+        """Estimate the cost of `keys` from the number of particles (pairs)"""
+        system = self.partial[keys[0]].trajectory[0]
+        species = [p.species for p in system.particle]
+        costs = []
+        for key in keys:
+            if self.nbodies == 1:
+                costs.append(species.count(key))
+            else:
+                costs.append(species.count(key[0]) * species.count(key[1]))
+        return costs
+
+    def _compute_parallel(self):
+        def compute(key):
+            self.partial[key].compute()
+            return self.partial[key]._results()
+
+        keys = self._independent()
+        trajectories = [self.partial[key].trajectory for key in keys]
+        results = map_tasks(compute, keys, self.nworkers,
+                            costs=self._costs(keys), trajectories=trajectories)
+        for key, result in zip(keys, results):
+            self.partial[key]._set_results(result)
+        if self.nbodies == 2:
+            for isp, jsp in self.partial:
+                if (isp, jsp) not in keys:
+                    self.partial[(isp, jsp)]._set_results(self.partial[(jsp, isp)]._results())
+
+    def _single_pass(self):
+        """Return True if all the partials are computed in a single pass"""
+        weights = [partial._weight for partial in self.partial.values()]
+        return self._species_resolved and weights.count(None) == len(weights)
+
+    def _unfiltered(self):
+        """
+        Return the unfiltered correlation that computes all the
+        partials in a single pass, with the current settings of the
+        partial correlations.
+        """
+        if self._all is None:
+            self._all = self._corr_cls(*self._args, **self._kwargs)
+            phasespace = self._corr_cls.phasespace
+            if not isinstance(phasespace, (list, tuple)):
+                phasespace = [phasespace]
+            self._all.phasespace = list(phasespace) + ['ids']
+        cf = self._all
+        first = self.partial[self._independent()[0]]
+        for name in ['dtype', 'nworkers', 'phasespace_cache', 'error_blocks']:
+            setattr(cf, name, getattr(first, name))
+        cf._partial_species = self.species
+        return cf
+
+    def _set_species_results(self):
+        """Store the results of the unfiltered correlation in the partials"""
+        cf = self._all
+        # As in the other paths, symmetric entries are copied
+        keys = self._independent()
+        for isp, jsp in self.partial:
+            key = (isp, jsp) if (isp, jsp) in keys else (jsp, isp)
+            self.partial[(isp, jsp)]._set_results(cf._partial_results[key])
+        cf._partial_results = None
+
+    def _compute_species(self):
+        cf = self._unfiltered()
+        cf.compute()
+        self._set_species_results()
+        # Release the arrays
+        for name in cf._phasespace_arrays():
+            setattr(cf, name, [])
+
     def compute(self):
-        if self.nbodies == 1:
+        if self._single_pass():
+            self._compute_species()
+
+        elif self.nworkers > 1:
+            self._compute_parallel()
+
+        elif self.nbodies == 1:
             for i in range(len(self.species)):
                 isp = self.species[i]
                 self.partial[isp].compute()
@@ -74,12 +185,17 @@ class Partial(object):
                         # The isp-jsp has been already calculated
                         self.partial[(isp, jsp)].grid = self.partial[(jsp, isp)].grid
                         self.partial[(isp, jsp)].value = self.partial[(jsp, isp)].value
+                        self.partial[(isp, jsp)].error = self.partial[(jsp, isp)].error
 
     def do(self, update=False):
         if update and not self.need_update():
-            return
-
-        self.compute()
+            for partial in self.partial.values():
+                partial._read_cache()
+        else:
+            self.compute()
+            if update:
+                for partial in self.partial.values():
+                    partial._write_cache()
 
         for partial in self.partial.values():
             try:
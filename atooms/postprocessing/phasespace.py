@@ -0,0 +1,326 @@
+# This file is part of atooms
+# Copyright 2010-2018, Daniele Coslovich
+
+"""
+Storage of phase space variables dumped from a trajectory.
+
+Per-frame arrays, such as particles' positions, are stored in a
+single contiguous numpy array of shape (nframes, N, ndim), which is
+preallocated when the first frame is appended. Correlation functions
+can then slice it along the time axis without copies.
+
+Stored arrays can be saved in a persistent cache on disk, see
+`Cache`, and reused as memory-mapped arrays when the same trajectory
+is analyzed again.
+"""
+
+import os
+import hashlib
+import logging
+
+import numpy
+
+__all__ = ['Store', 'Cache', 'SpeciesCodes', 'Unfolder', 'trajectory_key', 'callback_key',
+           'unfold', 'subtract_cm']
+
+_log = logging.getLogger(__name__)
+
+
+class Store(object):
+
+    """
+    Accumulate per-frame arrays in a preallocated contiguous array.
+
+    If the shape of the arrays changes across frames, as it happens
+    for grandcanonical trajectories or for filters that select a
+    varying number of particles, we fall back to a list of arrays.
+
+    If `dtype` is not None, floating point arrays are stored with
+    this data type, e.g. `numpy.float32` to halve the memory
+    footprint.
+
+    Frames can be stored at arbitrary positions by passing their
+    index as `frame` to `append()`: this is used when only some of the
+    frames of a trajectory are read. Frames that are not stored are
+    left zeroed (empty arrays if we fall back to a list) and
+    `finalize()` then returns all the `nframes` frames.
+    """
+
+    def __init__(self, nframes, dtype=None):
+        self.nframes = nframes
+        self.dtype = dtype
+        self._data = None
+        self._list = None
+        self._size = 0
+        self._sparse = False
+        self._stored = set()
+
+    def _cast(self, x):
+        x = numpy.asarray(x)
+        if self.dtype is not None and x.dtype.kind == 'f':
+            x = x.astype(self.dtype, copy=False)
+        return x
+
+    def append(self, x, frame=None):
+        x = self._cast(x)
+        if frame is None:
+            frame = self._size
+        elif frame != self._size:
+            self._sparse = True
+        if self._list is None:
+            if self._data is None:
+                # Zeroed memory is allocated lazily, thus frames that
+                # are never stored do not take up space
+                self._data = numpy.zeros((self.nframes, ) + x.shape, dtype=x.dtype)
+            elif x.shape != self._data.shape[1:] or frame >= self.nframes:
+                # Shape mismatch: switch to a list of arrays. Frames
+                # that were not stored become empty arrays
+                empty = numpy.empty((0, ) + self._data.shape[2:], dtype=self._data.dtype)
+                self._list = [self._data[i].copy() if i in self._stored else empty
+                              for i in range(self._size)]
+                self._data = None
+        if self._list is not None:
+            while len(self._list) <= frame:
+                self._list.append(numpy.empty((0, ) + x.shape[1:], dtype=x.dtype))
+            self._list[frame] = x
+        else:
+            self._data[frame] = x
+        self._stored.add(frame)
+        self._size = max(self._size, frame + 1)
+
+    def finalize(self):
+        """Return the stored frames as an array or as a list of arrays"""
+        if self._list is not None:
+            if self._sparse:
+                while len(self._list) < self.nframes:
+                    self._list.append(numpy.empty((0, ) + self._list[0].shape[1:],
+                                                  dtype=self._list[0].dtype))
+            return self._list
+        if self._data is None:
+            return []
+        if self._sparse:
+            return self._data
+        return self._data[:self._size]
+
+
+class SpeciesCodes(object):
+
+    """
+    Map arrays of species names to integer codes, i.e. their indices
+    in the list `species`.
+
+    The mapping is vectorized with a binary search over the sorted
+    species. The codes of the last array are stored and returned
+    again if the species layout is unchanged, which is the common
+    case across the frames of a trajectory.
+    """
+
+    def __init__(self, species):
+        self.species = list(species)
+        names = numpy.asarray(self.species)
+        self._order = numpy.argsort(names, kind='mergesort').astype(numpy.int32)
+        self._sorted = names[self._order]
+        self._names = None
+        self._codes = None
+
+    def __call__(self, names):
+        """Return the int32 codes of the array of species `names`"""
+        names = numpy.asarray(names)
+        if self._names is not None and names.shape == self._names.shape and \
+           numpy.array_equal(names, self._names):
+            return self._codes
+        if len(names) == 0:
+            codes = numpy.empty(0, dtype=numpy.int32)
+        else:
+            where = numpy.searchsorted(self._sorted, names)
+            where = numpy.minimum(where, len(self._sorted) - 1)
+            found = self._sorted[where] == names
+            if not numpy.all(found):
+                missing = names[~numpy.asarray(found, dtype=bool)][0]
+                raise ValueError('{} is not in list of species'.format(missing))
+            codes = self._order[where]
+        self._names, self._codes = names, codes
+        return codes
+
+
+def callback_key(cbk, args=(), kwargs=None):
+    """
+    Return a string identifying the callback `cbk` called with
+    arguments `args` and `kwargs`.
+
+    Callbacks are identified by their name, their bytecode and the
+    repr of their arguments. Callbacks are thus assumed to be pure
+    functions of their arguments.
+    """
+    name = '{}.{}'.format(getattr(cbk, '__module__', ''),
+                          getattr(cbk, '__name__', repr(cbk)))
+    code = getattr(cbk, '__code__', None)
+    if code is not None:
+        name += ':' + hashlib.md5(code.co_code).hexdigest()
+    if kwargs is None:
+        kwargs = {}
+    return '{}{}{}'.format(name, repr(args), repr(sorted(kwargs.items())))
+
+
+def trajectory_key(trajectory):
+    """
+    Return a hash identifying the content of `trajectory`.
+
+    The hash depends on the path, size and modification time of the
+    trajectory file, on the frames (steps) of the trajectory and on
+    its callbacks. If the trajectory is not associated to a file, the
+    function returns None.
+    """
+    filename = getattr(trajectory, 'filename', None)
+    if filename is None or not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    md5 = hashlib.md5()
+    for entry in [os.path.abspath(filename), stat.st_size, stat.st_mtime,
+                  trajectory.__class__.__name__, len(trajectory)]:
+        md5.update(str(entry).encode())
+    md5.update(numpy.array(trajectory.steps, dtype=numpy.int64).tobytes())
+    # Views on other trajectories, e.g. slices, also depend on the
+    # callbacks of the latter
+    while trajectory is not None:
+        callbacks = list(getattr(trajectory, 'callbacks', []))
+        callbacks += getattr(trajectory, 'class_callbacks', None) or []
+        for cbk, args, kwargs in callbacks:
+            md5.update(callback_key(cbk, args, kwargs).encode())
+        trajectory = getattr(trajectory, 'component', None)
+    return md5.hexdigest()
+
+
+class Cache(object):
+
+    """
+    Persistent cache of phase space arrays.
+
+    Arrays are stored as `.npy` files in the directory `path` and
+    loaded back as read-only memory-mapped arrays.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, name):
+        return os.path.join(self.path, name.strip('_') + '.npy')
+
+    def load(self, names):
+        """
+        Return a dictionary of memory-mapped arrays for the list of
+        `names` or None if any of them is not found in the cache.
+        """
+        for name in names:
+            if not os.path.exists(self._file(name)):
+                return None
+        _log.info('loading phase space from cache %s', self.path)
+        arrays = {}
+        for name in names:
+            try:
+                arrays[name] = numpy.load(self._file(name), mmap_mode='r')
+            except ValueError:
+                # Empty arrays cannot be memory-mapped
+                arrays[name] = numpy.load(self._file(name))
+        return arrays
+
+    def save(self, arrays):
+        """
+        Save the dictionary of `arrays` in the cache.
+
+        Only contiguous arrays are cached, lists of arrays are
+        ignored. Return True if all arrays have been cached.
+        """
+        done = True
+        for name, data in arrays.items():
+            if not isinstance(data, numpy.ndarray):
+                done = False
+                continue
+            try:
+                if not os.path.exists(self.path):
+                    os.makedirs(self.path)
+                # Write to a temporary file first, so that concurrent
+                # readers never see a partially written array
+                tmp = self._file(name) + '.tmp'
+                with open(tmp, 'wb') as fh:
+                    numpy.save(fh, data)
+                os.rename(tmp, self._file(name))
+            except (IOError, OSError) as e:
+                _log.warning('could not cache phase space in %s (%s)', self.path, e)
+                return False
+        return done
+
+
+def subtract_cm(pos, mass=None):
+    """
+    Return the positions `pos`, an array of shape (..., N, ndim), with
+    the center of mass of each frame subtracted. Particles are
+    weighted by `mass` if given.
+    """
+    pos = numpy.asarray(pos)
+    if mass is None:
+        cm = numpy.mean(pos, axis=-2)
+    else:
+        mass = numpy.asarray(mass, dtype=float)
+        cm = numpy.sum(pos * mass[:, numpy.newaxis], axis=-2) / numpy.sum(mass)
+    return pos - cm[..., numpy.newaxis, :]
+
+
+class Unfolder(object):
+
+    """
+    Unfold positions incrementally, as frames are appended.
+
+    As in `atooms.trajectory.decorators.Unfolded`, the first frame is
+    left untouched and the displacements between consecutive frames
+    are computed with the minimum image convention, using the cell
+    side of the later frame. If `fix_cm` is True, the center of mass
+    of the unfolded positions, weighted by `mass`, is subtracted at
+    each frame.
+    """
+
+    def __init__(self, fix_cm=False, mass=None):
+        self.fix_cm = fix_cm
+        self.mass = mass
+        self._last = None
+        self._last_unf = None
+
+    def append(self, pos, side):
+        """
+        Append the folded positions `pos` of a frame, an array of shape
+        (N, ndim), or of several frames, an array of shape (nframes,
+        N, ndim), with cell sides `side`. Return the unfolded
+        positions of the appended frames.
+        """
+        pos = numpy.asarray(pos, dtype=float)
+        side = numpy.asarray(side, dtype=float)
+        single = pos.ndim == 2
+        if single:
+            pos, side = pos[numpy.newaxis], side[numpy.newaxis]
+        if len(pos) == 0:
+            return pos
+        if self._last is None:
+            start, side = pos[:1], side[1:]
+        else:
+            if pos.shape[1:] != self._last.shape:
+                raise ValueError('cannot unfold positions when the number of particles changes')
+            start, pos = self._last_unf[numpy.newaxis], numpy.concatenate([self._last[numpy.newaxis], pos])
+        dif = numpy.diff(pos, axis=0)
+        dif -= numpy.rint(dif / side[:, numpy.newaxis, :]) * side[:, numpy.newaxis, :]
+        # Summing the displacements frame by frame gives the same
+        # rounding as the incremental unfolding
+        unf = numpy.cumsum(numpy.concatenate([start, dif]), axis=0)
+        if self._last is not None:
+            unf = unf[1:]
+        self._last, self._last_unf = pos[-1].copy(), unf[-1].copy()
+        if self.fix_cm:
+            unf = subtract_cm(unf, self.mass)
+        return unf[0] if single else unf
+
+
+def unfold(pos, side, fix_cm=False, mass=None):
+    """
+    Unfold the folded positions `pos`, an array of shape (nframes, N,
+    ndim), using the cell sides `side` at each frame, see `Unfolder`.
+    """
+    return Unfolder(fix_cm, mass).append(pos, side)
@@ -0,0 +1,273 @@
+# This file is part of atooms
+# Copyright 2010-2018, Daniele Coslovich
+
+"""
+Compute several correlation functions from a single pass over a
+trajectory.
+
+Each correlation function normally dumps its own phase space arrays
+from the trajectory. A `Pipeline` instead reads the union of the
+variables requested by all its correlation functions once and
+shares the same arrays among them. Correlation functions are grouped
+by trajectory, filters, center-of-mass fixing, data type and caching
+of the arrays: arrays are shared only within a group. Partial
+correlations that can be computed in a single pass over the
+unfiltered arrays, see `Partial`, join the group of unfiltered
+correlations.
+
+Example:
+-------
+
+    with Trajectory('trajectory.xyz') as th:
+        pp.Pipeline([pp.MeanSquareDisplacement(th),
+                     pp.RadialDistributionFunction(th),
+                     pp.StructureFactor(th)]).do()
+"""
+
+import logging
+
+from atooms.core.utils import Timer
+
+from .correlation import Correlation
+from .partial import Partial
+
+__all__ = ['Pipeline']
+
+_log = logging.getLogger(__name__)
+
+# Private arrays shared between correlation functions
+_arrays = ['_pos', '_vel', '_ids', '_pos_unf',
+           '_pos_0', '_pos_1', '_vel_0', '_vel_1',
+           '_ids_0', '_ids_1', '_pos_unf_0', '_pos_unf_1', '_cell_side']
+
+
+def _phasespace(cf):
+    """Return the phasespace of correlation `cf` as a list"""
+    if isinstance(cf.phasespace, (list, tuple)):
+        return list(cf.phasespace)
+    return [cf.phasespace]
+
+
+def _filters(cf):
+    """Return the filters actually applied when dumping the arrays of `cf`"""
+    filters = list(zip(cf._cbk, cf._cbk_args, cf._cbk_kwargs))
+    # One-body correlations, as well as two-body correlations with a
+    # single filter, only use the first filter
+    if cf.nbodies == 1 or len(filters) <= 1:
+        filters = filters[:1]
+    return filters
+
+
+def _key(cf):
+    return (cf.trajectory, cf._fix_cm, cf.dtype, cf.phasespace_cache, _filters(cf))
+
+
+def _same_key(key, other):
+    # We cannot hash filters in general (arguments may be lists), so
+    # keys are compared by equality. If the comparison is ambiguous,
+    # e.g. with array arguments, the arrays are not shared.
+    try:
+        return bool(key == other)
+    except ValueError:
+        return False
+
+
+class Pipeline(object):
+
+    """
+    Compute a list of correlation functions with a single pass over
+    the trajectory.
+
+    The `correlations` list may contain `Correlation` and `Partial`
+    instances. Correlation functions with weights are supported, but
+    the weights are still dumped separately by each of them.
+    """
+
+    def __init__(self, correlations):
+        self.correlations = correlations
+
+    def _flatten(self, todo=None):
+        """
+        Return the list of correlation functions to compute.
+
+        Symmetric entries (jsp, isp) of two-body partial correlations
+        are not included, see `_symmetrize()`.
+        """
+        flat = []
+        for cf in self.correlations:
+            if todo is not None and cf not in todo:
+                continue
+            if isinstance(cf, Partial):
+                for key in sorted(cf.partial, key=str):
+                    if cf.nbodies == 2 and \
+                       cf.species.index(key[0]) > cf.species.index(key[1]):
+                        continue
+                    flat.append(cf.partial[key])
+            else:
+                flat.append(cf)
+        return flat
+
+    def _tasks(self, todo=None):
+        """
+        Return the list of correlation functions to compute.
+
+        Partial correlations computed in a single pass contribute
+        their unfiltered correlation, the others are expanded as in
+        `_flatten()`.
+        """
+        tasks = []
+        for cf in self.correlations:
+            if todo is not None and cf not in todo:
+                continue
+            if isinstance(cf, Partial) and cf._single_pass():
+                tasks.append(cf._unfiltered())
+            else:
+                tasks += self._flatten([cf])
+        return tasks
+
+    def _symmetrize(self, todo=None):
+        """Copy the results of two-body partial correlations to (jsp, isp)"""
+        for cf in self.correlations:
+            if todo is not None and cf not in todo:
+                continue
+            if isinstance(cf, Partial) and cf.nbodies == 2:
+                for isp, jsp in cf.partial:
+                    if cf.species.index(isp) > cf.species.index(jsp):
+                        cf.partial[(isp, jsp)].grid = cf.partial[(jsp, isp)].grid
+                        cf.partial[(isp, jsp)].value = cf.partial[(jsp, isp)].value
+                        cf.partial[(isp, jsp)].error = cf.partial[(jsp, isp)].error
+
+    def _groups(self, correlations):
+        """Group correlation functions that can share the same arrays"""
+        groups = []
+        for cf in correlations:
+            for key, group in groups:
+                if _same_key(key, _key(cf)):
+                    group.append(cf)
+                    break
+            else:
+                groups.append((_key(cf), [cf]))
+        return [group for _, group in groups]
+
+    def _setup_arrays(self, group):
+        """
+        Dump the union of the phase space variables of the correlation
+        functions in `group` and share them among the latter.
+        """
+        phasespace = []
+        for cf in group:
+            for variable in _phasespace(cf):
+                if variable not in phasespace:
+                    phasespace.append(variable)
+
+        # A bare correlation function is used to dump the arrays. We
+        # use the two-body setup, which reduces to the one-body one
+        # when there are less than two filters.
+        first = group[0]
+        reader = Correlation(first.trajectory, None, norigins=-1,
+                             fix_cm=first._fix_cm)
+        reader.nbodies = 2
+        reader.phasespace = phasespace
+        reader.dtype = first.dtype
+        reader.phasespace_cache = first.phasespace_cache
+        # The number of workers does not affect the arrays
+        reader.nworkers = max([cf.nworkers for cf in group])
+        for cbk, args, kwargs in _filters(first):
+            reader.add_filter(cbk, *args, **kwargs)
+        reader._setup_arrays(frames=self._required_frames(group))
+
+        for cf in group:
+            for name in _arrays:
+                setattr(cf, name, getattr(reader, name))
+            cf._frames = reader._frames
+            cf._phasespace_ready = True
+
+    def _required_frames(self, group):
+        """
+        Return the union of the frames required by the correlation
+        functions in `group` or None if all frames are needed.
+        """
+        frames = set()
+        for cf in group:
+            if 'pos-unf' in _phasespace(cf):
+                return None
+            required = cf._required_frames()
+            if required is None:
+                return None
+            frames.update(required)
+        return sorted(frames)
+
+    def compute(self, todo=None):
+        """
+        Compute all the correlation functions.
+
+        If `todo` is given, only the correlation functions (or partial
+        correlations) in this list are computed.
+        """
+        correlations = self._tasks(todo)
+        groups = self._groups(correlations)
+        _log.info('computing %d correlation functions in %d passes',
+                  len(correlations), len(groups))
+        for group in groups:
+            timer = Timer()
+            timer.start()
+            self._setup_arrays(group)
+            timer.stop()
+            _log.info('shared setup for %d correlation functions done in %.1f sec',
+                      len(group), timer.wall_time)
+            for cf in group:
+                cf.compute()
+                # Release the references to the shared arrays
+                for name in _arrays:
+                    setattr(cf, name, [])
+                cf._frames = None
+                cf._phasespace_ready = False
+        for cf in self.correlations:
+            if todo is not None and cf not in todo:
+                continue
+            if isinstance(cf, Partial) and cf._single_pass():
+                cf._set_species_results()
+        self._symmetrize(todo)
+
+    def do(self, update=False):
+        """
+        Do the full template pattern for all the correlation
+        functions: compute, analyze and write.
+
+        If `update` is True, the results found in the cache of results
+        are not computed again, see `Correlation.do()`.
+        """
+        todo, cached = [], []
+        for cf in self.correlations:
+            if update and not cf.need_update():
+                cached.append(cf)
+            else:
+                todo.append(cf)
+
+        self.compute(todo)
+
+        for cf in self._flatten(cached) + self._symmetric(cached):
+            cf._read_cache()
+        if update:
+            for cf in self._flatten(todo) + self._symmetric(todo):
+                cf._write_cache()
+
+        for cf in self._flatten(todo + cached) + self._symmetric(todo + cached):
+            try:
+                cf.analyze()
+            except ImportError as e:
+                _log.warn('Could not analyze due to missing modules, continuing...')
+                _log.warn(e.message)
+            cf.write()
+
+    def _symmetric(self, todo):
+        """Return the symmetric entries skipped by `_flatten()`"""
+        flat = self._flatten(todo)
+        symmetric = []
+        for cf in self.correlations:
+            if cf not in todo or not isinstance(cf, Partial):
+                continue
+            for key in sorted(cf.partial, key=str):
+                if cf.partial[key] not in flat:
+                    symmetric.append(cf.partial[key])
+        return symmetric
@@ -6,8 +6,8 @@
 import numpy
 
 from .helpers import logx_grid
-from .correlation import Correlation, gcf_offset
-from .helpers import setup_t_grid
+from .correlation import Correlation, gcf_offset, gcf_offset_batch, gcf_multiple_tau
+from .helpers import setup_t_grid, required_frames
 
 __all__ = ['CollectiveOverlap', 'SelfOverlap']
 
@@ -26,9 +26,21 @@ def square_displacement(x, y, L=None):
     """Return array of square distances (no pbc)."""
     return numpy.sum((x-y)**2, axis=1)
 
-def collective_overlap(r0, r1, side, a_square):
-    rij = pairs_numpy(square_displacement, r0, r1, side)
-    return (rij.flatten() < a_square).sum()
+def collective_overlap(r0, r1, side, a_square, search=None):
+    """
+    Return the number of pairs of particles in `r0` and `r1` closer
+    than `a_square**0.5` in a periodic cell of sides `side`.
+
+    Pairs are found with the pair search backend `search`, see
+    `neighbors.pair_search()`.
+    """
+    from .neighbors import pair_search, pairs_distance_squared
+
+    if search is None:
+        search = pair_search(a_square**0.5, side, r1)
+    offsets, indices = search.compute(side, r0, r1)
+    owner = numpy.repeat(numpy.arange(len(r0)), numpy.diff(offsets))
+    return (pairs_distance_squared(r0, r1, owner, indices, side) < a_square).sum()
 
 def self_overlap(r0, r1, side, a_square):
     rij = square_displacement(r0, r1)
@@ -37,7 +49,12 @@ def self_overlap(r0, r1, side, a_square):
 
 class CollectiveOverlap(Correlation):
 
-    """Time-dependent collective overlap."""
+    """
+    Time-dependent collective overlap.
+
+    Pairs of particles within a distance `a` are counted using the
+    minimum image convention.
+    """
 
     symbol = 'qt'
     short_name = 'Q(t)'
@@ -52,10 +69,16 @@ class CollectiveOverlap(Correlation):
             self.grid = logx_grid(0.0, self.trajectory.total_time * 0.75, tsamples)
         self._discrete_tgrid = setup_t_grid(self.trajectory, self.grid, offset=norigins != '1')
 
+    def _required_frames(self):
+        return required_frames(len(self.trajectory), self.skip, self._discrete_tgrid)
+
     def _compute(self):
-        side = self.trajectory.read(0).cell.side
+        from .neighbors import pair_search
+
+        side = self._cell_side[0]
+        search = pair_search(self.a_square**0.5, side, self._pos[0])
         def f(x, y):
-            return collective_overlap(x, y, side, self.a_square).sum() / float(x.shape[0])
+            return collective_overlap(x, y, side, self.a_square, search) / float(x.shape[0])
         self.grid, self.value = gcf_offset(f, self._discrete_tgrid,
                                            self.skip, self.trajectory.steps, self._pos)
         self.grid = [ti * self.trajectory.timestep for ti in self.grid]
@@ -63,7 +86,13 @@ class CollectiveOverlap(Correlation):
 
 class SelfOverlap(Correlation):
 
-    """Time-dependent self overlap."""
+    """
+    Time-dependent self overlap.
+
+    If `algorithm` is 'multiple-tau', the self overlap is computed on
+    a log-spaced time grid, up to the largest time in the grid, with
+    a multiple-tau correlator, see `gcf_multiple_tau()`.
+    """
 
     symbol = 'qst'
     short_name = 'Q_s(t)'
@@ -71,8 +100,9 @@ class SelfOverlap(Correlation):
     phasespace = 'pos-unf'
 
     def __init__(self, trajectory, tgrid=None, norigins=-1, a=0.3,
-                 tsamples=60):
+                 tsamples=60, algorithm='direct'):
         Correlation.__init__(self, trajectory, tgrid, norigins=norigins)
+        self.algorithm = algorithm
         if tgrid is None:
             self.grid = logx_grid(0.0, trajectory.total_time * 0.75, tsamples)
         self._discrete_tgrid = setup_t_grid(self.trajectory, self.grid, offset=norigins != '1')
@@ -81,9 +111,19 @@ class SelfOverlap(Correlation):
     def _compute(self):
         side = self.trajectory.read(0).cell.side
         def f(x, y):
-            return self_overlap(x, y, side, self.a_square).sum() / float(x.shape[0])
-        self.grid, self.value = gcf_offset(f, self._discrete_tgrid,
-                                           self.skip, self.trajectory.steps, self._pos_unf)
+            overlap = numpy.sum((x - y)**2, axis=2) < self.a_square
+            return overlap.sum(axis=1) / float(x.shape[1])
+        blocks = self._block_average()
+        if self.algorithm == 'multiple-tau':
+            self.grid, self.value = gcf_multiple_tau(f, self.trajectory.steps, self._pos_unf,
+                                                     self.trajectory.block_size,
+                                                     tmax=max(self.grid) / self.trajectory.timestep,
+                                                     blocks=blocks)
+        else:
+            self.grid, self.value = gcf_offset_batch(f, self._discrete_tgrid,
+                                                     self.skip, self.trajectory.steps, self._pos_unf,
+                                                     blocks=blocks)
+        self._set_error(blocks)
         self.grid = [ti * self.trajectory.timestep for ti in self.grid]
 
     def analyze(self):
@@ -6,7 +6,7 @@
 
 import numpy
 
-from .correlation import Correlation, gcf_offset
+from .correlation import Correlation, gcf_offset_batch, gcf_multiple_tau
 from .helpers import setup_t_grid
 
 __all__ = ['StressAutocorrelation']
@@ -14,15 +14,23 @@ __all__ = ['StressAutocorrelation']
 
 class StressAutocorrelation(Correlation):
 
-    """Stress autocorrelation function."""
+    """
+    Stress autocorrelation function.
+
+    If `algorithm` is 'multiple-tau', the correlation function is
+    computed on a log-spaced time grid with a multiple-tau
+    correlator, averaging stresses at the coarse-grained levels, see
+    `gcf_multiple_tau()`.
+    """
 
     symbol = 'sacf'
     short_name = 'S(t)'
     long_name = 'stress autocorrelation'
     phasespace = ['vel']
 
-    def __init__(self, trajectory, tgrid, norigins=None):
+    def __init__(self, trajectory, tgrid, norigins=None, algorithm='direct'):
         Correlation.__init__(self, trajectory, tgrid, norigins=norigins)
+        self.algorithm = algorithm
         self._discrete_tgrid = setup_t_grid(self.trajectory, tgrid, offset=norigins != '1')
 
     def _get_stress(self):
@@ -42,13 +50,23 @@ class StressAutocorrelation(Correlation):
 
     def _compute(self):
         def f(x, y):
-            return numpy.sum(x*y) / float(x.shape[0])
+            return numpy.sum(x*y, axis=1) / float(x.shape[1])
 
         self._get_stress()
         V = self.trajectory.read(0).cell.volume
-        self.grid, self.value = gcf_offset(f, self._discrete_tgrid, self.trajectory.block_size,
-                                           self.trajectory.steps, self._stress)
+        blocks = self._block_average()
+        if self.algorithm == 'multiple-tau':
+            self.grid, self.value = gcf_multiple_tau(f, self.trajectory.steps, self._stress,
+                                                     self.trajectory.block_size,
+                                                     compression='average',
+                                                     tmax=max(self.grid) / self.trajectory.timestep,
+                                                     blocks=blocks)
+        else:
+            self.grid, self.value = gcf_offset_batch(f, self._discrete_tgrid, self.trajectory.block_size,
+                                                     self.trajectory.steps, self._stress,
+                                                     blocks=blocks)
         self.value = [x / V for x in self.value]
+        self._set_error(blocks, 1 / V)
         self.grid = [ti * self.trajectory.timestep for ti in self.grid]
 
     def analyze(self):
@@ -7,7 +7,8 @@ import logging
 import numpy
 
 from .progress import progress
-from .fourierspace import FourierSpaceCorrelation, expo_sphere
+from .fourierspace import FourierSpaceCorrelation, expo_sphere, rho_species
+from .helpers import required_frames
 
 __all__ = ['StructureFactor', 'StructureFactorLegacy', 'StructureFactorOptimized']
 
@@ -50,6 +51,7 @@ class StructureFactorLegacy(FourierSpaceCorrelation):
     short_name = 'S(k)'
     long_name = 'structure factor'
     phasespace = ['pos']
+    _species_resolved = True
 
     def __init__(self, trajectory, kgrid=None, norigins=-1, nk=20,
                  dk=0.1, kmin=-1.0, kmax=15.0, ksamples=30):
@@ -57,6 +59,9 @@ class StructureFactorLegacy(FourierSpaceCorrelation):
                                          nk, dk, kmin, kmax, ksamples)
         self._is_cell_variable = None
 
+    def _required_frames(self):
+        return required_frames(len(self.trajectory), self.skip)
+
     def _compute(self):
         nsteps = len(self._pos_0)
         ndims = len(self.k0)
@@ -68,6 +73,7 @@ class StructureFactorLegacy(FourierSpaceCorrelation):
         rho_1_av = [complex(0., 0.) for k in kgrid]
         rho2_av = [complex(0., 0.) for k in kgrid]
         variable_cell = is_cell_variable(self.trajectory)
+        blocks = self._block_average()
 
         for i in progress(range(0, nsteps, self.skip), total=nsteps // self.skip):
             # If cell changes we have to update the wave vectors
@@ -75,10 +81,12 @@ class StructureFactorLegacy(FourierSpaceCorrelation):
                 self._setup(i)
                 kgrid, selection = self._decimate_k()
                 kmax = max(self.kvector.keys()) + self.dk
+            # Value of S(k) at this time origin, for error estimates
+            sample = numpy.zeros(len(kgrid))
 
             # Tabulate exponentials
             # Note: tabulating and computing takes about the same time
-            if self._pos_0[i] is self._pos_1[i]:
+            if self._pos_0 is self._pos_1:
                 # Identical species
                 expo_0 = expo_sphere(self.k0, kmax, self._pos_0[i])
                 expo_1 = expo_0
@@ -148,6 +156,10 @@ class StructureFactorLegacy(FourierSpaceCorrelation):
                     rho_1_av[kk] += rho_1
                     rho2_av[kk] += (rho_0 * rho_1.conjugate())
                     cnt[kk] += 1
+                    sample[kk] += (rho_0 * rho_1.conjugate()).real / len(selection[kk])
+
+            if blocks is not None:
+                blocks.add(None, blocks.block(i, nsteps), sample)
 
         # In the absence of a microscopic field, the average density is zero.
         # We get rid of the average and compute <rho(k)rho*(k)>.
@@ -156,8 +168,9 @@ class StructureFactorLegacy(FourierSpaceCorrelation):
             rho_1_av = [complex(0., 0.) for k in kgrid]
 
         # Normalization
-        npart_0 = sum([p.shape[0] for p in self._pos_0]) / float(len(self._pos_0))
-        npart_1 = sum([p.shape[0] for p in self._pos_1]) / float(len(self._pos_1))
+        origins = range(0, nsteps, self.skip)
+        npart_0 = sum([self._pos_0[i].shape[0] for i in origins]) / float(len(origins))
+        npart_1 = sum([self._pos_1[i].shape[0] for i in origins]) / float(len(origins))
         self.grid = kgrid
         self.value, self.value_nonorm = [], []
         for kk in range(len(self.grid)):
@@ -165,6 +178,59 @@ class StructureFactorLegacy(FourierSpaceCorrelation):
             value = (rho2_av[kk] / cnt[kk] - rho_0_av[kk]*rho_1_av[kk].conjugate() / cnt[kk]**2).real
             self.value.append(value / norm)
             self.value_nonorm.append(value)
+        # With weights, the error of the average density is neglected
+        if blocks is not None:
+            self.error = list(blocks.error() / norm)
+
+    def _compute_species(self, species):
+        nsteps = len(self._pos)
+        nsp = len(species)
+        index = self._species_index(species)
+        # Setup k vectors
+        kgrid, selection = self.kgrid, self.selection
+        kmax = max(self.kvector.keys()) + self.dk
+        cnt = [0 for k in kgrid]
+        rho2_av = [numpy.zeros((nsp, nsp)) for k in kgrid]
+        npart = numpy.zeros(nsp)
+        variable_cell = is_cell_variable(self.trajectory)
+        blocks = self._block_average()
+
+        origins = range(0, nsteps, self.skip)
+        for i in progress(origins):
+            # If cell changes we have to update the wave vectors
+            if variable_cell:
+                self._setup(i)
+                kgrid, selection = self._decimate_k()
+                kmax = max(self.kvector.keys()) + self.dk
+
+            # The densities of all species are obtained from a single
+            # tabulation of the exponentials
+            ids = index[self._ids[i]]
+            npart += numpy.bincount(ids[ids >= 0], minlength=nsp)
+            expo = expo_sphere(self.k0, kmax, self._pos[i])
+            sample = numpy.zeros((len(kgrid), nsp, nsp))
+            for kk, knorm in enumerate(kgrid):
+                ikvec = [self.kvector[knorm][k] for k in selection[kk]]
+                rho = rho_species(expo, ids, nsp, ikvec)
+                rho2 = numpy.dot(rho, rho.conjugate().transpose()).real
+                rho2_av[kk] += rho2
+                cnt[kk] += len(ikvec)
+                sample[kk] = rho2 / len(ikvec)
+            if blocks is not None:
+                blocks.add(None, blocks.block(i, nsteps), sample)
+
+        # Normalization, see _compute()
+        npart /= len(origins)
+        error = blocks.error() if blocks is not None else None
+        results = {}
+        for a, isp in enumerate(species):
+            for b, jsp in enumerate(species):
+                norm = float(npart[a] * npart[b])**0.5
+                results[(isp, jsp)] = {'grid': kgrid,
+                                       'value': [rho2_av[kk][a, b] / cnt[kk] / norm
+                                                 for kk in range(len(kgrid))],
+                                       'error': None if error is None else list(error[:, a, b] / norm)}
+        return results
 
 
 class StructureFactorFast(StructureFactorLegacy):
@@ -179,6 +245,8 @@ class StructureFactorFast(StructureFactorLegacy):
     short_name = 'S(k)'
     long_name = 'structure factor'
     phasespace = ['pos']
+    # Partials are computed with the f90 kernel
+    _species_resolved = False
 
     def _compute(self):
         from atooms.trajectory.utils import is_cell_variable
@@ -196,16 +264,19 @@ class StructureFactorFast(StructureFactorLegacy):
         rho_av = [complex(0., 0.) for k in kgrid]
         rho2_av = [complex(0., 0.) for k in kgrid]
         variable_cell = is_cell_variable(self.trajectory)
+        blocks = self._block_average()
         for i in range(0, nsteps, self.skip):
             # If cell changes we have to update the wave vectors
             if variable_cell:
                 self._setup(i)
                 kgrid, selection = self._decimate_k()
                 kmax = max(self.kvector.keys()) + self.dk
+            block = blocks.block(i, nsteps) if blocks is not None else None
+            sample = numpy.zeros(len(kgrid))
 
             # Tabulate exponentials
             # Note: tabulating and computing takes about the same time
-            if self._pos_0[i] is self._pos_1[i]:
+            if self._pos_0 is self._pos_1:
                 # Identical species
                 expo_0 = expo_sphere(self.k0, kmax, self._pos_0[i])
                 expo_1 = expo_0
@@ -227,10 +298,14 @@ class StructureFactorFast(StructureFactorLegacy):
                 rho_1 = rho
                 rho2_av[kk] += numpy.sum(rho_0 * rho_1.conjugate())
                 cnt[kk] += rho.shape[0]
+                sample[kk] = numpy.sum(rho_0 * rho_1.conjugate()).real / rho.shape[0]
+            if blocks is not None:
+                blocks.add(None, block, sample)
 
         # Normalization.
-        npart_0 = sum([p.shape[0] for p in self._pos_0]) / float(len(self._pos_0))
-        npart_1 = sum([p.shape[0] for p in self._pos_1]) / float(len(self._pos_1))
+        origins = range(0, nsteps, self.skip)
+        npart_0 = sum([self._pos_0[i].shape[0] for i in origins]) / float(len(origins))
+        npart_1 = sum([self._pos_1[i].shape[0] for i in origins]) / float(len(origins))
         self.grid = kgrid
         self.value, self.value_nonorm = [], []
         for kk in range(len(self.grid)):
@@ -238,6 +313,8 @@ class StructureFactorFast(StructureFactorLegacy):
             value = (rho2_av[kk] / cnt[kk] - rho_av[kk]*rho_av[kk].conjugate() / cnt[kk]**2).real
             self.value.append(value / norm)
             self.value_nonorm.append(value)
+        if blocks is not None:
+            self.error = list(blocks.error() / norm)
 
 
 # Defaults to legacy
@@ -0,0 +1,83 @@
+# This file is part of atooms
+# Copyright 2010-2018, Daniele Coslovich
+
+"""
+Slices of trajectories as explicit plans of frames.
+
+`frame_plan()` turns the `first`, `last` and `skip` options of `pp.py`
+into the list of frames of a trajectory to analyze.
+`TrajectorySlice` then exposes these frames as a read-only
+trajectory, which reads each frame directly from the underlying
+trajectory. Frames outside the plan are never read, and systems are
+not cached: correlation functions store the phase space arrays they
+need anyway.
+
+Example:
+-------
+
+    with Trajectory('trajectory.xyz') as th:
+        # Analyze the last 10% of the trajectory
+        ts = TrajectorySlice(th, frame_plan(th, first=0.9))
+        pp.MeanSquareDisplacement(ts).do()
+"""
+
+from atooms.trajectory.base import TrajectoryBase
+from atooms.core.utils import fractional_slice
+
+__all__ = ['frame_plan', 'TrajectorySlice']
+
+
+def frame_plan(trajectory, first=None, last=None, skip=None):
+    """
+    Return the list of frames of `trajectory` between `first` and
+    `last`, every `skip` frames.
+
+    If `first` or `last` are in (0,1), they are fractions of the
+    length of the trajectory. If the trajectory has blocks of
+    exponentially spaced frames, the boundaries of the slice are
+    aligned to the blocks.
+    """
+    sl = fractional_slice(first, last, skip, len(trajectory))
+    if trajectory.block_size > 1:
+        block_size = trajectory.block_size
+        start = (sl.start // block_size) * block_size if sl.start is not None else sl.start
+        stop = (sl.stop // block_size) * block_size if sl.stop is not None else sl.stop
+        sl = slice(start, stop, sl.step)
+    return list(range(len(trajectory)))[sl]
+
+
+class TrajectorySlice(TrajectoryBase):
+
+    """
+    Read-only trajectory of the `frames` of `component`, a list of
+    frame indices.
+
+    Frame i is read as frame `frames[i]` of `component`, so that
+    callbacks and caching of the latter still apply. The file name is
+    that of the component.
+    """
+
+    def __init__(self, component, frames):
+        TrajectoryBase.__init__(self, None, 'r')
+        self.component = component
+        self.frames = list(frames)
+        self.filename = component.filename
+
+    def read_len(self):
+        return len(self.frames)
+
+    def read_steps(self):
+        steps = self.component.steps
+        return [steps[frame] for frame in self.frames]
+
+    def read_timestep(self):
+        return self.component.timestep
+
+    def read_sample(self, frame):
+        return self.component.read(self.frames[frame])
+
+    @property
+    def grandcanonical(self):
+        if self._grandcanonical is None:
+            self._grandcanonical = self.component.grandcanonical
+        return self._grandcanonical
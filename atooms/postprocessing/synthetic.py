@@ -0,0 +1,118 @@
+# This file is part of atooms
+# Copyright 2010-2018, Daniele Coslovich
+
+"""
+Synthetic trajectories stored in memory.
+
+`TrajectorySynthetic` behaves as a read-only atooms trajectory of
+non-interacting particles in a periodic cubic box, without touching
+the disk. It is meant for benchmarks and tests of correlation
+functions at arbitrary system sizes.
+
+Example:
+-------
+
+    th = TrajectorySynthetic(npart=10000, nframes=100, model='caged')
+    pp.SelfIntermediateScattering(th, kgrid=[7.0]).compute()
+"""
+
+import numpy
+from atooms.trajectory.base import TrajectoryBase
+from atooms.system import System, Particle, Cell
+
+__all__ = ['TrajectorySynthetic']
+
+
+class TrajectorySynthetic(TrajectoryBase):
+
+    """
+    In-memory trajectory of `npart` non-interacting particles at
+    given `density` in `ndim` dimensions.
+
+    The `species` dictionary gives the fraction of particles of each
+    species. Initial positions are uniformly distributed in the box
+    and particles then move according to `model`:
+
+    - brownian: free diffusion with diffusion coefficient `diffusion`
+    - caged: particles diffuse with coefficient `diffusion` at short
+      times but are confined around their initial positions (harmonic
+      cage) on a time scale `tau`, as in an Ornstein-Uhlenbeck process
+
+    Velocities are drawn from a Maxwell-Boltzmann distribution at unit
+    temperature, independently at each frame.
+
+    Frames are separated by a single step if `block_size` is 1,
+    otherwise steps are exponentially spaced within blocks of
+    `block_size` frames, i.e. 0, 1, 2, 4, ... Systems are built on the
+    fly from the stored unfolded positions when frames are read.
+    """
+
+    def __init__(self, npart=100, nframes=10, ndim=3, density=1.0,
+                 species=None, model='brownian', diffusion=0.1, tau=1.0,
+                 timestep=0.01, block_size=1, seed=1):
+        TrajectoryBase.__init__(self, None, 'r')
+        if species is None:
+            species = {'A': 0.8, 'B': 0.2}
+        if model not in ['brownian', 'caged']:
+            raise ValueError('unknown model {}'.format(model))
+        self.npart = npart
+        self.nframes = nframes
+        self.ndim = ndim
+        self.density = density
+        self.model = model
+        self.diffusion = diffusion
+        self.tau = tau
+        self.seed = seed
+        self._timestep = timestep
+        self._block_size = block_size
+        self._steps = self._setup_steps()
+        self._side = numpy.ones(ndim) * (npart / density)**(1.0 / ndim)
+
+        # Assign species by fraction, the last species takes the rest
+        names = sorted(species)
+        counts = [int(round(species[name] * npart)) for name in names[:-1]]
+        counts.append(npart - sum(counts))
+        self._species = numpy.repeat(names, counts)
+
+        random = numpy.random.RandomState(seed)
+        self._pos = numpy.empty((nframes, npart, ndim))
+        self._pos[0] = (random.random_sample((npart, ndim)) - 0.5) * self._side
+        for frame in range(1, nframes):
+            dt = (self._steps[frame] - self._steps[frame - 1]) * timestep
+            noise = random.normal(0.0, 1.0, (npart, ndim))
+            if model == 'brownian':
+                self._pos[frame] = self._pos[frame - 1] + (2 * diffusion * dt)**0.5 * noise
+            else:
+                decay = numpy.exp(-dt / tau)
+                sigma = (diffusion * tau * (1 - decay**2))**0.5
+                self._pos[frame] = self._pos[0] + \
+                    (self._pos[frame - 1] - self._pos[0]) * decay + sigma * noise
+
+    def _setup_steps(self):
+        if self._block_size == 1:
+            return list(range(self.nframes))
+        block = [0] + [2**i for i in range(self._block_size - 1)]
+        period = 2**(self._block_size - 1)
+        return [frame // self._block_size * period + block[frame % self._block_size]
+                for frame in range(self.nframes)]
+
+    def read_len(self):
+        return self.nframes
+
+    def read_steps(self):
+        return self._setup_steps()
+
+    def read_timestep(self):
+        return self._timestep
+
+    def read_block_size(self):
+        return self._block_size
+
+    def read_sample(self, frame):
+        pos = self._pos[frame] - numpy.rint(self._pos[frame] / self._side) * self._side
+        random = numpy.random.RandomState(self.seed + frame + 1)
+        vel = random.normal(0.0, 1.0, pos.shape)
+        particle = [Particle(species=self._species[i], position=pos[i],
+                             velocity=vel[i], radius=0.5)
+                    for i in range(self.npart)]
+        return System(particle, cell=Cell(self._side.copy()))
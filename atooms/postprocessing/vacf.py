@@ -5,30 +5,68 @@
 
 import numpy
 
-from .correlation import Correlation, gcf_offset
-from .helpers import setup_t_grid
+from .correlation import Correlation, gcf_offset_batch, gcf_fft, acf_fft, use_fft, _stack
+from .correlation import gcf_multiple_tau
+from .helpers import setup_t_grid, required_frames
 
 __all__ = ['VelocityAutocorrelation']
 
 
 class VelocityAutocorrelation(Correlation):
 
-    """Velocity autocorrelation function."""
+    """
+    Velocity autocorrelation function.
+
+    If `algorithm` is 'fft', the correlation function is computed
+    with FFT using all time origins, which requires equally spaced
+    frames. With 'multiple-tau', it is computed on a log-spaced time
+    grid with a multiple-tau correlator, averaging velocities at the
+    coarse-grained levels, see `gcf_multiple_tau()`. With 'auto', FFT
+    is used when it is cheaper and errors are not requested, see
+    `use_fft()`.
+    """
 
     symbol = 'vacf'
     short_name = 'Z(t)'
     long_name = 'velocity autocorrelation'
     phasespace = ['vel']
 
-    def __init__(self, trajectory, tgrid, norigins=None):
+    def __init__(self, trajectory, tgrid, norigins=None, algorithm='auto'):
         Correlation.__init__(self, trajectory, tgrid, norigins=norigins)
         self._discrete_tgrid = setup_t_grid(self.trajectory, tgrid, offset=norigins != '1')
+        self.algorithm = algorithm
+
+    def _use_fft(self):
+        if self.algorithm == 'multiple-tau':
+            return False
+        return use_fft(self.algorithm, self._discrete_tgrid, self.trajectory.block_size,
+                       self.trajectory.steps, self.trajectory.block_size,
+                       errors=self.error_blocks > 1)
+
+    def _required_frames(self):
+        if self.algorithm == 'multiple-tau' or self._use_fft():
+            return None
+        return required_frames(len(self.trajectory), self.trajectory.block_size,
+                               self._discrete_tgrid)
 
     def _compute(self):
         def f(x, y):
-            return numpy.sum(x * y) / float(x.shape[0])
-        self.grid, self.value = gcf_offset(f, self._discrete_tgrid,
-                                           self.trajectory.block_size,
-                                           self.trajectory.steps,
-                                           self._vel)
+            return numpy.sum(x * y, axis=(1, 2)) / float(x.shape[1])
+        vel = _stack(self._vel)
+        blocks = self._block_average()
+        if self.algorithm == 'multiple-tau':
+            self.grid, self.value = gcf_multiple_tau(f, self.trajectory.steps, vel,
+                                                     self.trajectory.block_size,
+                                                     compression='average',
+                                                     tmax=max(self.grid) / self.trajectory.timestep,
+                                                     blocks=blocks)
+        elif isinstance(vel, numpy.ndarray) and self._use_fft():
+            self.grid, self.value = gcf_fft(acf_fft, self._discrete_tgrid,
+                                            self.trajectory.steps, vel)
+        else:
+            self.grid, self.value = gcf_offset_batch(f, self._discrete_tgrid,
+                                                     self.trajectory.block_size,
+                                                     self.trajectory.steps,
+                                                     vel, blocks=blocks)
+        self._set_error(blocks)
         self.grid = [ti * self.trajectory.timestep for ti in self.grid]
@@ -31,19 +31,31 @@ parser.add_argument('--quiet', action='store_true', dest='quiet', help='quiet ou
 parser.add_argument('--verbose', action='store_true', dest='verbose', help='verbose output')
 parser.add_argument('--debug', action='store_true', dest='debug', help='debug output')
 parser.add_argument('--nup', action='store_true', dest='nup', help='answer to NUP query')
-parser.add_argument('--update', action='store_true', dest='update', help='compute only if update is needed')
+parser.add_argument('--update', action='store_true', dest='update', help='compute only if results are not found in the cache')
 parser.add_argument('--no-cache', action='store_true', dest='no_cache', help='disable trajectory cache')
 parser.add_argument('--species-layout', dest='species_layout', help='force species layout to F, C or A')
 parser.add_argument('--norigins', dest='norigins', help="time origins for averages")
 parser.add_argument('--no-partial', action='store_true', dest='no_partial', help='disable partial correlations')
 parser.add_argument('--filter', dest='filter', help='filter correlation function via arbitrary condition on particle properties')
+parser.add_argument('--float32', action='store_true', dest='float32', help='store phase space arrays in single precision')
+parser.add_argument('--phasespace-cache', action='store_true', dest='phasespace_cache', help='cache phase space arrays on disk')
+parser.add_argument('--nworkers', dest='nworkers', type=int, default=1, help='number of processes to read the trajectory')
+parser.add_argument('--error-blocks', dest='error_blocks', type=int, default=0, help='number of blocks to estimate statistical errors')
+parser.add_argument('--output-format', dest='output_format', default='txt', choices=['txt', 'npz', 'hdf5'], help='format of output files')
 argh.add_commands(parser, [msd, vacf, fkt, fskt, chi4qs, gr, sk, ik, alpha2, qst, qt, ba], func_kwargs={'formatter_class': CustomHelpFormatter})
 if argcomplete is not None:
     argcomplete.autocomplete(parser)
 args = parser.parse_args()
 
 # Modify output path
-postprocessing.correlation.core.pp_output_path = args.output 
+postprocessing.core.pp_output_path = args.output
+if args.float32:
+    postprocessing.core.pp_float_dtype = 'float32'
+if args.phasespace_cache:
+    postprocessing.core.pp_phasespace_cache = True
+postprocessing.core.pp_nworkers = args.nworkers
+postprocessing.core.pp_error_blocks = args.error_blocks
+postprocessing.core.pp_output_format = args.output_format
 
 if args.verbose:
     setup_logging('atooms', level=40)
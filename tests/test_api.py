@@ -44,6 +44,45 @@ class TestApi(unittest.TestCase):
     def test_chi4qs(self):
         api.chi4qs(self.test_file)
 
+    def test_slice(self):
+        from atooms.trajectory import TrajectoryXYZ, Sliced
+        import atooms.postprocessing as pp
+        args = api._compat({'first': 0.5, 'skip': 2})
+        with TrajectoryXYZ(self.test_file) as th:
+            ref = Sliced(th, slice(len(th) // 2, None, 2))
+            for ts in api._get_trajectories([self.test_file], args):
+                self.assertEqual(ts.steps, ref.steps)
+                self.assertEqual(len(ts), len(ref))
+                self.assertFalse(ts.component.cache)
+                cf = pp.MeanSquareDisplacement(ts, tsamples=5)
+                cf.compute()
+                cf_ref = pp.MeanSquareDisplacement(ref, tsamples=5)
+                cf_ref.compute()
+                self.assertEqual(cf.grid, cf_ref.grid)
+                self.assertLess(deviation(numpy.array(cf.value), numpy.array(cf_ref.value)), 1e-10)
+
+    def test_lazy_import(self):
+        import subprocess
+        import atooms.postprocessing as pp
+        # Public names resolve to the attributes of their modules
+        for name in pp.__all__:
+            value = getattr(pp, name)
+            module = sys.modules['atooms.postprocessing.' + pp._names[name]]
+            self.assertIs(value, getattr(module, name))
+        with self.assertRaises(AttributeError):
+            pp.NotACorrelation
+        # Importing the package does not pull in numpy and the correlations
+        if sys.version_info < (3, 7):
+            self.skipTest('lazy imports require python >= 3.7')
+        code = 'import sys, atooms.postprocessing.api; ' \
+               'print(sorted(m for m in ["numpy", "atooms.postprocessing.correlation", ' \
+               '"atooms.trajectory"] if m in sys.modules))'
+        root = os.path.join(os.path.dirname(__file__), '..')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(output.decode().strip(), '[]')
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import copy
 import sys
 import os
 import random
@@ -84,6 +85,178 @@ class TestRealSpace(unittest.TestCase):
             self.assertLess(deviation(p.value, ref_value[i]), 4e-2)
         ts.close()
 
+    def test_gcf_offset_batch(self):
+        from atooms.postprocessing.correlation import gcf_offset, gcf_offset_batch
+        from atooms.postprocessing.helpers import setup_t_grid
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            grid = setup_t_grid(th, [0.0, 3.0, 45.0, 90])
+            x = numpy.array([s.dump('pos') for s in th])
+            ref = gcf_offset(lambda x, y: numpy.sum((x-y)**2) / x.shape[0], grid, 2, th.steps, x)
+            for data, chunk_mb in [(x, 64.0), (x, 0.01), (list(x), 64.0)]:
+                res = gcf_offset_batch(lambda x, y: numpy.sum((x-y)**2, axis=(1, 2)) / x.shape[1],
+                                       grid, 2, th.steps, data, chunk_mb=chunk_mb)
+                self.assertEqual(res[0], ref[0])
+                self.assertLess(deviation(numpy.array(res[1]), numpy.array(ref[1])), 1e-10)
+            # Variable number of particles
+            x = [xi[:len(xi) - i % 2] for i, xi in enumerate(x)]
+            ref = gcf_offset(lambda x, y: numpy.sum(x[0] * y[0]), grid, 2, th.steps, x)
+            res = gcf_offset_batch(lambda x, y: numpy.sum(x[:, 0] * y[:, 0], axis=1), grid, 2, th.steps, x)
+            self.assertLess(deviation(numpy.array(res[1]), numpy.array(ref[1])), 1e-10)
+
+    def test_fft(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            tgrid = [th.timestep * i for i in range(0, 60, 3)]
+            for cls in [postprocessing.MeanSquareDisplacement,
+                        postprocessing.VelocityAutocorrelation]:
+                ref = cls(th, tgrid, norigins=-1, algorithm='direct')
+                ref.compute()
+                cf = cls(th, tgrid, norigins=-1, algorithm='fft')
+                cf.compute()
+                self.assertLess(deviation(numpy.array(cf.grid), numpy.array(ref.grid)), 1e-10)
+                self.assertLess(deviation(numpy.array(cf.value), numpy.array(ref.value)), 1e-8)
+
+    def test_multiple_tau(self):
+        from atooms.postprocessing.correlation import gcf_multiple_tau, gcf_offset_batch
+        def msd(x, y):
+            return numpy.sum((x-y)**2, axis=(1, 2)) / float(x.shape[1])
+        numpy.random.seed(1)
+        x = numpy.cumsum(numpy.random.normal(size=(256, 10, 3)), axis=0)
+        t = list(range(256))
+        dt, value = gcf_multiple_tau(msd, t, x, p=8, m=2)
+        self.assertEqual(dt[:10], [0, 1, 2, 3, 4, 5, 6, 7, 8, 10])
+        # The first level uses all the time origins
+        ref = gcf_offset_batch(msd, [(0, i) for i in range(8)], 1, t, x)
+        self.assertLess(deviation(numpy.array(value[:8]), numpy.array(ref[1])), 1e-10)
+        # At the second level, time origins are spaced by m
+        ref = gcf_offset_batch(msd, [(0, 10)], 2, t, x)
+        self.assertAlmostEqual(value[9], ref[1][0])
+        # Logarithmic blocks: 0, 1, 2, 4, 8, 9, 10, 12, ...
+        t = [i * 8 + j for i in range(64) for j in [0, 1, 2, 4]]
+        dt, value = gcf_multiple_tau(msd, t, x, block_size=4, p=8, m=2, tmax=80)
+        self.assertEqual(dt, [0, 1, 2, 4, 8, 16, 24, 32, 40, 48, 56, 64, 80])
+
+    def test_error(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            cf = postprocessing.MeanSquareDisplacement(th, [0.0, 3.0, 10.0, 20.0], norigins=-1)
+            cf.error_blocks = 4
+            cf.output_path = '/dev/null'
+            cf.compute()
+            self.assertEqual(len(cf.error), len(cf.value))
+            self.assertEqual(cf.error[0], 0.0)
+            self.assertTrue(all(0 < e < v for e, v in zip(cf.error[1:], cf.value[1:])))
+            cf = postprocessing.RadialDistributionFunction(th, norigins=-1)
+            cf.error_blocks = 4
+            cf.compute()
+            self.assertEqual(len(cf.error), len(cf.value))
+            self.assertTrue(numpy.all(numpy.isfinite(cf.error)))
+
+        # FFT is chosen on dense grids, unless errors are requested
+        from atooms.postprocessing.synthetic import TrajectorySynthetic
+        th = TrajectorySynthetic(20, 200)
+        for cls in [postprocessing.MeanSquareDisplacement, postprocessing.VelocityAutocorrelation]:
+            cf = cls(th, tgrid=[i * th.timestep for i in range(100)], norigins=-1)
+            cf.compute()
+            self.assertIsNone(cf.error)
+            value = cf.value
+            cf = cls(th, tgrid=[i * th.timestep for i in range(100)], norigins=-1)
+            cf.error_blocks = 4
+            cf.compute()
+            self.assertEqual(len(cf.error), len(cf.value))
+            self.assertLess(deviation(numpy.array(cf.value), numpy.array(value)), 1e-6)
+
+    def test_output_format(self):
+        import tempfile
+        import shutil
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        tmpdir = tempfile.mkdtemp()
+        formats = ['txt', 'npz']
+        try:
+            import h5py
+            formats.append('hdf5')
+        except ImportError:
+            pass
+        with trajectory.TrajectoryXYZ(f) as th:
+            for fmt in formats:
+                cf = postprocessing.MeanSquareDisplacement(th, [0.0, 3.0, 10.0, 20.0], norigins=-1)
+                cf.error_blocks = 4
+                cf.output_format = fmt
+                cf.output_path = os.path.join(tmpdir, 'msd.' + fmt)
+                cf.do()
+                value, error = cf.value, cf.error
+                cf.read()
+                self.assertLess(deviation(cf.value, value), 1e-4)
+                self.assertLess(deviation(cf.error, error), 1e-4)
+
+                cf = postprocessing.SelfIntermediateScattering(th, kgrid=[4.0, 7.3], tgrid=[0.0, 1.0, 10.0])
+                cf.output_format = fmt
+                cf.output_path = os.path.join(tmpdir, 'fskt.' + fmt)
+                cf.do()
+                grid, value = cf.grid, cf.value
+                cf.read()
+                self.assertLess(deviation(numpy.array(cf.grid[0]), numpy.array(grid[0])), 1e-4)
+                self.assertLess(deviation(numpy.array(cf.grid[1]), numpy.array(grid[1])), 1e-4)
+                self.assertLess(deviation(numpy.array(cf.value), numpy.array(value)), 1e-4)
+        shutil.rmtree(tmpdir)
+
+    def test_update(self):
+        import tempfile
+        import shutil
+        tmpdir = tempfile.mkdtemp()
+        f = os.path.join(tmpdir, 'kalj-small.xyz')
+        shutil.copy(os.path.join(self.reference_path, 'kalj-small.xyz'), f)
+
+        def compute(tgrid, norigins):
+            cf = postprocessing.MeanSquareDisplacement(f, tgrid, norigins=norigins)
+            need = cf.need_update()
+            cf.do(update=True)
+            return need, cf.value
+
+        need, value = compute([0.0, 3.0, 10.0], -1)
+        self.assertTrue(need)
+        need, cached = compute([0.0, 3.0, 10.0], -1)
+        self.assertFalse(need)
+        self.assertEqual(list(cached), list(value))
+        self.assertTrue(compute([0.0, 3.0, 20.0], -1)[0])
+        self.assertTrue(compute([0.0, 3.0, 10.0], 2)[0])
+        # Filters are part of the fingerprint
+        cf = postprocessing.MeanSquareDisplacement(f, [0.0, 3.0, 10.0], norigins=-1)
+        cf.add_filter(filter_species, 'A')
+        self.assertTrue(cf.need_update())
+        shutil.rmtree(tmpdir)
+
+    def test_synthetic(self):
+        from atooms.postprocessing.synthetic import TrajectorySynthetic
+        th = TrajectorySynthetic(npart=500, nframes=20, diffusion=0.5)
+        self.assertEqual(len(th), 20)
+        self.assertEqual(len(th[0].particle), 500)
+        self.assertEqual(sorted(th[0].distinct_species()), ['A', 'B'])
+        cf = postprocessing.MeanSquareDisplacement(th, [0.0, 0.1])
+        cf.compute()
+        self.assertLess(abs(cf.value[1] - 6 * 0.5 * 0.1), 0.02)
+        cf = postprocessing.RadialDistributionFunction(TrajectorySynthetic(npart=1000, nframes=2))
+        cf.compute()
+        self.assertLess(abs(numpy.mean(cf.value[10:]) - 1.0), 0.02)
+        th = TrajectorySynthetic(nframes=8, block_size=4, model='caged')
+        self.assertEqual(th.steps, [0, 1, 2, 4, 8, 9, 10, 12])
+        self.assertEqual(th.block_size, 4)
+
+    def test_bench(self):
+        import json
+        import tempfile
+        from atooms.postprocessing import bench
+        output = tempfile.mktemp()
+        results = bench.main(['-N', '50', '-f', '5', '-c', 'gr', 'msd', '-o', output])
+        with open(output) as fh:
+            data = json.load(fh)
+        os.remove(output)
+        self.assertEqual(len(data['results']), len(bench.cases['gr']) + len(bench.cases['msd']))
+        self.assertEqual(data['results'], results)
+        for result in results:
+            self.assertGreater(result['throughput'], 0)
+
     def test_gr_partial(self):
         f = os.path.join(self.reference_path, 'kalj-small.xyz')
         ts = trajectory.TrajectoryXYZ(f)
@@ -117,6 +290,176 @@ class TestRealSpace(unittest.TestCase):
             for ab in [('A', 'A'), ('A', 'B'), ('B', 'B')]:
                 self.assertLess(deviation(gr.partial[ab].value[21:25], ref[ab]), 4e-2)
 
+    def test_gr_partial_species(self):
+        # All partials in one pass must match the filtered ones
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            for cls in [postprocessing.RadialDistributionFunctionLegacy,
+                        postprocessing.RadialDistributionFunctionFast,
+                        postprocessing.RadialDistributionFunctionNumpy]:
+                cf = postprocessing.Partial(cls, ['A', 'B'], th, norigins=10)
+                self.assertTrue(cf._all is None)
+                cf.compute()
+                self.assertTrue(cf._all is not None)
+                ref = postprocessing.Partial(cls, ['A', 'B'], th, norigins=10)
+                ref._species_resolved = False
+                ref.compute()
+                self.assertTrue(ref._all is None)
+                for key in ref.partial:
+                    self.assertLess(deviation(cf.partial[key].grid, ref.partial[key].grid), 1e-10)
+                    self.assertLess(deviation(cf.partial[key].value, ref.partial[key].value), 1e-10)
+
+    def test_gr_numpy(self):
+        from atooms.postprocessing.gr import pairs_cells_hist, gr_kernel
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            # Full range, all pairs, and short range, cell lists. The
+            # last edge of the grid is subject to round-off for dr=0.1
+            for rmax, dr in [(-1.0, 0.04), (1.5, 0.04), (1.2, 0.1)]:
+                ref = postprocessing.RadialDistributionFunctionFast(th, norigins=10, rmax=rmax, dr=dr)
+                ref.compute()
+                cf = postprocessing.RadialDistributionFunctionNumpy(th, norigins=10, rmax=rmax, dr=dr)
+                cf.compute()
+                self.assertEqual(len(cf.grid), len(ref.grid))
+                self.assertLess(deviation(cf.grid, ref.grid), 1e-10)
+                self.assertLess(deviation(cf.value, ref.value), 1e-10)
+            # Distinct sets of particles, in 2d too
+            system = th[0]
+            x = system.dump('pos')
+            side = system.cell.side
+            bins = numpy.linspace(0.0, 1.5, 31)
+            for ndim in [2, 3]:
+                ref = numpy.zeros(len(bins) - 1, dtype=numpy.int64)
+                for i in range(100):
+                    ref += numpy.histogram(gr_kernel(x[100:, :ndim], x[i, :ndim], side[:ndim]), bins)[0]
+                hist = pairs_cells_hist(gr_kernel, x[:100, :ndim], x[100:, :ndim], side[:ndim], bins)
+                self.assertEqual(list(hist[0, 0]), list(ref))
+
+    def test_gr_streaming(self):
+        from atooms.postprocessing.synthetic import TrajectorySynthetic
+        th = TrajectorySynthetic(50, 200)
+        for cls in [postprocessing.RadialDistributionFunctionLegacy,
+                    postprocessing.RadialDistributionFunctionFast,
+                    postprocessing.RadialDistributionFunctionNumpy]:
+            cf = cls(th, norigins=-1)
+            cf._setup_arrays()
+            cf._phasespace_ready = True
+            # Cell sides are taken from the stored arrays
+            read = th.read
+            th.read = None
+            try:
+                cf.compute()
+            finally:
+                th.read = read
+            self.assertLess(abs(cf.value[-1] - 1.0), 0.2)
+
+    def test_linked_cells(self):
+        from atooms.postprocessing.linkedcells import LinkedCells
+        rcut = 1.5
+        random = numpy.random.RandomState(1)
+        # Less than 3 cells along some sides too
+        for side in [numpy.array([6.0, 4.0]), numpy.array([5.0, 5.0, 5.0]),
+                     numpy.array([7.0, 3.2, 5.0])]:
+            x = (random.random_sample((150, len(side))) - 0.5) * side
+            y = (random.random_sample((50, len(side))) - 0.5) * side
+            for other in [None, y]:
+                lc = LinkedCells(rcut)
+                offsets, indices = lc.compute(side, x, other)
+                pairs = set()
+                for i in range(len(x)):
+                    for j in indices[offsets[i]: offsets[i+1]]:
+                        pair = (i, j) if other is not None else (min(i, j), max(i, j))
+                        self.assertNotIn(pair, pairs)
+                        pairs.add(pair)
+                # All pairs within rcut are found
+                for i in range(len(x)):
+                    dr = (x if other is None else other) - x[i]
+                    dr -= numpy.rint(dr / side) * side
+                    for j in numpy.nonzero(numpy.sum(dr**2, axis=1) < rcut**2)[0]:
+                        if other is None and i == j:
+                            continue
+                        pair = (i, j) if other is not None else (min(i, j), max(i, j))
+                        self.assertIn(pair, pairs)
+                # Padded neighbors for the f90 kernels
+                neighbors, number = lc.compute(side, x, other, as_array=True)
+                for i in range(len(x)):
+                    self.assertEqual(list(neighbors[i, :number[i]]),
+                                     list(indices[offsets[i]: offsets[i+1]]))
+
+    def test_verlet_list(self):
+        from atooms.postprocessing.neighbors import VerletList
+        from atooms.postprocessing.synthetic import TrajectorySynthetic
+        rcut = 1.5
+        th = TrajectorySynthetic(300, 10, diffusion=0.01)
+        vl = VerletList(rcut, skin=0.3)
+        for system in th:
+            x = system.dump('pos')
+            side = system.cell.side
+            offsets, indices = vl.compute(side, x)
+            pairs = set()
+            for i in range(len(x)):
+                for j in indices[offsets[i]: offsets[i+1]]:
+                    pairs.add((min(i, j), max(i, j)))
+            # All pairs within rcut are in the list
+            for i in range(len(x)):
+                dr = x[i+1:] - x[i]
+                dr -= numpy.rint(dr / side) * side
+                for j in numpy.nonzero(numpy.sum(dr**2, axis=1) < rcut**2)[0]:
+                    self.assertIn((i, i+1+j), pairs)
+        # The list is reused across frames
+        self.assertGreater(vl.builds, 0)
+        self.assertLess(vl.builds, len(th))
+
+    def test_pair_search(self):
+        try:
+            import scipy
+        except ImportError:
+            self.skipTest('missing scipy')
+        from atooms.postprocessing.neighbors import pair_search, PeriodicKDTree
+        from atooms.postprocessing.linkedcells import LinkedCells
+        rcut = 1.5
+        random = numpy.random.RandomState(1)
+        side = numpy.array([10.0, 10.0, 10.0])
+        x = (random.random_sample((500, 3)) - 0.5) * side
+        y = (random.random_sample((100, 3)) - 0.5) * side
+        for other in [None, y]:
+            offsets, indices = PeriodicKDTree(rcut).compute(side, x, other)
+            for i in range(len(x)):
+                dr = (x if other is None else other) - x[i]
+                dr -= numpy.rint(dr / side) * side
+                js = numpy.nonzero(numpy.sum(dr**2, axis=1) < rcut**2)[0]
+                if other is None:
+                    js = js[js > i]
+                self.assertEqual(sorted(indices[offsets[i]: offsets[i+1]]), list(js))
+        # Cell lists for homogeneous systems, trees for slabs and thin cells
+        self.assertIsInstance(pair_search(rcut, side, x), LinkedCells)
+        slab = x * numpy.array([1.0, 1.0, 0.05])
+        self.assertIsInstance(pair_search(rcut, side, slab), PeriodicKDTree)
+        self.assertIsInstance(pair_search(rcut, numpy.array([10.0, 10.0, 2.0]), x), PeriodicKDTree)
+
+    def test_collective_overlap(self):
+        from atooms.postprocessing.qt import collective_overlap
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            r0, r1, side = th[0].dump('pos'), th[5].dump('pos'), th[0].cell.side
+            ref = 0
+            for i in range(len(r0)):
+                dr = r1 - r0[i]
+                dr -= numpy.rint(dr / side) * side
+                ref += numpy.sum(numpy.sum(dr**2, axis=1) < 0.3**2)
+            self.assertEqual(collective_overlap(r0, r1, side, 0.3**2), ref)
+
+    def test_ba(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            cf = postprocessing.BondAngleDistribution(th, norigins=10)
+            cf.compute()
+            # Explicit cutoffs
+            ref = postprocessing.BondAngleDistribution(th, norigins=10, rcut=cf.rcut)
+            ref.compute()
+            self.assertLess(deviation(cf.value, ref.value), 1e-10)
+            self.assertAlmostEqual(numpy.sum(cf.value) * (cf.grid[1] - cf.grid[0]), 1.0)
+
     def test_gr_filter(self):
         from atooms.postprocessing.filter import Filter
         f = os.path.join(self.reference_path, 'kalj-small.xyz')
@@ -139,6 +482,42 @@ class TestRealSpace(unittest.TestCase):
         self.assertLess(deviation(gr.value[21:25], ref[('B', 'B')]), 4e-2)
         ts.close()
 
+    def test_filter_condition(self):
+        from atooms.postprocessing.filter import Filter, ParticleArrays, mask_condition
+
+        def filter_slow(system, condition):
+            s = copy.copy(system)
+            s.particle = [p for p in system.particle
+                          if eval(condition, {'x': p.position[0], 'species': p.species})]
+            return s
+
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            condition = 'species == "A" and not x < 0'
+            mask = mask_condition(ParticleArrays(th[0]), condition)
+            self.assertEqual(list(numpy.nonzero(mask)[0]),
+                             [i for i, p in enumerate(th[0].particle)
+                              if p.species == 'A' and p.position[0] >= 0])
+            mask = mask_condition(ParticleArrays(th[0]), '-1 < x < 1 or species == "B"')
+            self.assertEqual(list(mask), [-1 < p.position[0] < 1 or p.species == 'B'
+                                          for p in th[0].particle])
+            gr = Filter(postprocessing.RadialDistributionFunction(th), condition)
+            gr.compute()
+            ref = postprocessing.RadialDistributionFunction(th)
+            ref.add_filter(filter_slow, condition)
+            ref.add_filter(lambda s: s)
+            ref.compute()
+            self.assertLess(deviation(gr.value, ref.value), 1e-10)
+            self.assertRaises(ValueError, mask_condition, ParticleArrays(th[0]), 'foo > 0')
+            # Logical operators on integer fields match the per-particle eval
+            system = th[0]
+            for i, p in enumerate(system.particle):
+                p.flag = i % 3
+            for condition in ['not flag', 'flag and x > 0', 'flag or x > 0', 'not flag or 0 < flag < 2']:
+                mask = mask_condition(ParticleArrays(system), condition)
+                self.assertEqual(list(mask), [bool(eval(condition, {'x': p.position[0], 'flag': p.flag}))
+                                              for p in system.particle])
+
 class TestFourierSpace(unittest.TestCase):
 
     def setUp(self):
@@ -252,6 +631,35 @@ class TestFourierSpace(unittest.TestCase):
         th.close()
         tt.close()
         
+    def test_partial_species(self):
+        # All partials in one pass must match the filtered ones
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            for cls, kwargs in [(postprocessing.StructureFactorLegacy, {'nk': 10}),
+                                (postprocessing.IntermediateScattering, {'nk': 4, 'tsamples': 10})]:
+                cf = postprocessing.Partial(cls, ['A', 'B'], th, [4.0, 7.3], **kwargs)
+                cf.compute()
+                ref = postprocessing.Partial(cls, ['A', 'B'], th, [4.0, 7.3], **kwargs)
+                ref._species_resolved = False
+                ref.compute()
+                for key in ref.partial:
+                    self.assertLess(deviation(numpy.array(cf.partial[key].value),
+                                              numpy.array(ref.partial[key].value)), 1e-10)
+
+            # With weights, partials are computed with filters
+            ff = os.path.join(self.reference_path, 'kalj-small-field.xyz')
+            cf = postprocessing.Partial(postprocessing.StructureFactorLegacy, ['A', 'B'], th, [4.0, 7.3])
+            cf.add_weight(trajectory=trajectory.TrajectoryXYZ(ff), field='field_B')
+            cf.compute()
+            self.assertTrue(cf._all is None)
+            ref = postprocessing.Partial(postprocessing.StructureFactorLegacy, ['A', 'B'], th, [4.0, 7.3])
+            ref._species_resolved = False
+            ref.add_weight(trajectory=trajectory.TrajectoryXYZ(ff), field='field_B')
+            ref.compute()
+            for key in ref.partial:
+                self.assertLess(deviation(numpy.array(cf.partial[key].value),
+                                          numpy.array(ref.partial[key].value)), 1e-10)
+
     def test_sk_field_partial(self):
         """
         Test that weight works with partial correlation
@@ -272,6 +680,38 @@ class TestFourierSpace(unittest.TestCase):
         self.assertLess(deviation(p.partial[('A', 'A')].value, zeros), 2e-2)
         th.close()
 
+    def test_error(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            cfs = [postprocessing.StructureFactorLegacy(th, [4, 7.3, 10]),
+                   postprocessing.IntermediateScattering(th, [4, 7.3, 10], nk=10, tgrid=[0.0, 1.0, 10.0]),
+                   postprocessing.SelfIntermediateScatteringLegacy(th, [4, 7.3, 10], nk=10, tgrid=[0.0, 1.0, 10.0])]
+            try:
+                from atooms.postprocessing.fourierspace_wrap import fourierspace_module
+                cfs.append(postprocessing.StructureFactorOptimized(th, [4, 7.3, 10]))
+                cfs.append(postprocessing.SelfIntermediateScatteringFast(th, [4, 7.3, 10], nk=10, tgrid=[0.0, 1.0, 10.0]))
+            except ImportError:
+                pass
+            for cf in cfs:
+                cf.error_blocks = 4
+                cf.compute()
+                self.assertEqual(numpy.array(cf.error).shape, numpy.array(cf.value).shape)
+                self.assertTrue(numpy.all(numpy.isfinite(cf.error)))
+                self.assertTrue(numpy.all(numpy.array(cf.error) >= 0))
+
+            # Partials computed in a single pass have errors too
+            for cls in [postprocessing.StructureFactorLegacy, postprocessing.IntermediateScattering]:
+                cf = postprocessing.Partial(cls, ['A', 'B'], th, [4, 7.3, 10], nk=10)
+                for partial in cf.partial.values():
+                    partial.error_blocks = 4
+                cf.compute()
+                ref = cls(th, [4, 7.3, 10], nk=10)
+                ref.add_filter(filter_species, 'B')
+                ref.error_blocks = 4
+                ref.compute()
+                self.assertLess(deviation(numpy.array(cf.partial[('B', 'B')].error).flatten(),
+                                          numpy.array(ref.error).flatten()), 1e-6)
+
     @unittest.skip('Broken test')
     def test_fkt_random(self):
         f = os.path.join(self.reference_path, 'kalj-small.xyz')
@@ -395,5 +835,236 @@ class TestFourierSpace(unittest.TestCase):
         self.assertLess(deviation(p.value, ref_value), 0.04)
         t.close()
         
+class TestPhaseSpace(unittest.TestCase):
+
+    def setUp(self):
+        self.reference_path = 'data'
+        if not os.path.exists(self.reference_path):
+            self.reference_path = os.path.join(os.path.dirname(sys.argv[0]), '../data')
+
+    def test_store(self):
+        from atooms.postprocessing.phasespace import Store
+        store = Store(3)
+        for i in range(3):
+            store.append(numpy.ones((4, 3)) * i)
+        data = store.finalize()
+        self.assertEqual(data.shape, (3, 4, 3))
+        self.assertEqual(data[2, 0, 0], 2.0)
+        # Variable number of particles
+        store = Store(3, dtype=numpy.float32)
+        for i in range(3):
+            store.append(numpy.ones((4 + i, 3)))
+        data = store.finalize()
+        self.assertIsInstance(data, list)
+        self.assertEqual(data[2].shape, (6, 3))
+        self.assertEqual(data[2].dtype, numpy.float32)
+        # Sparse frames with a variable number of particles: frames
+        # that are not stored are empty
+        store = Store(5)
+        store.append(numpy.ones((4, 3)), frame=0)
+        store.append(numpy.ones((4, 3)), frame=2)
+        store.append(numpy.ones((5, 3)), frame=3)
+        data = store.finalize()
+        self.assertEqual([len(x) for x in data], [4, 0, 4, 5, 0])
+        self.assertEqual(data[1].shape, (0, 3))
+
+    def test_species_codes(self):
+        from atooms.postprocessing.phasespace import SpeciesCodes
+        codes = SpeciesCodes(['B', 'A', 'C'])
+        names = numpy.array(['A', 'C', 'B', 'A'])
+        self.assertEqual(list(codes(names)), [1, 2, 0, 1])
+        self.assertEqual(codes(names.copy()).dtype, numpy.int32)
+        # Grandcanonical layout
+        self.assertEqual(list(codes(['C', 'C'])), [2, 2])
+        self.assertEqual(len(codes([])), 0)
+        self.assertRaises(ValueError, codes, ['A', 'D'])
+
+    def test_unfold(self):
+        from atooms.trajectory.decorators import Unfolded
+        from atooms.postprocessing.phasespace import Unfolder, unfold
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            pos = numpy.array([s.dump('pos') for s in th])
+            side = numpy.array([s.cell.side for s in th])
+            for fix_cm in [False, True]:
+                ref = numpy.array([s.dump('pos') for s in Unfolded(th, fixed_cm=fix_cm)])
+                self.assertLess(numpy.abs(unfold(pos, side, fix_cm=fix_cm) - ref).max(), 1e-10)
+                # Append frames incrementally
+                unfolder = Unfolder(fix_cm=fix_cm)
+                pos_unf = [unfolder.append(pos[0], side[0]), unfolder.append(pos[1:3], side[1:3])]
+                pos_unf += [unfolder.append(x, y) for x, y in zip(pos[3:], side[3:])]
+                self.assertLess(numpy.abs(numpy.vstack([pos_unf[0][numpy.newaxis], pos_unf[1],
+                                                        numpy.array(pos_unf[2:])]) - ref).max(), 1e-10)
+
+    def test_float32(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            ref = postprocessing.MeanSquareDisplacement(th, [0.0, 3.0, 45.0, 90])
+            ref.compute()
+            cf = postprocessing.MeanSquareDisplacement(th, [0.0, 3.0, 45.0, 90])
+            cf.dtype = numpy.float32
+            cf.compute()
+            self.assertEqual(cf._pos_unf.dtype, numpy.float32)
+            self.assertEqual(cf._pos_unf.shape, (len(th), len(th[0].particle), 3))
+            self.assertLess(deviation(numpy.array(cf.value), numpy.array(ref.value)), 1e-4)
+
+    def test_required_frames(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            for cls, args in [(postprocessing.RadialDistributionFunction, ()),
+                              (postprocessing.StructureFactor, ([4, 7.3, 10], )),
+                              (postprocessing.IntermediateScattering, ([4, 7.3], [0.0, 3.0]))]:
+                ref = cls(th, *args, norigins=0.2)
+                ref._required_frames = lambda: None
+                ref.compute()
+                cf = cls(th, *args, norigins=0.2)
+                cf.compute()
+                self.assertLess(len(cf._frames), len(th))
+                self.assertLess(deviation(numpy.array(cf.value), numpy.array(ref.value)), 1e-10)
+
+    def test_cache(self):
+        import shutil
+        import tempfile
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        tmpdir = tempfile.mkdtemp()
+        tmp = os.path.join(tmpdir, 'kalj-small.xyz')
+        shutil.copy(f, tmp)
+        try:
+            with trajectory.TrajectoryXYZ(tmp) as th:
+                values = []
+                for i in range(2):
+                    cf = postprocessing.MeanSquareDisplacement(th, [0.0, 3.0, 45.0, 90])
+                    cf.phasespace_cache = True
+                    cf.compute()
+                    values.append(cf.value)
+                    if i == 1:
+                        self.assertIsInstance(cf._pos_unf, numpy.memmap)
+                self.assertEqual(values[0], values[1])
+                self.assertTrue(os.path.exists(tmp + '.pp.cache'))
+                self.assertEqual(len(cf._cell_side), len(th))
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.reference_path = 'data'
+        if not os.path.exists(self.reference_path):
+            self.reference_path = os.path.join(os.path.dirname(sys.argv[0]), '../data')
+
+    def _compare(self, cf_ref, cf):
+        cf_ref.compute()
+        cf.nworkers = 2
+        cf.compute()
+        self.assertLess(deviation(numpy.array(cf.value), numpy.array(cf_ref.value)), 1e-10)
+
+    def test_onebody(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        tgrid = [0.0, 3.0, 45.0, 90]
+        with trajectory.TrajectoryXYZ(f) as th:
+            self._compare(postprocessing.MeanSquareDisplacement(th, tgrid),
+                          postprocessing.MeanSquareDisplacement(th, tgrid))
+            self._compare(postprocessing.MeanSquareDisplacement(th, tgrid, fix_cm=True),
+                          postprocessing.MeanSquareDisplacement(th, tgrid, fix_cm=True))
+            cf_ref = postprocessing.MeanSquareDisplacement(th, tgrid)
+            cf_ref.add_filter(filter_species, 'B')
+            cf = postprocessing.MeanSquareDisplacement(th, tgrid)
+            cf.add_filter(filter_species, 'B')
+            self._compare(cf_ref, cf)
+
+    def test_twobody(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            cfs = []
+            for _ in range(2):
+                cf = postprocessing.RadialDistributionFunction(th)
+                cf.add_filter(filter_species, 'A')
+                cf.add_filter(filter_species, 'B')
+                cfs.append(cf)
+            self._compare(*cfs)
+
+    def test_partial(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        tgrid = [0.0, 3.0, 45.0, 90]
+        with trajectory.TrajectoryXYZ(f) as th:
+            for cls, args in [(postprocessing.RadialDistributionFunction, ()),
+                              (postprocessing.MeanSquareDisplacement, (tgrid, ))]:
+                ref = postprocessing.Partial(cls, ['A', 'B'], th, *args)
+                ref.compute()
+                cf = postprocessing.Partial(cls, ['A', 'B'], th, *args, nworkers=2)
+                cf.compute()
+                self.assertEqual(sorted(cf.partial), sorted(ref.partial))
+                for key in ref.partial:
+                    self.assertLess(deviation(numpy.array(cf.partial[key].value),
+                                              numpy.array(ref.partial[key].value)), 1e-10)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.reference_path = 'data'
+        if not os.path.exists(self.reference_path):
+            self.reference_path = os.path.join(os.path.dirname(sys.argv[0]), '../data')
+
+    def test_pipeline(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            tgrid = [0.0, 3.0, 45.0, 90]
+            ref = [postprocessing.MeanSquareDisplacement(th, tgrid),
+                   postprocessing.RadialDistributionFunction(th),
+                   postprocessing.StructureFactor(th, [4, 7.3, 10])]
+            for cf in ref:
+                cf.compute()
+            cfs = [postprocessing.MeanSquareDisplacement(th, tgrid),
+                   postprocessing.RadialDistributionFunction(th),
+                   postprocessing.StructureFactor(th, [4, 7.3, 10])]
+            postprocessing.Pipeline(cfs).compute()
+            for cf, cf_ref in zip(cfs, ref):
+                self.assertLess(deviation(numpy.array(cf.value), numpy.array(cf_ref.value)), 1e-10)
+
+    def test_pipeline_partial(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            ref = postprocessing.Partial(postprocessing.RadialDistributionFunction, ['A', 'B'], th)
+            ref.compute()
+            gr = postprocessing.Partial(postprocessing.RadialDistributionFunction, ['A', 'B'], th)
+            msd = postprocessing.Partial(postprocessing.MeanSquareDisplacement, ['A', 'B'], th)
+            postprocessing.Pipeline([gr, msd]).compute()
+            for key in ref.partial:
+                self.assertLess(deviation(gr.partial[key].value, ref.partial[key].value), 1e-10)
+            self.assertTrue(len(msd.partial['A'].value) > 0)
+
+    def test_pipeline_partial_species(self):
+        # Species-resolved partials share the unfiltered pass
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            classes = [postprocessing.RadialDistributionFunction, postprocessing.StructureFactorLegacy]
+            args = [(), ([4, 7.3, 10], )]
+            ref = [postprocessing.Partial(cls, ['A', 'B'], th, *arg) for cls, arg in zip(classes, args)]
+            for cf in ref:
+                cf.compute()
+            cfs = [postprocessing.Partial(cls, ['A', 'B'], th, *arg) for cls, arg in zip(classes, args)]
+            cfs.append(postprocessing.MeanSquareDisplacement(th, [0.0, 3.0, 45.0, 90]))
+            pipeline = postprocessing.Pipeline(cfs)
+            self.assertEqual(len(pipeline._groups(pipeline._tasks())), 1)
+            pipeline.compute()
+            for cf, cf_ref in zip(cfs, ref):
+                for key in cf_ref.partial:
+                    self.assertLess(deviation(numpy.array(cf.partial[key].value),
+                                              numpy.array(cf_ref.partial[key].value)), 1e-10)
+            self.assertTrue(len(cfs[-1].value) > 0)
+
+    def test_pipeline_dtype(self):
+        f = os.path.join(self.reference_path, 'kalj-small.xyz')
+        with trajectory.TrajectoryXYZ(f) as th:
+            gr = postprocessing.RadialDistributionFunction(th)
+            gr.dtype = numpy.float32
+            msd = postprocessing.MeanSquareDisplacement(th, [0.0, 3.0, 45.0, 90])
+            msd.dtype = numpy.float64
+            pipeline = postprocessing.Pipeline([gr, msd])
+            self.assertEqual(len(pipeline._groups([gr, msd])), 2)
+            pipeline._setup_arrays([msd])
+            self.assertEqual(msd._pos_unf[0].dtype, numpy.float64)
+
 if __name__ == '__main__':
     unittest.main()